@@ -1,5 +1,6 @@
 """
-you must import this file before using any setting part of django on test
+you must import this file before using any setting part of django on test.
+the trainer and the util modules do not need it any more.
 """
 # from django.core.wsgi import get_wsgi_application
 # os.environ.setdefault("DJANGO_SETTINGS_MODULE", "img_ai_algorithm.settings")
@@ -7,7 +8,8 @@ from django.conf import settings
 from img_ai_trainer import settings as st
 import os
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "img_ai_trainer.settings")
-settings.configure(default_settings=st)
+if not settings.configured:
+    settings.configure(default_settings=st)
 from django.apps import AppConfig
 
 BASE_DIR = st.BASE_DIR
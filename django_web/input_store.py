@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+"""
+Content-addressed store of the training inputs: corpora and font files.
+
+Uploads are written to the store chunk by chunk while their sha256 is computed, a file is
+never held in memory. A file is a font when it starts with a sane sfnt header (table
+directory within the file) or a collection of them, otherwise it must be utf-8 text: a
+corpus starting with "true" or "OTTO" stays a text. A finished upload is named by its hash:
+
+    {root}/objects/ab/ab12...ef         the file, read-only
+    {root}/objects/ab/ab12...ef.json    size, kind (font or text), name of the first upload
+    {root}/tmp/                         uploads in progress
+
+Uploading a file already in the store only costs the transfer: the new copy is dropped and
+the existing object is returned. The digest is also recorded for file_util.file_hash, so
+that the font pool and the stage cache key the object by its hash without reading it again
+(see TrainingJob.file_hashes for worker processes).
+
+usage:
+    store = InputStore("/web/train_data/inputs")
+    upload = store.open_upload()
+    for chunk in chunks:
+        upload.write(chunk)
+    stored = upload.finish("simsun.ttc")   # StoredInput: sha256, size, kind, path
+
+    python -m django_web.input_store /web/train_data/inputs add simsun.ttc corpus.txt
+    python -m django_web.input_store /web/train_data/inputs list
+"""
+import argparse
+import codecs
+import hashlib
+import json
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+from django_web.model import ServiceException
+from django_web.util.file_util import remember_hash
+
+CHUNK_SIZE = 1024 * 1024  # Default size of the chunks read from uploads and files
+MAX_BYTES = 2 * 1024 * 1024 * 1024  # Default size limit of a stored file
+STALE_SECONDS = 24 * 3600  # uploads in progress older than this are removed
+KIND_FONT = 'font'
+KIND_TEXT = 'text'
+# first bytes of truetype/opentype fonts and collections
+SFNT_VERSIONS = (b'\x00\x01\x00\x00', b'OTTO', b'true')
+COLLECTION_TAG = b'ttcf'
+FONT_MAGICS = SFNT_VERSIONS + (COLLECTION_TAG,)
+MAX_TABLES = 512  # more tables in the directory of a font header: not a font
+MAX_FACES = 256  # more fonts in a collection header: not a collection
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+class StoredInput(object):
+    """ A file of the store """
+
+    def __init__(self, sha256, size, kind, name, path, new=False):
+        self.sha256 = sha256
+        self.size = size
+        self.kind = kind
+        self.name = name
+        self.path = path
+        # False when the content was already in the store
+        self.new = new
+
+    def to_dict(self):
+        return {'sha256': self.sha256, 'size': self.size, 'kind': self.kind, 'name': self.name, 'new': self.new}
+
+
+class Upload(object):
+    """ A file being written to the store, hashed and checked chunk by chunk """
+
+    def __init__(self, store, max_bytes):
+        self.store = store
+        self.max_bytes = max_bytes
+        fd, self.tmp_path = tempfile.mkstemp(dir=store.tmp_dir, prefix='upload_')
+        self.fp = os.fdopen(fd, 'wb')
+        self.sha = hashlib.sha256()
+        self.size = 0
+        self.head = b''
+        # the first bytes are those of a font, the header is checked by finish()
+        self.font_magic = None
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def write(self, chunk):
+        if self.fp is None:
+            raise ServiceException("the upload is closed")
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            self.abort()
+            raise ServiceException("the file exceeds %d bytes" % self.max_bytes)
+        self.sha.update(chunk)
+        self.fp.write(chunk)
+        if self.font_magic is None:
+            self.head += chunk
+            if len(self.head) >= 4:
+                self.font_magic = self.head[:4] in FONT_MAGICS
+                self.head = b''
+        if self.decoder is not None:
+            self._check_text(chunk)
+
+    def _check_text(self, chunk, final=False):
+        """ Decode the text so far; a file which may be a font is no longer a text, others are refused """
+        try:
+            self.decoder.decode(chunk, final)
+        except UnicodeDecodeError:
+            self.decoder = None
+            if not self.font_magic:
+                self._refuse()
+
+    def _refuse(self):
+        self.abort()
+        raise ServiceException("text inputs must be utf-8, fonts truetype or opentype files")
+
+    def finish(self, name):
+        """ Move the upload to its place in the store
+        :param name: file name given by the client, kept in the metadata
+        :return: StoredInput
+        """
+        self.fp.close()
+        self.fp = None
+        if self.font_magic and _is_font(self.tmp_path, self.size):
+            kind = KIND_FONT
+        else:
+            self.font_magic = False
+            if self.decoder is None:
+                self._refuse()
+            self._check_text(b'', final=True)
+            kind = KIND_TEXT
+        return self.store._commit(self.tmp_path, self.sha.hexdigest(), self.size, kind, name)
+
+    def abort(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def _is_font(path, size):
+    """ True if the file starts with a truetype/opentype header whose tables lie within the file, or with a
+    collection of such fonts
+    """
+    with open(path, 'rb') as fp:
+        head = fp.read(12)
+        if head[:4] != COLLECTION_TAG:
+            return _is_sfnt(fp, 0, size)
+        if len(head) < 12:
+            return False
+        faces = struct.unpack('>I', head[8:12])[0]
+        if not 0 < faces <= MAX_FACES:
+            return False
+        offsets = fp.read(4 * faces)
+        if len(offsets) < 4 * faces:
+            return False
+        return all(_is_sfnt(fp, offset, size) for offset in struct.unpack('>%dI' % faces, offsets))
+
+
+def _is_sfnt(fp, offset, size):
+    """ True if a sane sfnt header (version, number of tables, table directory) starts at offset """
+    fp.seek(offset)
+    header = fp.read(12)
+    if len(header) < 12 or header[:4] not in SFNT_VERSIONS:
+        return False
+    tables = struct.unpack('>H', header[4:6])[0]
+    if not 0 < tables <= MAX_TABLES:
+        return False
+    directory = fp.read(16 * tables)
+    if len(directory) < 16 * tables:
+        return False
+    for tag, _, table_offset, length in struct.iter_unpack('>4sIII', directory):
+        if not all(32 <= byte < 127 for byte in tag) or table_offset + length > size:
+            return False
+    return True
+
+
+class InputStore(object):
+    """ Files stored under the sha256 of their content """
+
+    def __init__(self, root, max_bytes=MAX_BYTES):
+        """
+        :param root: 存储目录
+        :param max_bytes: 单个文件的大小上限
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(root, 'objects')
+        self.tmp_dir = os.path.join(root, 'tmp')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self._remove_stale_uploads()
+
+    def _remove_stale_uploads(self):
+        limit = time.time() - STALE_SECONDS
+        for name in os.listdir(self.tmp_dir):
+            path = os.path.join(self.tmp_dir, name)
+            try:
+                if os.stat(path).st_mtime < limit:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def object_path(self, sha256):
+        return os.path.join(self.objects_dir, sha256[:2], sha256)
+
+    def open_upload(self):
+        return Upload(self, self.max_bytes)
+
+    def add_file(self, path, chunk_size=CHUNK_SIZE):
+        """ Copy a local file into the store """
+        upload = self.open_upload()
+        try:
+            with open(path, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(chunk_size), b''):
+                    upload.write(chunk)
+        except BaseException:
+            upload.abort()
+            raise
+        return upload.finish(os.path.basename(path))
+
+    def _commit(self, tmp_path, sha256, size, kind, name):
+        path = self.object_path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.chmod(tmp_path, 0o444)
+        try:
+            # a link fails when the object exists: identical concurrent uploads keep a single copy
+            os.link(tmp_path, path)
+            new = True
+        except FileExistsError:
+            new = False
+        finally:
+            os.remove(tmp_path)
+        meta_path = path + '.json'
+        if new or not os.path.exists(meta_path):
+            meta = {'size': size, 'kind': kind, 'name': name, 'created': time.time()}
+            tmp_meta = "%s.%d.%d.tmp" % (meta_path, os.getpid(), threading.get_ident())
+            with open(tmp_meta, 'w', encoding='UTF-8') as fp:
+                json.dump(meta, fp, ensure_ascii=False)
+            os.replace(tmp_meta, meta_path)
+        remember_hash(path, sha256)
+        stored = self.get(sha256)
+        stored.new = new
+        return stored
+
+    def get(self, sha256):
+        """ A stored file
+        :raise ServiceException: unknown or malformed hash
+        """
+        if not isinstance(sha256, str) or not DIGEST_RE.match(sha256):
+            raise ServiceException("%s is not a sha256 hex digest" % sha256)
+        path = self.object_path(sha256)
+        try:
+            with open(path + '.json', 'r', encoding='UTF-8') as fp:
+                meta = json.load(fp)
+        except (OSError, ValueError):
+            raise ServiceException("no input %s" % sha256)
+        remember_hash(path, sha256)
+        return StoredInput(sha256, meta['size'], meta['kind'], meta['name'], path)
+
+    def path(self, sha256, kind=None):
+        """ Path of a stored file, checking its kind """
+        stored = self.get(sha256)
+        if kind is not None and stored.kind != kind:
+            raise ServiceException("input %s is a %s, not a %s" % (sha256, stored.kind, kind))
+        return stored.path
+
+    def list(self):
+        for prefix in sorted(os.listdir(self.objects_dir)):
+            for name in sorted(os.listdir(os.path.join(self.objects_dir, prefix))):
+                if DIGEST_RE.match(name):
+                    yield self.get(name)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_input_store():
+    """ The input store of the process, configured from the django settings """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                from django.conf import settings
+
+                _store = InputStore(settings.INPUT_STORE_PATH, getattr(settings, 'INPUT_MAX_BYTES', MAX_BYTES))
+    return _store
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Add or list the files of an input store.')
+    parser.add_argument('root', help="store directory")
+    sub = parser.add_subparsers(dest='action')
+    sub.required = True
+    add_parser = sub.add_parser('add', help="copy files into the store")
+    add_parser.add_argument('paths', nargs='+')
+    sub.add_parser('list', help="stored files")
+    args = parser.parse_args(argv)
+
+    store = InputStore(args.root)
+    if args.action == 'add':
+        for path in args.paths:
+            stored = store.add_file(path)
+            print("%s  %s %10d  %s%s" % (stored.sha256, stored.kind.ljust(4), stored.size, stored.name,
+                                         "" if stored.new else " (already stored)"))
+    else:
+        for stored in store.list():
+            print("%s  %s %10d  %s" % (stored.sha256, stored.kind.ljust(4), stored.size, stored.name))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+
+"""
+Text recognition service with micro-batching.
+
+Requests are not recognized one by one: every text region goes into the queue of its
+language and psm, a dispatcher thread takes the queue holding the oldest region, waits at
+most max_wait_ms for it to fill up to batch_size regions and hands the batch to one of the
+recognizer workers, which stay warm between batches. Filling a batch never looks at the
+regions of other languages. A batch is only closed once a worker is free: under load the
+regions arriving meanwhile make full batches instead of small batches queued for the workers.
+
+Two recognizers are available:
+- tesserocr (when installed): each worker thread keeps a loaded tesseract API per
+  language/psm, a batch is a loop of SetImage/GetUTF8Text without any process spawn.
+- the tesseract command line: a batch is written as one multi-page tif and recognized by a
+  single tesseract process, the page texts being split on the form feeds tesseract writes
+  after every page.
+
+Models published through tesseract_trainer.publish are followed by a ModelWatcher, a new
+version is used by the next batches without restart.
+"""
+import io
+import itertools
+import math
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from django_web.model import ServiceException
+from django_web.util.lazy_import import LazyModule
+
+Image = LazyModule("PIL.Image")
+
+BATCH_SIZE = 16  # Default maximum number of regions recognized together
+MAX_WAIT_MS = 10  # Default time the dispatcher waits for more regions before sending a batch
+WORKERS = 4  # Default number of recognizer workers
+TIMEOUT = 30  # Default time a request waits for its texts, in seconds
+LATENCY_WINDOW = 4096  # number of recent requests the latency percentiles are computed on
+
+
+class LatencyStats(object):
+    """ Latencies of the recent requests and batch statistics """
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.regions = 0
+        self.batches = 0
+        self.batch_regions = 0
+        self.errors = 0
+
+    def record_request(self, seconds, regions):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.requests += 1
+            self.regions += regions
+
+    def record_batch(self, size, ok=True):
+        with self.lock:
+            self.batches += 1
+            self.batch_regions += size
+            if not ok:
+                self.errors += 1
+
+    def percentiles(self, points=(50, 90, 99)):
+        """ Latency percentiles in milliseconds, nearest-rank """
+        with self.lock:
+            values = sorted(self.latencies)
+        if not values:
+            return dict((p, None) for p in points)
+        return dict((p, 1000.0 * values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)])
+                    for p in points)
+
+    def snapshot(self):
+        percentiles = self.percentiles()
+        with self.lock:
+            return {'requests': self.requests,
+                    'regions': self.regions,
+                    'batches': self.batches,
+                    'batch_errors': self.errors,
+                    'mean_batch_size': float(self.batch_regions) / self.batches if self.batches else 0.0,
+                    'latency_ms': dict(('p%d' % p, v) for p, v in percentiles.items())}
+
+
+class CliRecognizer(object):
+    """ One tesseract process per batch, the regions being the pages of a multi-page tif """
+
+    def __init__(self, tesseract_cmd='tesseract'):
+        self.tesseract_cmd = tesseract_cmd
+
+    def recognize(self, images, lang, psm, tessdata_dir=None):
+        fd, tif_path = tempfile.mkstemp(suffix='.tif', prefix='ocr_batch_')
+        os.close(fd)
+        try:
+            images[0].save(tif_path, save_all=True, append_images=images[1:], compression='tiff_deflate')
+            cmd = [self.tesseract_cmd, tif_path, 'stdout', '-l', lang, '-psm', str(psm)]
+            if tessdata_dir:
+                cmd[1:1] = ['--tessdata-dir', tessdata_dir]
+            run = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        finally:
+            os.remove(tif_path)
+        if run.returncode != 0:
+            raise ServiceException("tesseract failed: %s" % run.stderr.decode('utf-8', 'replace').strip())
+        pages = run.stdout.decode('utf-8').split('\f')
+        if len(pages) < len(images):
+            raise ServiceException("tesseract returned %d pages for %d regions" % (len(pages), len(images)))
+        return [page.strip() for page in pages[:len(images)]]
+
+
+class TesserocrRecognizer(object):
+    """ Loaded tesseract APIs kept per worker thread, language, psm and model directory """
+
+    def __init__(self):
+        import tesserocr
+        self.tesserocr = tesserocr
+        self.local = threading.local()
+
+    def _api(self, lang, psm, tessdata_dir):
+        apis = getattr(self.local, 'apis', None)
+        if apis is None:
+            apis = self.local.apis = {}
+        key = (lang, psm, tessdata_dir)
+        api = apis.get(key)
+        if api is None:
+            # a new model version gets a new key, the previous api of the language is released
+            for old_key in [k for k in apis if k[:2] == (lang, psm)]:
+                apis.pop(old_key).End()
+            kwargs = {'lang': lang, 'psm': psm}
+            if tessdata_dir:
+                kwargs['path'] = tessdata_dir.rstrip(os.sep) + os.sep
+            api = apis[key] = self.tesserocr.PyTessBaseAPI(**kwargs)
+        return api
+
+    def recognize(self, images, lang, psm, tessdata_dir=None):
+        api = self._api(lang, psm, tessdata_dir)
+        texts = []
+        for image in images:
+            api.SetImage(image)
+            texts.append(api.GetUTF8Text().strip())
+        return texts
+
+
+def make_recognizer():
+    """ tesserocr if installed, else the tesseract command line """
+    try:
+        return TesserocrRecognizer()
+    except ImportError:
+        return CliRecognizer()
+
+
+class _Item(object):
+    __slots__ = ('image', 'lang', 'psm', 'future', 'sequence')
+
+    def __init__(self, image, lang, psm):
+        self.image = image
+        self.lang = lang
+        self.psm = psm
+        self.future = Future()
+        # arrival order over all languages, set when queued
+        self.sequence = None
+
+
+class MicroBatcher(object):
+    """ Coalesce concurrent recognition requests into batches """
+
+    def __init__(self, recognizer=None, batch_size=BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, workers=WORKERS,
+                 tessdata_path=None):
+        """
+        :param recognizer: 识别器, 默认make_recognizer()
+        :param batch_size: 一个批次最多的区域数
+        :param max_wait_ms: 收到第一个区域后最多等待多久再发送批次(毫秒)
+        :param workers: 识别线程数
+        :param tessdata_path: 语言包目录, 通过publish发布的语言包会自动使用最新版本
+        """
+        self.recognizer = recognizer or make_recognizer()
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.tessdata_path = tessdata_path
+        self.stats = LatencyStats()
+        # (lang, psm) -> deque of the regions waiting for a batch, guarded by the condition
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.sequence = itertools.count()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.workers = workers
+        # taken by the dispatcher before it fills a batch, released when the batch is recognized
+        self.free_workers = threading.Semaphore(workers)
+        # workers recognizing a batch, and regions of the batches waiting for a worker, updated under stats.lock
+        self.busy = 0
+        self.waiting = 0
+        # lang -> ModelWatcher, shared by the workers
+        self.watchers = {}
+        self.watchers_lock = threading.Lock()
+        self.running = True
+        self.dispatcher = threading.Thread(target=self._dispatch, name='ocr-dispatcher')
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    def submit(self, images, lang, psm):
+        """ Queue regions for recognition
+        :param images: list of PIL images
+        :return: list of futures of the texts
+        """
+        if not self.running:
+            raise ServiceException("the recognition service is stopped")
+        items = [_Item(image, lang, psm) for image in images]
+        with self.condition:
+            sequence = next(self.sequence)
+            for item in items:
+                item.sequence = sequence
+            self.pending.setdefault((lang, psm), deque()).extend(items)
+            self.condition.notify()
+        return [item.future for item in items]
+
+    def recognize(self, images, lang, psm, timeout=TIMEOUT):
+        """ Recognize regions, blocking until all texts are known """
+        start = time.time()
+        futures = self.submit(images, lang, psm)
+        try:
+            return [future.result(timeout=max(0, start + timeout - time.time())) for future in futures]
+        finally:
+            self.stats.record_request(time.time() - start, len(images))
+
+    def snapshot(self):
+        """ Statistics, with the worker occupation and the number of regions waiting for a batch """
+        snapshot = self.stats.snapshot()
+        with self.stats.lock:
+            snapshot['busy_workers'] = self.busy
+            waiting = self.waiting
+        snapshot['workers'] = self.workers
+        with self.condition:
+            queued = sum(len(items) for items in self.pending.values())
+        snapshot['queued_regions'] = queued + waiting
+        return snapshot
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.dispatcher.join()
+        self.executor.shutdown()
+
+    def _dispatch(self):
+        while True:
+            self.free_workers.acquire()
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.pending:
+                    self.free_workers.release()
+                    return
+                # the language of the oldest region goes first
+                key = min(self.pending, key=lambda k: self.pending[k][0].sequence)
+                items = self.pending[key]
+                deadline = time.time() + self.max_wait
+                while self.running and len(items) < self.batch_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch = [items.popleft() for _ in range(min(self.batch_size, len(items)))]
+                if not items:
+                    del self.pending[key]
+            with self.stats.lock:
+                self.waiting += len(batch)
+            self.executor.submit(self._run_batch, batch)
+
+    def _tessdata_dir(self, lang):
+        if not self.tessdata_path:
+            return None
+        from django_web.tesseract_trainer.publish import ModelWatcher
+
+        with self.watchers_lock:
+            watcher = self.watchers.get(lang)
+            if watcher is None:
+                watcher = self.watchers[lang] = ModelWatcher(self.tessdata_path, lang)
+            return watcher.tessdata_dir()
+
+    def _run_batch(self, batch):
+        first = batch[0]
+        with self.stats.lock:
+            self.busy += 1
+            self.waiting -= len(batch)
+        try:
+            texts = self.recognizer.recognize([item.image for item in batch], first.lang, first.psm,
+                                              self._tessdata_dir(first.lang))
+        except Exception as e:
+            self.stats.record_batch(len(batch), ok=False)
+            for item in batch:
+                item.future.set_exception(e)
+            return
+        finally:
+            with self.stats.lock:
+                self.busy -= 1
+            self.free_workers.release()
+        self.stats.record_batch(len(batch))
+        for item, text in zip(batch, texts):
+            item.future.set_result(text)
+
+
+def load_image(data, max_size=None, min_side=15, max_side=4096):
+    """ Decode an uploaded image to a grayscale PIL image, checking its size
+    :param data: bytes of the image file
+    :raise ServiceException: with the message to return to the client
+    """
+    from django_web.util.constants import IMAGE_EXCEED_SIZE_LIMIT, WRONG_IMG_SIZE
+
+    if max_size is not None and len(data) > max_size:
+        raise ServiceException(IMAGE_EXCEED_SIZE_LIMIT)
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except Exception:
+        raise ServiceException("无法识别的图片格式")
+    if max(image.size) > max_side or min(image.size) < min_side:
+        raise ServiceException(WRONG_IMG_SIZE)
+    return image.convert('L')
+
+
+def crop_regions(image, regions):
+    """ Cut text regions out of an image
+    :param regions: list of [x, y, w, h]
+    """
+    width, height = image.size
+    crops = []
+    for region in regions:
+        if len(region) != 4:
+            raise ServiceException("a region is [x, y, w, h]")
+        x, y, w, h = [int(v) for v in region]
+        if w <= 0 or h <= 0 or x < 0 or y < 0 or x + w > width or y + h > height:
+            raise ServiceException("region %s is outside of the image" % list(region))
+        crops.append(image.crop((x, y, x + w, y + h)))
+    return crops
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_service():
+    """ The recognition service of the process, configured from the django settings """
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                from django.conf import settings
+
+                recognizer = CliRecognizer() if getattr(settings, 'OCR_RECOGNIZER', 'auto') == 'cli' else None
+                _service = MicroBatcher(recognizer=recognizer,
+                                        batch_size=getattr(settings, 'OCR_BATCH_SIZE', BATCH_SIZE),
+                                        max_wait_ms=getattr(settings, 'OCR_MAX_WAIT_MS', MAX_WAIT_MS),
+                                        workers=getattr(settings, 'OCR_WORKERS', WORKERS),
+                                        tessdata_path=getattr(settings, 'OCR_TESSDATA_PATH', None))
+    return _service
@@ -3,22 +3,32 @@
 A small training framework for Tesseract 3.0.1, taking over the tedious manual process
 of training Tesseract 3described in the Tesseract Wiki:
 https://code.google.com/p/tesseract-ocr/wiki/TrainingTesseract3
+
+The LSTM models of tesseract 4 and later are fine-tuned by lstm.LSTMTrainer.
 """
 
 __version__ = '0.1'
 __author__ = 'Balthazar Rouberol, rouberol.b@gmail.com'
+import hashlib
+import json
 import time
 import shutil
 import os
-import subprocess
 import logging
-from django_web.model import *
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from django_web.model import ServiceException
 
 logger = logging.getLogger('django_logger')
 
 from os.path import join, exists
 
+from django_web.util.file_util import file_hash
 from .multipage_tif import MultiPageTif
+from .scheduler import get_scheduler
+from .traineddata import combine
+from .coverage import FontCoverage, coverage_report, format_coverage_report
 
 # list of files generated during the training procedure
 GENERATED_DURING_TRAINING = ['unicharset', 'pffmtable', 'inttemp', 'normproto', 'shapetable']
@@ -27,6 +37,14 @@ FONT_SIZE = 25  # Default font size, used during tif generation
 TESSDATA_PATH = '/usr/local/share/tessdata'  # Default path to the 'tessdata' directory
 WORD_LIST = None  # Default path to the "word_list" file, contaning frequent words
 VERBOSE = True  # verbosity enabled by default. Set to False to remove all text outputs
+WHITESPACE = re.compile(r'\s')
+
+# what to do when the training folder already exists
+ON_EXISTS_ASK = 'ask'  # prompt the user (default, interactive)
+ON_EXISTS_CLEAN = 'clean'  # remove the previous training and start over
+ON_EXISTS_ABORT = 'abort'  # raise a ServiceException
+ON_EXISTS_KEEP = 'keep'  # reuse the folder and the files already in it
+ON_EXISTS_CHOICES = (ON_EXISTS_ASK, ON_EXISTS_CLEAN, ON_EXISTS_ABORT, ON_EXISTS_KEEP)
 
 
 class TesseractTrainer:
@@ -45,7 +63,15 @@ class TesseractTrainer:
                  train_id=0,
                  tessdata_path=TESSDATA_PATH,
                  word_list=WORD_LIST,
-                 verbose=VERBOSE):
+                 verbose=VERBOSE,
+                 on_exists=ON_EXISTS_ASK,
+                 augmenter=None,
+                 skip_missing_glyphs=True,
+                 layout=None,
+                 stage_cache=None,
+                 workspace=None,
+                 glyph_export=None,
+                 scheduler=None):
         """
         训练tesseract字库
         :param ref_path: 存储中间文件的目录
@@ -56,33 +82,58 @@ class TesseractTrainer:
         :param training_text: 训练字符集
         :param ttf_file_list: trueTypeFont文件
         :param font_properties: (<italic>,<bold>,<fixed>,<serif>,<fraktur>) 0-with  1-without
-        :param font_size: 字体大小，单位px
+        :param font_size: 字体大小，单位px; 传入列表则在同一次训练中绘制所有字号
         :param train_id: 训练标识数
         :param tessdata_path: 放置最终训练数据的路径
-        :param word_list: 暂时用不上
+        :param word_list: 常用词表文件(每行一个词), 生成freq-dawg; 或者{dawg类型: 词表文件}, 如{"word-dawg": ...}
         :param verbose:
+        :param on_exists: 训练目录已存在时的处理方式 ask/clean/abort/keep, 非交互运行时不要用ask
+        :param augmenter: 可选的augment.Augmenter, 在保存tif之前给生成的图片加噪声/模糊/旋转等
+        :param skip_missing_glyphs: 每种字体只绘制其cmap中有字形的字, 避免训练到方块字
+        :param layout: 页面排版参数, 见multipage_tif.LAYOUT_KEYS (行间距, 列间距, 每页字数...)
+        :param stage_cache: 可选的stage_cache.StageCache, 参数相同的绘图和box.train结果直接复用
+        :param workspace: 可选的workspace.Workspace, 中间文件放在内存临时目录中, 训练结束只保留最终结果
+        :param glyph_export: True或glyph_export.GlyphExporter的参数, 把绘制的每个字导出到训练目录下的glyphs目录,
+            供其他模型训练使用
+        :param scheduler: 可选的scheduler.ResourceScheduler, 默认使用进程共用的调度器, 在内存和cpu预算内启动tesseract进程
         """
+        if on_exists not in ON_EXISTS_CHOICES:
+            raise ServiceException("on_exists must be one of %s" % ", ".join(ON_EXISTS_CHOICES))
         # 为训练任务单独创建一个文件夹
         folder_name = "%s_%s" % (lang_name, train_id)
         training_path = os.path.join(ref_path, folder_name)
         if not os.path.exists(training_path):
             os.mkdir(training_path)
-        else:
-            key = input("已经存在一个同名的训练%s! 是否删除？ Y/N" % training_path)
-            if key == "Y" or key == "y":
+        elif on_exists != ON_EXISTS_KEEP:
+            if on_exists == ON_EXISTS_ASK:
+                key = input("已经存在一个同名的训练%s! 是否删除？ Y/N" % training_path)
+                remove = key == "Y" or key == "y"
+            else:
+                remove = on_exists == ON_EXISTS_CLEAN
+            if remove:
                 self.clean(training_path)
                 time.sleep(1)
                 os.mkdir(training_path)
             else:
                 raise ServiceException("训练终止！")
         self.folder_name = folder_name
+        self.ref_path = ref_path
+        self.train_id = train_id
+        # Optional scratch workspace: the training runs in its scratch directory and the
+        # retained files are moved back to the training folder at the end
+        self.workspace = workspace
+        self.final_path = training_path
+        if workspace is not None:
+            training_path = workspace.open(training_path)
         self.training_path = training_path
         self.base_lang = base_lang
         self.base_psm = base_psm
-        # Training text: the text used for the multipage tif generation
-        # we replace all \n by " " as we'll split the text over " "s
-        # self.training_text = open(text).read().replace("\n", " ")
-        self.training_text = training_text.replace("\n", " ")
+        # Training text: the text used for the multipage tif generation.
+        # whitespace is never rendered, it is dropped here once instead of at every page generation
+        # (see django_web.util.corpus.CharIndex to derive the text from a large corpus)
+        if WHITESPACE.search(training_text):
+            training_text = "".join(training_text.split())
+        self.training_text = training_text
 
         # 初始化exp_number为0
         self.exp_number = 0
@@ -105,11 +156,15 @@ class TesseractTrainer:
             if not exists(ttf_file):
                 raise ServiceException("The %s file does not exist. Aborting." % ttf_file)
 
-        # The font size (in px) used during the multipage tif generation
+        # The font size (in px) used during the multipage tif generation, or a list of sizes
+        if isinstance(font_size, (list, tuple)):
+            if len(font_size) < 1:
+                raise ServiceException("need at least one font size")
+            font_size = list(font_size)
         self.font_size = font_size
 
         # Local path to the 'font_propperties' file
-        self.font_properties_file = font_properties
+        self.font_properties = font_properties
         self.font_properties_file = os.path.join(training_path, "font_properties")
         if (not isinstance(font_properties, tuple)) and (len(font_properties) != 5):
             raise ServiceException("font properties must be tuple with length of 5")
@@ -126,27 +181,118 @@ class TesseractTrainer:
         self.word_list = word_list
         # Set verbose to True to display the training commands output
         self.verbose = verbose
-
-    def _generate_boxfile(self, ttf):
+        # Optional augmentation of the generated pages
+        self.augmenter = augmenter
+        # Only render, for each font, the characters it has a glyph for
+        self.skip_missing_glyphs = skip_missing_glyphs
+        # Per font coverage of the training text, filled by report_coverage()
+        self.coverage = None
+        # Page layout overrides passed to MultiPageTif
+        self.layout = dict(layout or {})
+        # Optional cache of the render and box.train stages, shared between trainings
+        self.stage_cache = stage_cache
+        # Stage processes start only within the memory and cpu budget of the host
+        self.scheduler = scheduler or get_scheduler()
+        # Optional export of the rendered glyphs, written to the training folder on disk
+        self.glyph_exporter = None
+        if glyph_export:
+            from .glyph_export import GlyphExporter
+
+            options = glyph_export if isinstance(glyph_export, dict) else {}
+            self.glyph_exporter = GlyphExporter(join(self.final_path, 'glyphs'), **options)
+
+    def _font_text(self, ttf):
+        """ The part of the training text the font can render, None if it can render nothing """
+        text = self.training_text
+        if self.skip_missing_glyphs:
+            text, missing = FontCoverage.load(ttf).filter(text)
+            if missing:
+                print("%s: skipping %d characters without glyph" % (os.path.basename(ttf), len(missing)))
+            if not text:
+                print("%s has no glyph for the training text, font skipped" % ttf)
+                return None
+        return text
+
+    def _generate_boxfile(self, ttf, text=None):
         """ Generate a multipage tif, filled with the training text and generate a boxfile
-            from the coordinates of the characters inside it
+            from the coordinates of the characters inside it.
+            Return the font size of every page, or False if the font has no glyph for any of the training characters.
         """
+        if text is None:
+            text = self._font_text(ttf)
+            if text is None:
+                return False
         ttf_list = [ttf]
-        mp = MultiPageTif(self.training_path, self.training_text, self.font_name, ttf_list,
-                          self.font_size, self.exp_number, self.lang_name, self.verbose)
+        mp = MultiPageTif(self.training_path, text, self.font_name, ttf_list,
+                          self.font_size, self.exp_number, self.lang_name, self.verbose,
+                          augmenter=self.augmenter, layout=self.layout)
+        # single-page tifs are named after the exp, so that exps can be rendered concurrently
+        mp.indiv_page_prefix = '%s.page' % self._form_file_prefix(self.exp_number)
+        mp.glyph_exporter = self.glyph_exporter
         mp.generate_tif()  # generate a multi-page tif, filled with self.training_text
         mp.generate_boxfile()  # generate the boxfile, associated with the generated tif
+        return mp.page_sizes
+
+    def _train_font(self, ttf):
+        """ Render the pages of a font and run box.train on them, as exp self.exp_number.
+            Both stages are taken from the stage cache when an identical run already did them.
+            Return False if the font was skipped.
+        """
+        text = self._font_text(ttf)
+        if text is None:
+            return False
+        cache = self.stage_cache
+        if cache is None:
+            self._generate_boxfile(ttf, text)
+            self._train_on_boxfile()
+            return True
+        augment = self.augmenter.cache_params() if self.augmenter is not None else None
+        prefix = os.path.join(self.training_path, self._form_file_prefix(self.exp_number))
+        # the font size of every page: the glyphs of cached pages can be exported
+        rendered = {'page.tif': prefix + '.tif', 'page.box': prefix + '.box', 'page.sizes': prefix + '.sizes.json'}
+        render_key = cache.key('render', text=hashlib.sha256(text.encode('utf-8')).hexdigest(),
+                               font=file_hash(ttf), sizes=self.font_size, layout=self.layout, augment=augment,
+                               files=sorted(rendered))
+        with cache.lock(render_key):
+            if not cache.fetch(render_key, rendered):
+                page_sizes = self._generate_boxfile(ttf, text)
+                with open(rendered['page.sizes'], 'w', encoding='UTF-8') as fp:
+                    json.dump(page_sizes, fp)
+                cache.store(render_key, rendered)
+            else:
+                if self.verbose:
+                    print("%s: pages taken from the stage cache" % os.path.basename(ttf))
+                if self.glyph_exporter is not None:
+                    from .glyph_export import export_boxed_pages
+
+                    with open(rendered['page.sizes'], 'r', encoding='UTF-8') as fp:
+                        page_sizes = json.load(fp)
+                    export_boxed_pages(self.glyph_exporter, rendered['page.tif'], rendered['page.box'], ttf,
+                                       page_sizes)
+        train_key = cache.key('box.train', render=render_key, lang=self.base_lang, psm=self.base_psm)
+        trained = {'page.tr': prefix + '.tr'}
+        with cache.lock(train_key):
+            if not cache.fetch(train_key, trained):
+                self._train_on_boxfile()
+                if exists(trained['page.tr']):
+                    cache.store(train_key, trained)
+            elif self.verbose:
+                print("%s: box.train output taken from the stage cache" % os.path.basename(ttf))
+        return True
+
+    def report_coverage(self):
+        """ Compute and print the coverage of the training characters by each font """
+        self.coverage = coverage_report(self.training_text, self.ttf_file_list)
+        print(format_coverage_report(self.coverage))
+        return self.coverage
 
     def _train_on_boxfile(self):
         """ Run tesseract on training mode, using the generated boxfiles """
 
-        cmd = 'tesseract {prefix}.tif {prefix} -l {lang} -psm {psm} nobatch box.train'.format(
-            prefix=self._form_file_prefix(self.exp_number),
-            lang=self.base_lang,
-            psm=self.base_psm)
-        print("cmd: %s" % cmd)
-        run = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=self.training_path)
-        display_output(run, self.verbose)
+        prefix = self._form_file_prefix(self.exp_number)
+        cmd = ['tesseract', prefix + '.tif', prefix, '-l', self.base_lang, '-psm', str(self.base_psm),
+               'nobatch', 'box.train']
+        self._run_stage('box.train', cmd, size=len(self.training_text))
 
     def _form_file_prefix(self, exp_num):
         prefix = '%s.%s.exp%s' % (self.lang_name, self.font_name, exp_num)
@@ -170,38 +316,28 @@ class TesseractTrainer:
         cmd = ['unicharset_extractor']
         for idx in range(self.exp_number):
             cmd.append('%s.box' % (self._form_file_prefix(idx)))
-        print("cmd: %s" % " ".join(cmd))
-        run = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=self.training_path)
-        display_output(run, self.verbose)
+        self._run_stage('unicharset_extractor', cmd)
 
     def _shape_cluster(self):
         """ Shape Cluster character features from all the training pages, and create shapetable """
-        cmd = ['shapeclustering -F font_properties -U unicharset']
+        cmd = ['shapeclustering', '-F', 'font_properties', '-U', 'unicharset']
         for idx in range(self.exp_number):
             cmd.append('%s.tr' % (self._form_file_prefix(idx)))
-        cmd = " ".join(cmd)
-        print("cmd: %s" % cmd)
-        run = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=self.training_path)
-        display_output(run, self.verbose)
+        self._run_stage('shapeclustering', cmd, size=self._charset_size())
 
     def _mf_training(self):
         """ Cluster character features from all the training pages, and create characters prototype """
-        cmd = ['mftraining -F font_properties -U unicharset']
+        cmd = ['mftraining', '-F', 'font_properties', '-U', 'unicharset']
         for idx in range(self.exp_number):
             cmd.append('%s.tr' % (self._form_file_prefix(idx)))
-        cmd = " ".join(cmd)
-        print("cmd: %s" % cmd)
-        run = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=self.training_path)
-        display_output(run, self.verbose)
+        self._run_stage('mftraining', cmd, size=self._charset_size())
 
     def _cntraining(self):
         """ Generate the 'normproto' data file (the character normalization sensitivity prototypes) """
         cmd = ['cntraining']
         for idx in range(self.exp_number):
             cmd.append('%s.tr' % (self._form_file_prefix(idx)))
-        print("cmd: %s" % " ".join(cmd))
-        run = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=self.training_path)
-        display_output(run, self.verbose)
+        self._run_stage('cntraining', cmd, size=self._charset_size())
 
     def _rename_files(self):
         """ Add the self.dictionary_name prefix to each file generated during the tesseract training process """
@@ -215,73 +351,136 @@ class TesseractTrainer:
     def _dictionary_data(self):
         """ Generate dictionaries, coded as a Directed Acyclic Word Graph (DAWG),
             from the list of frequent words if those were submitted during the Trainer initialization.
+            word_list is a word list path, written as the freq-dawg, or a dict of dawg type -> word list path
+            (e.g. {"word-dawg": ..., "freq-dawg": ...}).
+            Needs the unicharset; run by _cluster next to mftraining/cntraining.
         """
-        if self.word_list:
-            cmd = 'wordlist2dawg %s %s.freq-dawg %s.unicharset' % (self.word_list, self.lang_name,
-                                                                   self.lang_name)
-            print("cmd: %s" % cmd)
-            run = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                   cwd=self.training_path)
-            display_output(run, self.verbose)
+        from .dawg import build_dawg
+
+        word_lists = self.word_list if isinstance(self.word_list, dict) else {'freq-dawg': self.word_list}
+        unicharset = os.path.join(self.training_path, 'unicharset')
+        for dawg_type, word_list in sorted(word_lists.items()):
+            dawg_path = os.path.join(self.training_path, '%s.%s' % (self.lang_name, dawg_type))
+            start = time.time()
+            stats = build_dawg(word_list, unicharset, dawg_path, tmp_dir=self.training_path)
+            print("%s: %d words (%d dropped: unknown characters), %d edges in %.1fs" % (
+                os.path.basename(dawg_path), stats['words'], stats['dropped'], stats['edges'], time.time() - start))
 
     def _combine_data(self):
-        cmd = 'combine_tessdata %s.' % (self.lang_name)
-        print("cmd: %s" % cmd)
-        run = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=self.training_path)
-        display_output(run, self.verbose)
+        """ Combine the {lang}.* files into {lang}.traineddata, like `combine_tessdata {lang}.` """
+        components = combine(os.path.join(self.training_path, '%s.' % self.lang_name))
+        print("%s.traineddata: %s" % (self.lang_name, ", ".join(components)))
+
+    def _charset_size(self):
+        """ Number of distinct training characters, the size the clustering stages grow with """
+        return len(set(self.training_text))
+
+    def _run_stage(self, stage, cmd, size=None):
+        """ Run a stage process in the training folder once the scheduler admits it
+        :return: subprocess.CompletedProcess
+        """
+        print("cmd: %s" % " ".join(cmd))
+        run = self.scheduler.run(stage, cmd, cwd=self.training_path, size=size)
+        if self.verbose:
+            print(str(run.stdout, 'utf-8', 'replace'))
+            if run.stderr:
+                print(str(run.stderr, 'utf-8', 'replace'))
+        if run.returncode != 0:
+            print("%s exited with code %d: %s" % (stage, run.returncode,
+                                                 str(run.stderr, 'utf-8', 'replace').strip()[-500:]))
+        return run
 
     def training(self):
         print("**** start training language = %s ****" % self.lang_name)
         """ Execute all training steps """
-        for ttf in self.ttf_file_list:
-            self._generate_boxfile(ttf)
-            self._train_on_boxfile()
-            self.exp_number += 1
+        if self.skip_missing_glyphs:
+            self.report_coverage()
+        with self._in_workspace():
+            for ttf in self.ttf_file_list:
+                if self._train_font(ttf):
+                    self.exp_number += 1
+                    self._spill()
+            if self.exp_number == 0:
+                raise ServiceException("no font can render the training text")
+            self._close_glyph_export()
+            self._cluster()
+        if self.verbose:
+            print('The %s.traineddata file has been generated !' % (self.lang_name))
+
+    @contextmanager
+    def _in_workspace(self):
+        """ Finalize the workspace after the training: keep the retained files in the training
+            folder and remove the rest, or remove everything if the training failed
+        """
+        if self.workspace is None:
+            yield
+            return
+        try:
+            yield
+        except BaseException:
+            self.workspace.discard()
+            raise
+        self.training_path = self.workspace.finalize(self.lang_name)
+
+    def _close_glyph_export(self):
+        if self.glyph_exporter is not None:
+            self.glyph_exporter.close()
+
+    def _spill(self):
+        """ Keep the scratch directory under its cap """
+        if self.workspace is not None:
+            self.workspace.spill()
+
+    def _cluster(self):
+        """ Run the language level steps on the .tr files of exps 0 to self.exp_number - 1 """
         self._compute_character_set()
+        # dictionaries are built in a thread while mftraining/cntraining run
+        dictionary = None
+        if self.word_list:
+            executor = ThreadPoolExecutor(max_workers=1)
+            dictionary = executor.submit(self._dictionary_data)
+            executor.shutdown(wait=False)
 
         # self._shape_cluster()
         self._mf_training()
         self._cntraining()
+        if dictionary is not None:
+            dictionary.result()
         self._rename_files()
-        # 跳过dictionary
-        # self._dictionary_data()
         self._combine_data()
-        if self.verbose:
-            print('The %s.traineddata file has been generated !' % (self.lang_name))
 
     def clean(self, path=None):
         """ Remove all files generated during tesseract training process """
         print('cleaning...')
         if path is None:
-            path = self.training_path
-        for root, dirs, files in os.walk(path):
-            for name in files:
-                os.remove(os.path.join(root, name))
-            for name in dirs:
-                os.removedirs(os.path.join(root, name))
-            os.removedirs(root)
+            path = self.final_path
+        shutil.rmtree(path)
 
     def add_trained_data(self):
-        """ Copy the newly trained data to the tessdata/ directory """
+        """ Publish the newly trained data to the tessdata/ directory, as a new version
+            of the language (see publish.ArtifactStore). Running recognizers switch to it
+            through their ModelWatcher, and rollback_trained_data() restores the previous one.
+        """
+        from .publish import ArtifactStore
         traineddata_name = '%s.traineddata' % self.lang_name
         traineddata_path = os.path.join(self.training_path, traineddata_name)
         if self.verbose:
             print('Copying %s to %s.' % (traineddata_path, self.tessdata_path))
-        print("**** move traineddata from %s to %s" % (traineddata_path, self.tessdata_path))
+        print("**** publish traineddata from %s to %s" % (traineddata_path, self.tessdata_path))
         try:
-            shutil.copyfile(traineddata_path,
-                            join(self.tessdata_path, traineddata_name))  # Copy traineddata fie to the tessdata dir
-        except IOError:
-            raise IOError("Permission denied. Super-user rights are required to copy %s to %s." % (
+            digest = ArtifactStore(self.tessdata_path).publish(self.lang_name, traineddata_path)
+        except PermissionError:
+            raise ServiceException("Permission denied. Super-user rights are required to copy %s to %s." % (
                 traineddata_name, self.tessdata_path))
-
-
-def display_output(run, verbose):
-    """ Display the output/error of a subprocess.Popen object
-        if 'verbose' is True.
-    """
-    out, err = run.communicate()
-    if verbose:
-        print(str(out,'utf-8'))
-        if err:
-            print(str(err,'utf-8'))
+        except OSError as e:
+            # missing traineddata, full disk...
+            raise ServiceException("could not publish %s to %s: %s" % (traineddata_name, self.tessdata_path, e))
+        print("**** %s version %s is live" % (self.lang_name, digest))
+        return digest
+
+    def rollback_trained_data(self, digest=None):
+        """ Make the previously published version of the language current again """
+        from .publish import ArtifactStore
+        digest = ArtifactStore(self.tessdata_path).rollback(self.lang_name, digest)
+        print("**** %s rolled back to version %s" % (self.lang_name, digest))
+        return digest
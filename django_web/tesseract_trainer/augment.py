@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+"""
+Augmentation of the rendered training pages.
+
+The pages rendered by MultiPageTif are perfectly clean, while the images we recognize
+(ID-card crops) are noisy, blurred and slightly rotated. The Augmenter degrades the pages
+the same way before they are saved: small rotation, blur, contrast loss, gaussian noise
+and binarization with a jittered threshold.
+
+Pages of the same size are stacked and every operation is applied to the whole stack
+with numpy, chunks of the stack being spread over worker processes. The random parameters
+of a page only depend on the seed and the page number, so the output does not depend on
+the number of workers. Box coordinates follow the rotation of their page.
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+from django_web.util.lazy_import import LazyModule
+
+np = LazyModule("numpy")
+
+WHITE = 255
+
+
+class Augmenter(object):
+    """ Apply random degradations to stacks of grayscale pages """
+
+    def __init__(self,
+                 max_angle=1.5,
+                 blur_prob=0.5,
+                 blur_sigma=(0.5, 1.2),
+                 contrast=(0.6, 1.0),
+                 noise_std=(0.0, 12.0),
+                 binarize_prob=0.2,
+                 binarize_threshold=(100, 180),
+                 seed=0,
+                 workers=1,
+                 chunk_size=8):
+        """
+        :param max_angle: 最大旋转角度(度)，每页在[-max_angle, max_angle]之间随机取值
+        :param blur_prob: 每页做高斯模糊的概率
+        :param blur_sigma: 高斯模糊sigma的取值范围
+        :param contrast: 对比度系数的取值范围，1为不变，越小墨迹越淡
+        :param noise_std: 高斯噪声标准差的取值范围
+        :param binarize_prob: 每页做二值化的概率
+        :param binarize_threshold: 二值化阈值的取值范围
+        :param seed: 随机种子，相同种子和页码得到相同结果
+        :param workers: 并行处理的进程数，1则在当前进程处理
+        :param chunk_size: 每个进程一次处理的页数
+        """
+        self.max_angle = max_angle
+        self.blur_prob = blur_prob
+        self.blur_sigma = tuple(blur_sigma)
+        self.contrast = tuple(contrast)
+        self.noise_std = tuple(noise_std)
+        self.binarize_prob = binarize_prob
+        self.binarize_threshold = tuple(binarize_threshold)
+        self.seed = seed
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._executor = None
+
+    def cache_params(self):
+        """ The parameters the augmented pages depend on, for the stage cache key """
+        return dict((key, value) for key, value in self.__dict__.items()
+                    if key not in ('workers', 'chunk_size', '_executor'))
+
+    def augment_pages(self, pages):
+        """ Augment a list of pages
+        :param pages: list of (page_nb, uint8 array HxW, boxes) where boxes is a Mx4 array
+                      of [x0, y0, x1, y1] in image coordinates
+        :return: list of (uint8 array HxW, boxes) in the order of pages
+        """
+        # stack pages of identical shape together, then cut the stacks in chunks
+        groups = {}
+        for idx, (page_nb, image, boxes) in enumerate(pages):
+            groups.setdefault(image.shape, []).append(idx)
+        chunks = []
+        for indices in groups.values():
+            for start in range(0, len(indices), self.chunk_size):
+                chunk = indices[start:start + self.chunk_size]
+                chunks.append((chunk,
+                               np.stack([pages[i][1] for i in chunk]),
+                               [pages[i][2] for i in chunk],
+                               [pages[i][0] for i in chunk]))
+        if self.workers > 1 and len(chunks) > 1:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            outputs = self._executor.map(self._augment_chunk, [c[1:] for c in chunks])
+        else:
+            outputs = map(self._augment_chunk, [c[1:] for c in chunks])
+        results = [None] * len(pages)
+        for (indices, _, _, _), (stack, boxes_list) in zip(chunks, outputs):
+            for pos, idx in enumerate(indices):
+                results[idx] = (stack[pos], boxes_list[pos])
+        return results
+
+    def close(self):
+        """ Stop the worker processes """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _page_params(self, page_numbers):
+        """ Draw the random parameters of each page, one generator per (seed, page number) """
+        params = []
+        for page_nb in page_numbers:
+            rng = np.random.default_rng([self.seed, page_nb])
+            params.append((rng,
+                           rng.uniform(-self.max_angle, self.max_angle),
+                           rng.uniform(*self.blur_sigma) if rng.random() < self.blur_prob else 0.0,
+                           rng.uniform(*self.contrast),
+                           rng.uniform(*self.noise_std),
+                           rng.uniform(*self.binarize_threshold) if rng.random() < self.binarize_prob else -1.0))
+        return params
+
+    def _augment_chunk(self, chunk):
+        """ Augment a stack of pages of the same shape
+        :param chunk: (uint8 array NxHxW, list of N box arrays, list of N page numbers)
+        :return: (uint8 array NxHxW, list of N box arrays)
+        """
+        stack, boxes_list, page_numbers = chunk
+        params = self._page_params(page_numbers)
+        rngs = [p[0] for p in params]
+        angle, sigma, contrast, noise_std, threshold = [np.array([p[i] for p in params], dtype=np.float32)
+                                                        for i in range(1, 6)]
+        pages = stack.astype(np.float32)
+        pages, boxes_list = rotate_stack(pages, np.deg2rad(angle), boxes_list)
+        pages = blur_stack(pages, sigma)
+        # contrast: fade the ink towards the white background
+        pages = WHITE - (WHITE - pages) * contrast[:, None, None]
+        noise = np.stack([rng.standard_normal(pages.shape[1:], dtype=np.float32) for rng in rngs])
+        pages += noise * noise_std[:, None, None]
+        # binarization jitter, only on the pages with a threshold
+        binarized = np.where(pages < threshold[:, None, None], 0, WHITE)
+        pages = np.where((threshold >= 0)[:, None, None], binarized, pages)
+        return np.clip(pages, 0, WHITE).astype(np.uint8), boxes_list
+
+    def __getstate__(self):
+        # the executor stays in the parent process
+        state = dict(self.__dict__)
+        state['_executor'] = None
+        return state
+
+
+def rotate_stack(pages, angles, boxes_list):
+    """ Rotate each page of the stack around its center, with bilinear interpolation
+    :param pages: float32 array NxHxW
+    :param angles: N angles in radian
+    :param boxes_list: N box arrays of [x0, y0, x1, y1], moved along with their page
+    :return: (rotated pages, rotated boxes): each box becomes the bounding box of its rotated corners
+    """
+    n, h, w = pages.shape
+    cx, cy = (w - 1) / 2.0, (h - 1) / 2.0
+    cos = np.cos(angles)[:, None, None]
+    sin = np.sin(angles)[:, None, None]
+    xs = np.arange(w, dtype=np.float32)[None, None, :] - cx
+    ys = np.arange(h, dtype=np.float32)[None, :, None] - cy
+    # inverse mapping: the source pixel of every destination pixel
+    src_x = cos * xs + sin * ys + cx
+    src_y = -sin * xs + cos * ys + cy
+    x0 = np.floor(src_x).astype(np.int32)
+    y0 = np.floor(src_y).astype(np.int32)
+    fx = src_x - x0
+    fy = src_y - y0
+    # pad with white so that pixels coming from outside of the page stay background
+    padded = np.pad(pages, ((0, 0), (1, 2), (1, 2)), constant_values=WHITE)
+    x0 = np.clip(x0 + 1, 0, w + 1)
+    y0 = np.clip(y0 + 1, 0, h + 1)
+    idx = np.arange(n)[:, None, None]
+    top = padded[idx, y0, x0] * (1 - fx) + padded[idx, y0, x0 + 1] * fx
+    bottom = padded[idx, y0 + 1, x0] * (1 - fx) + padded[idx, y0 + 1, x0 + 1] * fx
+    rotated = top * (1 - fy) + bottom * fy
+
+    rotated_boxes = []
+    for page, boxes in enumerate(boxes_list):
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        # the 4 corners of every box, forward rotation
+        corners_x = boxes[:, [0, 2, 2, 0]] - cx
+        corners_y = boxes[:, [1, 1, 3, 3]] - cy
+        c, s = np.cos(angles[page]), np.sin(angles[page])
+        rx = c * corners_x - s * corners_y + cx
+        ry = s * corners_x + c * corners_y + cy
+        moved = np.stack([rx.min(axis=1), ry.min(axis=1), rx.max(axis=1), ry.max(axis=1)], axis=1)
+        moved = np.clip(np.rint(moved), 0, [w - 1, h - 1, w - 1, h - 1]).astype(np.int32)
+        rotated_boxes.append(moved)
+    return rotated, rotated_boxes
+
+
+def blur_stack(pages, sigmas):
+    """ Separable gaussian blur with one sigma per page, 0 leaves the page unchanged
+    :param pages: float32 array NxHxW
+    :param sigmas: N sigma values
+    """
+    max_sigma = float(np.max(sigmas)) if len(sigmas) else 0.0
+    if max_sigma <= 0:
+        return pages
+    radius = int(np.ceil(3 * max_sigma))
+    taps = np.arange(-radius, radius + 1, dtype=np.float32)
+    # one normalized kernel per page, a dirac for the pages without blur
+    safe = np.where(sigmas > 0, sigmas, 1.0)[:, None]
+    kernels = np.exp(-0.5 * (taps[None, :] / safe) ** 2)
+    kernels = np.where((sigmas > 0)[:, None], kernels, (taps == 0)[None, :].astype(np.float32))
+    kernels /= kernels.sum(axis=1, keepdims=True)
+    for axis in (1, 2):
+        pad = [(0, 0), (0, 0), (0, 0)]
+        pad[axis] = (radius, radius)
+        padded = np.pad(pages, pad, mode='edge')
+        size = pages.shape[axis]
+        blurred = np.zeros_like(pages)
+        for k in range(len(taps)):
+            window = padded[:, k:k + size, :] if axis == 1 else padded[:, :, k:k + size]
+            blurred += window * kernels[:, k][:, None, None]
+        pages = blurred
+    return pages
@@ -0,0 +1,387 @@
+# coding:utf-8
+"""
+Batch training of many language packs from a manifest, under one shared worker budget.
+
+usage:
+    python -m django_web.tesseract_trainer.batch manifest.json [--workers N] [--dry-run] [--cold]
+
+The manifest is a json file. Every entry of "jobs" is expanded into one training job
+per (font set, font size) combination, "defaults" applies to every job and relative
+paths are resolved against the directory of the manifest:
+
+    {
+        "ref_path": "/web/train_data",
+        "tessdata_path": "/usr/local/share/tessdata",
+        "workers": 4,
+        "defaults": {"base_lang": "chi_sim", "base_psm": 6, "font_name": "myfont",
+                     "font_properties": [0, 0, 0, 0, 0], "publish": true},
+        "jobs": [
+            {"lang_name": "han", "training_text": "resource/train_text/han",
+             "font_sets": {"hei": ["resource/ttf/simhei.ttf"], "song": ["resource/ttf/simsun.ttc"]},
+             "font_sizes": [40, 60]}
+        ]
+    }
+
+A job with a single font set and a single size keeps its lang_name, otherwise the
+lang_name of each expanded job is "{lang_name}_{font_set}_{font_size}".
+With "multi_size": true, all sizes of a font set are rendered in the same job instead,
+named "{lang_name}_{font_set}" (or lang_name for a single font set).
+The run never prompts: an existing training folder is cleaned unless "on_exists" says otherwise.
+With "mode": "lstm" the job fine-tunes the LSTM model of base_lang instead (options of
+lstm.LSTMTrainer in "lstm"); "on_exists": "keep" then resumes an interrupted training.
+Jobs are forked from a process which imported the libraries and loaded the fonts of all jobs
+once (worker_pool.WarmPool); --cold starts plain worker processes instead.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django_web.model import ServiceException
+from django_web.util.corpus import CharIndex
+from django_web.util.file_util import remember_hash
+from .scheduler import MEMORY_BUDGET_ENV, CPU_BUDGET_ENV, MAX_THREADS_ENV, PIN_CPUS_ENV
+from .worker_pool import WarmPool, fork_supported
+
+# keys every manifest job must define
+JOB_REQUIRED = ('lang_name', 'training_text', 'font_sets', 'font_sizes')
+# keys of a manifest job, with their default value
+JOB_DEFAULTS = {
+    'lang_name': None,
+    'training_text': None,
+    'font_sets': None,
+    'font_sizes': None,
+    'base_lang': 'chi_sim',
+    'base_psm': 6,
+    'font_name': 'myfont',
+    'font_properties': [0, 0, 0, 0, 0],
+    'train_id': 0,
+    'word_list': None,
+    'on_exists': 'clean',
+    'publish': False,
+    'verbose': False,
+    # options of augment.Augmenter, or true for the default options
+    'augment': None,
+    # derivation of the training text from the corpus, see corpus.CharIndex.training_text
+    # (max_repeat None keeps every occurrence: the training text is as long as the corpus)
+    'max_repeat': 1,
+    'min_count': 1,
+    'shuffle_seed': None,
+    # train all font_sizes of a font set in one job
+    'multi_size': False,
+    # page layout overrides, see multipage_tif.LAYOUT_KEYS
+    'layout': None,
+    # directory of a stage_cache.StageCache shared by the jobs
+    'stage_cache': None,
+    # 'legacy' (3.x classifier) or 'lstm' (fine-tune the LSTM model of base_lang, see lstm.LSTMTrainer)
+    'mode': 'legacy',
+    # options of lstm.LSTMTrainer: max_iterations, target_error_rate, lines_per_shard...
+    'lstm': None,
+    # options of workspace.Workspace (scratch_root, scratch_cap, retain), or true for the default options
+    'scratch': None,
+    # options of glyph_export.GlyphExporter (glyph_size, shard_size), or true for the default options:
+    # the rendered glyphs are exported to the glyphs folder of the training
+    'glyph_export': None,
+}
+MODES = ('legacy', 'lstm')
+
+
+class TrainingJob(object):
+    """ One language pack to train: a language, a font set and a font size """
+
+    def __init__(self, name, ref_path, tessdata_path, lang_name, training_text, font_set, ttf_file_list,
+                 font_size, base_lang, base_psm, font_name, font_properties, train_id, word_list,
+                 on_exists, publish, verbose, augment=None, max_repeat=1, min_count=1, shuffle_seed=None,
+                 layout=None, stage_cache=None, mode='legacy', lstm=None, scratch=None, glyph_export=None,
+                 file_hashes=None):
+        self.name = name
+        self.ref_path = ref_path
+        self.tessdata_path = tessdata_path
+        self.lang_name = lang_name
+        self.training_text = training_text
+        self.font_set = font_set
+        self.ttf_file_list = ttf_file_list
+        self.font_size = font_size
+        self.base_lang = base_lang
+        self.base_psm = base_psm
+        self.font_name = font_name
+        self.font_properties = tuple(font_properties)
+        self.train_id = train_id
+        self.word_list = word_list
+        self.on_exists = on_exists
+        self.publish = publish
+        self.verbose = verbose
+        self.augment = augment
+        self.max_repeat = max_repeat
+        self.min_count = min_count
+        self.shuffle_seed = shuffle_seed
+        self.layout = layout
+        self.stage_cache = stage_cache
+        self.mode = mode
+        self.lstm = lstm
+        self.scratch = scratch
+        self.glyph_export = glyph_export
+        # path -> sha256 of input files whose hash is already known (input_store), not read again
+        # for the font pool and stage cache keys
+        self.file_hashes = file_hashes
+
+    def make_trainer(self):
+        """ The TesseractTrainer of this job """
+        # imported here: the parent process only parses the manifest
+        from django_web.tesseract_trainer import TesseractTrainer
+        from django_web.tesseract_trainer.augment import Augmenter
+        from django_web.tesseract_trainer.stage_cache import StageCache
+        from django_web.tesseract_trainer.lstm import LSTMTrainer
+        from django_web.tesseract_trainer.workspace import Workspace
+
+        for path, digest in (self.file_hashes or {}).items():
+            remember_hash(path, digest)
+        corpus = CharIndex.from_file(self.training_text)
+        training_text = corpus.training_text(max_repeat=self.max_repeat, min_count=self.min_count,
+                                             shuffle_seed=self.shuffle_seed)
+        augmenter = None
+        if self.augment:
+            augmenter = Augmenter(**self.augment) if isinstance(self.augment, dict) else Augmenter()
+        workspace = None
+        if self.scratch:
+            workspace = Workspace(**self.scratch) if isinstance(self.scratch, dict) else Workspace()
+        trainer_class, options = TesseractTrainer, {}
+        if self.mode == 'lstm':
+            trainer_class, options = LSTMTrainer, dict(self.lstm or {})
+        return trainer_class(self.ref_path,
+                             self.base_lang,
+                             self.base_psm,
+                             self.lang_name,
+                             self.font_name,
+                             training_text,
+                             self.ttf_file_list,
+                             self.font_properties,
+                             self.font_size,
+                             self.train_id,
+                             self.tessdata_path,
+                             word_list=self.word_list,
+                             verbose=self.verbose,
+                             on_exists=self.on_exists,
+                             augmenter=augmenter,
+                             layout=self.layout,
+                             stage_cache=StageCache(self.stage_cache) if self.stage_cache else None,
+                             workspace=workspace,
+                             glyph_export=self.glyph_export,
+                             **options)
+
+    def run(self):
+        """ Train the language pack, and publish it to tessdata if asked to
+        :return: path of the generated traineddata
+        """
+        trainer = self.make_trainer()
+        trainer.training()
+        if self.publish:
+            trainer.add_trained_data()
+        return os.path.join(trainer.training_path, '%s.traineddata' % self.lang_name)
+
+
+def run_job(job):
+    """ Worker entry point: run a job and never raise, so that one failure does not stop the batch
+    :return: dict with name, status, duration, output and error
+    """
+    start = time.time()
+    result = {'name': job.name, 'lang_name': job.lang_name, 'font_set': job.font_set,
+              'font_size': job.font_size, 'output': None, 'error': None}
+    try:
+        output = job.run()
+        # jobs may return a dict of extra result fields instead of the output path
+        if isinstance(output, dict):
+            result.update(output)
+        else:
+            result['output'] = output
+        result['status'] = 'ok'
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = "%s: %s" % (type(e).__name__, e)
+        if job.verbose:
+            traceback.print_exc()
+    result['duration'] = time.time() - start
+    return result
+
+
+def load_manifest(manifest_path):
+    """ Read a manifest file and expand it into training jobs
+    :param manifest_path: path of the json manifest
+    :return: (list of TrainingJob, worker budget found in the manifest or None)
+    """
+    with open(manifest_path, 'r', encoding='UTF-8') as fp:
+        manifest = json.load(fp)
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+
+    def resolve(path):
+        if isinstance(path, dict):
+            return dict((key, resolve(value)) for key, value in path.items())
+        return path if path is None else os.path.join(base_dir, os.path.expanduser(path))
+
+    ref_path = resolve(manifest.get('ref_path'))
+    tessdata_path = resolve(manifest.get('tessdata_path'))
+    if ref_path is None or tessdata_path is None:
+        raise ServiceException("the manifest needs a ref_path and a tessdata_path")
+    defaults = dict(JOB_DEFAULTS)
+    defaults.update(manifest.get('defaults', {}))
+
+    jobs = []
+    for entry in manifest.get('jobs', []):
+        spec = dict(defaults)
+        spec.update(entry)
+        unknown = set(spec) - set(JOB_DEFAULTS)
+        if unknown:
+            raise ServiceException("unknown job keys: %s" % ", ".join(sorted(unknown)))
+        missing = [key for key in JOB_REQUIRED if spec[key] is None]
+        if missing:
+            raise ServiceException("job %s misses %s" % (spec.get('lang_name'), ", ".join(missing)))
+        if spec['mode'] not in MODES:
+            raise ServiceException("mode must be one of %s" % ", ".join(MODES))
+        if spec['on_exists'] == 'ask':
+            raise ServiceException("batch training can not prompt, on_exists can not be 'ask'")
+        font_sets = spec['font_sets']
+        if isinstance(font_sets, list):
+            font_sets = dict(("set%d" % idx, fonts) for idx, fonts in enumerate(font_sets))
+        font_sizes = spec['font_sizes']
+        if not isinstance(font_sizes, list):
+            font_sizes = [font_sizes]
+        if spec['multi_size']:
+            font_sizes = [font_sizes]
+        single = len(font_sets) == 1 and len(font_sizes) == 1
+        for set_name, fonts in sorted(font_sets.items()):
+            for font_size in font_sizes:
+                if single:
+                    lang_name = spec['lang_name']
+                elif spec['multi_size']:
+                    lang_name = "%s_%s" % (spec['lang_name'], set_name)
+                else:
+                    lang_name = "%s_%s_%s" % (spec['lang_name'], set_name, font_size)
+                jobs.append(TrainingJob(name=lang_name,
+                                        ref_path=ref_path,
+                                        tessdata_path=tessdata_path,
+                                        lang_name=lang_name,
+                                        training_text=resolve(spec['training_text']),
+                                        font_set=set_name,
+                                        ttf_file_list=[resolve(f) for f in fonts],
+                                        font_size=font_size,
+                                        base_lang=spec['base_lang'],
+                                        base_psm=spec['base_psm'],
+                                        font_name=spec['font_name'],
+                                        font_properties=spec['font_properties'],
+                                        train_id=spec['train_id'],
+                                        word_list=resolve(spec['word_list']),
+                                        on_exists=spec['on_exists'],
+                                        publish=spec['publish'],
+                                        verbose=spec['verbose'],
+                                        augment=spec['augment'],
+                                        max_repeat=spec['max_repeat'],
+                                        min_count=spec['min_count'],
+                                        shuffle_seed=spec['shuffle_seed'],
+                                        layout=spec['layout'],
+                                        stage_cache=resolve(spec['stage_cache']),
+                                        mode=spec['mode'],
+                                        lstm=spec['lstm'],
+                                        scratch=spec['scratch'],
+                                        glyph_export=spec['glyph_export']))
+    names = [job.name for job in jobs]
+    duplicated = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicated:
+        raise ServiceException("several jobs would write the same language: %s" % ", ".join(duplicated))
+    return jobs, manifest.get('workers')
+
+
+def run_batch(jobs, workers=None, warm=True):
+    """ Run all jobs, at most 'workers' at the same time
+    :param jobs: list of TrainingJob
+    :param workers: worker process budget shared by all jobs, default: number of cpus
+    :param warm: fork the jobs from a process with the libraries and the fonts of the jobs already
+        loaded (see worker_pool.WarmPool), instead of starting cold worker processes
+    :return: list of job results, in the order of jobs
+    """
+    if not jobs:
+        return []
+    workers = max(1, min(workers or os.cpu_count() or 1, len(jobs)))
+    results = {}
+    warm = warm and fork_supported()
+    if warm:
+        fonts = sorted(set(ttf for job in jobs for ttf in job.ttf_file_list))
+        sizes = sorted(set(size for job in jobs
+                           for size in (job.font_size if isinstance(job.font_size, list) else [job.font_size])))
+        executor = WarmPool(workers, fonts=fonts, font_sizes=sizes)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    with executor:
+        futures = dict((executor.submit(run_job, job), job) for job in jobs)
+        for future in as_completed(futures):
+            result = future.result()
+            results[result['name']] = result
+            print("[%d/%d] %s %s in %.1fs" % (len(results), len(jobs), result['name'], result['status'],
+                                             result['duration']))
+    if warm:
+        dispatch = executor.dispatch_seconds
+        print("**** warm pool: %d jobs dispatched in %.1f ms on average" % (
+            len(dispatch), 1000.0 * sum(dispatch) / max(1, len(dispatch))))
+    return [results[job.name] for job in jobs]
+
+
+def format_summary(results):
+    """ Render the job results as a text table """
+    header = ('job', 'fonts', 'size', 'status', 'time(s)', 'output / error')
+    rows = [(r['name'], r['font_set'], str(r['font_size']), r['status'], "%.1f" % r['duration'],
+             r['output'] if r['status'] == 'ok' else r['error']) for r in results]
+    widths = [max(len(str(row[i])) for row in rows + [header]) for i in range(len(header) - 1)]
+    lines = []
+    for row in [header] + rows:
+        cells = [str(cell).ljust(width) for cell, width in zip(row, widths)]
+        lines.append("  ".join(cells + [str(row[-1])]))
+    lines.insert(1, "-" * len(lines[0]))
+    total = sum(r['duration'] for r in results)
+    failed = len([r for r in results if r['status'] != 'ok'])
+    lines.append("%d jobs, %d failed, %.1fs of training" % (len(results), failed, total))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Train tesseract language packs listed in a manifest.')
+    parser.add_argument('manifest', help="path of the json manifest")
+    parser.add_argument('--workers', '-w', type=int, default=None,
+                        help="number of jobs running at the same time (default: manifest, then cpu count)")
+    parser.add_argument('--dry-run', action='store_true', help="only list the expanded jobs")
+    parser.add_argument('--memory-budget', type=int, default=None,
+                        help="MB the tesseract processes of all jobs may use (default: 80%% of the memory)")
+    parser.add_argument('--cpu-budget', type=int, default=None,
+                        help="threads of the tesseract processes running at the same time (default: cpu count)")
+    parser.add_argument('--max-threads', type=int, default=None,
+                        help="threads of an lstmtraining process (default: half of the cpu budget)")
+    parser.add_argument('--pin-cpus', action='store_true', help="bind every tesseract process to its own cpus")
+    parser.add_argument('--cold', action='store_true',
+                        help="start plain worker processes instead of forking them from a preloaded one")
+    args = parser.parse_args(argv)
+    # read by scheduler.get_scheduler in the worker processes
+    if args.memory_budget:
+        os.environ[MEMORY_BUDGET_ENV] = str(args.memory_budget)
+    if args.cpu_budget:
+        os.environ[CPU_BUDGET_ENV] = str(args.cpu_budget)
+    if args.max_threads:
+        os.environ[MAX_THREADS_ENV] = str(args.max_threads)
+    if args.pin_cpus:
+        os.environ[PIN_CPUS_ENV] = '1'
+
+    jobs, manifest_workers = load_manifest(args.manifest)
+    if args.dry_run:
+        for job in jobs:
+            print("%s: %s, size %s, fonts %s" % (job.name, job.training_text, job.font_size,
+                                                 ", ".join(job.ttf_file_list)))
+        return 0
+    start = time.time()
+    results = run_batch(jobs, args.workers or manifest_workers, warm=not args.cold)
+    print(format_summary(results))
+    print("wall time %.1fs" % (time.time() - start))
+    return 0 if all(r['status'] == 'ok' for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+"""
+Glyph coverage of the training fonts.
+
+Fonts do not all cover the same characters (SIMYOU has far fewer glyphs than ARIALUNI),
+and rendering a character missing from a font draws a "tofu" box that tesseract then
+learns as that character. The coverage of a font is read once from its cmap table,
+for every face of a .ttc collection, and cached on disk under the sha256 of the font
+file, so that each font only renders the characters it has a glyph for.
+"""
+import bisect
+import json
+import os
+import struct
+
+from django_web.model import ServiceException
+from django_web.util.file_util import file_hash
+
+# Default directory of the cached coverage indexes
+COVERAGE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'tesser_train', 'coverage')
+
+# (platform id, encoding id) of the unicode cmap subtables
+UNICODE_ENCODINGS = {(0, 0), (0, 1), (0, 2), (0, 3), (0, 4), (0, 6), (3, 1), (3, 10)}
+
+# in-process cache: font sha256 -> FontCoverage
+_loaded = dict()
+
+
+class FontCoverage(object):
+    """ Codepoints having a glyph, for every face of a font file """
+
+    def __init__(self, faces):
+        # one sorted list of [first, last] codepoint ranges per face
+        self.faces = faces
+        self._starts = [[r[0] for r in ranges] for ranges in faces]
+
+    @classmethod
+    def load(cls, ttf_file, cache_dir=COVERAGE_CACHE_DIR):
+        """ Coverage of a font file, read from the cache when the font was already indexed
+        :param ttf_file: path of a .ttf/.otf/.ttc file
+        :param cache_dir: directory of the cached indexes, None to disable the disk cache
+        """
+        digest = file_hash(ttf_file)
+        coverage = _loaded.get(digest)
+        if coverage is not None:
+            return coverage
+        cache_file = os.path.join(cache_dir, digest + '.json') if cache_dir else None
+        if cache_file and os.path.exists(cache_file):
+            with open(cache_file, 'r') as fp:
+                coverage = cls(json.load(fp)['faces'])
+        else:
+            with open(ttf_file, 'rb') as fp:
+                coverage = cls(read_cmap_ranges(fp.read()))
+            if cache_file:
+                if not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+                with open(tmp_file, 'w') as fp:
+                    json.dump({'font': os.path.basename(ttf_file), 'faces': coverage.faces}, fp)
+                os.replace(tmp_file, cache_file)
+        _loaded[digest] = coverage
+        return coverage
+
+    def covers(self, char, face=0):
+        """ True if the face has a glyph for char """
+        code = ord(char)
+        ranges = self.faces[face]
+        pos = bisect.bisect_right(self._starts[face], code) - 1
+        return pos >= 0 and ranges[pos][1] >= code
+
+    def missing(self, text, face=0):
+        """ Set of the characters of text without glyph in the face """
+        return set(char for char in set(text) if not self.covers(char, face))
+
+    def filter(self, text, face=0):
+        """ Remove the characters without glyph from text
+        :return: (filtered text, set of the removed characters)
+        """
+        missing = self.missing(text, face)
+        if not missing:
+            return text, missing
+        return text.translate(dict((ord(char), None) for char in missing)), missing
+
+    def glyph_count(self, face=0):
+        return sum(last - first + 1 for first, last in self.faces[face])
+
+
+def read_cmap_ranges(data):
+    """ Parse the unicode cmap subtables of every face of a font file
+    :param data: content of a .ttf/.otf/.ttc file
+    :return: list (one per face) of sorted [first, last] codepoint ranges mapped to a real glyph
+    """
+    if data[:4] == b'ttcf':
+        num_fonts, = struct.unpack_from('>I', data, 8)
+        face_offsets = struct.unpack_from('>%dI' % num_fonts, data, 12)
+    else:
+        face_offsets = (0,)
+    return [_face_ranges(data, offset) for offset in face_offsets]
+
+
+def _face_ranges(data, face_offset):
+    num_tables, = struct.unpack_from('>H', data, face_offset + 4)
+    cmap_offset = None
+    for idx in range(num_tables):
+        tag, _, offset, _ = struct.unpack_from('>4sIII', data, face_offset + 12 + 16 * idx)
+        if tag == b'cmap':
+            cmap_offset = offset
+            break
+    if cmap_offset is None:
+        raise ServiceException("the font has no cmap table")
+    _, num_subtables = struct.unpack_from('>HH', data, cmap_offset)
+    codepoints = set()
+    for idx in range(num_subtables):
+        platform_id, encoding_id, offset = struct.unpack_from('>HHI', data, cmap_offset + 4 + 8 * idx)
+        if (platform_id, encoding_id) not in UNICODE_ENCODINGS:
+            continue
+        table = cmap_offset + offset
+        table_format, = struct.unpack_from('>H', data, table)
+        if table_format == 4:
+            codepoints.update(_format4_codepoints(data, table))
+        elif table_format == 12:
+            codepoints.update(_format12_codepoints(data, table))
+    return _to_ranges(codepoints)
+
+
+def _format4_codepoints(data, table):
+    """ Segment mapping to delta values (BMP only) """
+    seg_count = struct.unpack_from('>H', data, table + 6)[0] // 2
+    end_codes = struct.unpack_from('>%dH' % seg_count, data, table + 14)
+    start_codes = struct.unpack_from('>%dH' % seg_count, data, table + 16 + 2 * seg_count)
+    id_deltas = struct.unpack_from('>%dh' % seg_count, data, table + 16 + 4 * seg_count)
+    range_offsets_pos = table + 16 + 6 * seg_count
+    id_range_offsets = struct.unpack_from('>%dH' % seg_count, data, range_offsets_pos)
+    for seg in range(seg_count):
+        start, end = start_codes[seg], end_codes[seg]
+        if start == 0xFFFF:
+            continue
+        delta, range_offset = id_deltas[seg], id_range_offsets[seg]
+        for code in range(start, end + 1):
+            if range_offset == 0:
+                glyph = (code + delta) & 0xFFFF
+            else:
+                glyph_pos = range_offsets_pos + 2 * seg + range_offset + 2 * (code - start)
+                if glyph_pos + 2 > len(data):
+                    continue
+                glyph, = struct.unpack_from('>H', data, glyph_pos)
+                if glyph:
+                    glyph = (glyph + delta) & 0xFFFF
+            if glyph:
+                yield code
+
+
+def _format12_codepoints(data, table):
+    """ Segmented coverage (full unicode range) """
+    num_groups, = struct.unpack_from('>I', data, table + 12)
+    for idx in range(num_groups):
+        start, end, start_glyph = struct.unpack_from('>III', data, table + 16 + 12 * idx)
+        # only the first code of a group starting at glyph 0 maps to .notdef
+        for code in range(start + (1 if start_glyph == 0 else 0), end + 1):
+            yield code
+
+
+def _to_ranges(codepoints):
+    ranges = []
+    for code in sorted(codepoints):
+        if ranges and ranges[-1][1] == code - 1:
+            ranges[-1][1] = code
+        else:
+            ranges.append([code, code])
+    return ranges
+
+
+def coverage_report(text, ttf_file_list, cache_dir=COVERAGE_CACHE_DIR):
+    """ Per font coverage of the characters of text
+    :return: list of dict(font, faces, glyphs, covered, total, missing) computed on the first face,
+             the one used for rendering
+    """
+    chars = set(text)
+    report = []
+    for ttf_file in ttf_file_list:
+        coverage = FontCoverage.load(ttf_file, cache_dir)
+        missing = coverage.missing(chars)
+        report.append({'font': ttf_file,
+                       'faces': len(coverage.faces),
+                       'glyphs': coverage.glyph_count(),
+                       'covered': len(chars) - len(missing),
+                       'total': len(chars),
+                       'missing': "".join(sorted(missing))})
+    return report
+
+
+def format_coverage_report(report, max_missing=20):
+    lines = ["%-40s %6s %8s %14s  %s" % ("font", "faces", "glyphs", "covered", "missing")]
+    for row in report:
+        missing = row['missing']
+        if len(missing) > max_missing:
+            missing = missing[:max_missing] + "...(%d)" % len(row['missing'])
+        ratio = 100.0 * row['covered'] / row['total'] if row['total'] else 100.0
+        lines.append("%-40s %6d %8d %6d/%-6d%.0f%%  %s" % (os.path.basename(row['font']), row['faces'], row['glyphs'],
+                                                        row['covered'], row['total'], ratio, missing))
+    return "\n".join(lines)
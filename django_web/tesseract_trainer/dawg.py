@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+"""
+Minimal DAWG builder writing tesseract's squished dawg files (word-dawg, freq-dawg...),
+as a replacement of `wordlist2dawg` for large word lists.
+
+usage:
+    python -m django_web.tesseract_trainer.dawg word_list output.dawg unicharset [--chunk-size N]
+
+The word list is read as a stream: words are encoded with the unicharset (words with a
+character the unicharset does not know are dropped), sorted by runs of chunk_size words
+written to temporary files, and the sorted runs are merged. The merged stream is
+deduplicated and fed to the incremental construction of a minimal DAWG for sorted input
+(Daciuk et al. 2000): memory is bounded by the size of the resulting DAWG plus one run,
+whatever the size of the word list.
+
+File layout (little endian), as written by SquishedDawg::write_squished_dawg:
+    int16 magic (42), int32 unicharset size, int32 number of edges, then one uint64 per edge:
+    next node << (flag_start_bit + 3) | flags << flag_start_bit | unichar id
+with flag_start_bit = ceil(log2(unicharset size + 1)) and flags MARKER (last edge of its
+node), DIRECTION (backward edge, never written) and WERD_END. A node is the index of its
+first edge, node 0 is the root and a next node of 0 means that the edge has no children.
+"""
+import argparse
+import heapq
+import math
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+
+from django_web.model import ServiceException
+
+DAWG_MAGIC = 42
+MARKER_FLAG = 1
+DIRECTION_FLAG = 2
+WERD_END_FLAG = 4
+NUM_FLAG_BITS = 3
+CHUNK_SIZE = 1000000  # Default number of words sorted in memory at once
+
+
+def read_unicharset(unicharset_path):
+    """ Read a unicharset file
+    :return: (dict unichar -> id, unicharset size)
+    """
+    with open(unicharset_path, 'r', encoding='UTF-8') as fp:
+        size = int(fp.readline().split()[0])
+        unichars = {}
+        for unichar_id in range(size):
+            fields = fp.readline().split(' ')
+            unichar = fields[0].rstrip('\n')
+            # the space is written as NULL
+            unichars[' ' if unichar == 'NULL' else unichar] = unichar_id
+    return unichars, size
+
+
+def encode_word(word, unichars, max_len):
+    """ Unichar ids of a word, longest unichar first; None if a character is unknown """
+    ids = []
+    pos = 0
+    while pos < len(word):
+        for length in range(min(max_len, len(word) - pos), 0, -1):
+            unichar_id = unichars.get(word[pos:pos + length])
+            if unichar_id is not None:
+                ids.append(unichar_id)
+                pos += length
+                break
+        else:
+            return None
+    return tuple(ids)
+
+
+class WordStream(object):
+    """ Sorted and deduplicated unichar id sequences of a word list, sorted by external runs """
+
+    def __init__(self, word_list_path, unichars, chunk_size=CHUNK_SIZE, tmp_dir=None):
+        self.word_list_path = word_list_path
+        self.unichars = unichars
+        self.max_len = max(len(unichar) for unichar in unichars) if unichars else 1
+        self.chunk_size = chunk_size
+        self.tmp_dir = tmp_dir
+        self.read = 0
+        self.dropped = 0
+        self.words = 0
+
+    def __iter__(self):
+        run_dir = tempfile.mkdtemp(prefix='dawg_runs_', dir=self.tmp_dir)
+        try:
+            runs = self._write_runs(run_dir)
+            previous = None
+            for ids in heapq.merge(*[_read_run(path) for path in runs]):
+                if ids != previous:
+                    self.words += 1
+                    yield ids
+                    previous = ids
+        finally:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+    def _write_runs(self, run_dir):
+        runs = []
+        chunk = set()
+        with open(self.word_list_path, 'r', encoding='UTF-8', errors='replace') as fp:
+            for line in fp:
+                word = line.strip()
+                if not word:
+                    continue
+                self.read += 1
+                ids = encode_word(word, self.unichars, self.max_len)
+                if not ids:
+                    self.dropped += 1
+                    continue
+                chunk.add(ids)
+                if len(chunk) >= self.chunk_size:
+                    runs.append(_write_run(run_dir, len(runs), chunk))
+                    chunk = set()
+        if chunk:
+            runs.append(_write_run(run_dir, len(runs), chunk))
+        return runs
+
+
+def _write_run(run_dir, index, chunk):
+    path = os.path.join(run_dir, 'run%05d' % index)
+    with open(path, 'w') as fp:
+        fp.writelines(" ".join(map(str, ids)) + "\n" for ids in sorted(chunk))
+    return path
+
+
+def _read_run(path):
+    with open(path, 'r') as fp:
+        for line in fp:
+            yield tuple(int(v) for v in line.split())
+
+
+class DawgBuilder(object):
+    """ Incremental construction of a minimal DAWG from words given in increasing order """
+
+    def __init__(self, unicharset_size):
+        self.unicharset_size = unicharset_size
+        self.flag_start_bit = int(math.ceil(math.log(unicharset_size + 1.0, 2)))
+        self.label_mask = (1 << self.flag_start_bit) - 1
+        # registered nodes: tuple of packed edges -> node id, ids start at 1, 0 is "no children".
+        # a packed edge is child id << (flag_start_bit + 1) | word end << flag_start_bit | unichar id
+        self.register = {}
+        self.nodes = [None]
+        # nodes of the last word not registered yet: lists of [unichar id, word end, child]
+        self.path = [[]]
+        self.previous = ()
+        self.root = None
+
+    def add(self, ids):
+        if ids <= self.previous:
+            raise ServiceException("words must be added in increasing order")
+        prefix = 0
+        for a, b in zip(ids, self.previous):
+            if a != b:
+                break
+            prefix += 1
+        self._minimize(prefix)
+        for unichar_id in ids[prefix:]:
+            self.path[-1].append([unichar_id, False, None])
+            self.path.append([])
+        # the last edge of the word is an end of word
+        self.path[-2][-1][1] = True
+        self.previous = ids
+
+    def _minimize(self, depth):
+        """ Register the nodes of the current path deeper than depth """
+        shift = self.flag_start_bit
+        while len(self.path) > depth + 1:
+            edges = self.path.pop()
+            key = tuple((child << (shift + 1)) | (word_end << shift) | unichar_id
+                        for unichar_id, word_end, child in edges)
+            if not key:
+                node = 0
+            else:
+                node = self.register.get(key)
+                if node is None:
+                    node = self.register[key] = len(self.nodes)
+                    self.nodes.append(key)
+            self.path[-1][-1][2] = node
+
+    def finish(self):
+        self._minimize(0)
+        shift = self.flag_start_bit
+        self.root = tuple((child << (shift + 1)) | (word_end << shift) | unichar_id
+                          for unichar_id, word_end, child in self.path[0])
+        self.register = None
+        return self
+
+    def edge_count(self):
+        return len(self.root) + sum(len(node) for node in self.nodes[1:])
+
+    def write(self, dawg_path):
+        """ Write the squished dawg, the root first """
+        if self.root is None:
+            self.finish()
+        if not self.root:
+            raise ServiceException("the dawg has no word")
+        shift = self.flag_start_bit
+        next_shift = shift + NUM_FLAG_BITS
+        offsets = array('q', [0]) * len(self.nodes)
+        offset = len(self.root)
+        for node in range(1, len(self.nodes)):
+            offsets[node] = offset
+            offset += len(self.nodes[node])
+        tmp_path = dawg_path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(struct.pack('<hii', DAWG_MAGIC, self.unicharset_size, offset))
+            for edges in [self.root] + self.nodes[1:]:
+                records = array('Q')
+                last = len(edges) - 1
+                for idx, edge in enumerate(edges):
+                    child = edge >> (shift + 1)
+                    flags = WERD_END_FLAG if (edge >> shift) & 1 else 0
+                    if idx == last:
+                        flags |= MARKER_FLAG
+                    records.append((offsets[child] << next_shift) | (flags << shift) | (edge & self.label_mask))
+                if sys.byteorder != 'little':
+                    records.byteswap()
+                records.tofile(fp)
+        os.replace(tmp_path, dawg_path)
+
+
+def build_dawg(word_list_path, unicharset_path, dawg_path, chunk_size=CHUNK_SIZE, tmp_dir=None):
+    """ Build a squished dawg from a word list
+    :return: dict(read, dropped, words, edges)
+    """
+    unichars, size = read_unicharset(unicharset_path)
+    stream = WordStream(word_list_path, unichars, chunk_size, tmp_dir)
+    builder = DawgBuilder(size)
+    for ids in stream:
+        builder.add(ids)
+    builder.finish()
+    builder.write(dawg_path)
+    return {'read': stream.read, 'dropped': stream.dropped, 'words': stream.words, 'edges': builder.edge_count()}
+
+
+def read_dawg(dawg_path):
+    """ All words of a squished dawg, as unichar id tuples (for checks) """
+    with open(dawg_path, 'rb') as fp:
+        magic, unicharset_size, num_edges = struct.unpack('<hii', fp.read(10))
+        if magic != DAWG_MAGIC:
+            raise ServiceException("%s is not a little endian dawg" % dawg_path)
+        edges = array('Q')
+        edges.frombytes(fp.read(8 * num_edges))
+    if sys.byteorder != 'little':
+        edges.byteswap()
+    shift = int(math.ceil(math.log(unicharset_size + 1.0, 2)))
+    label_mask = (1 << shift) - 1
+    stack = [(0, ())]
+    while stack:
+        node, prefix = stack.pop()
+        edge = node
+        while True:
+            record = edges[edge]
+            word = prefix + (record & label_mask,)
+            flags = (record >> shift) & 7
+            if flags & WERD_END_FLAG:
+                yield word
+            child = record >> (shift + NUM_FLAG_BITS)
+            if child:
+                stack.append((child, word))
+            if flags & MARKER_FLAG:
+                break
+            edge += 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build a tesseract dawg from a word list.')
+    parser.add_argument('word_list', help="one word per line")
+    parser.add_argument('dawg', help="output file, e.g. chi_sim.word-dawg")
+    parser.add_argument('unicharset', help="unicharset of the language")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="words sorted in memory at once")
+    args = parser.parse_args(argv)
+    stats = build_dawg(args.word_list, args.unicharset, args.dawg, args.chunk_size)
+    print("%(read)d words read, %(dropped)d dropped, %(words)d distinct words, %(edges)d edges" % stats)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""
+Evaluation of a trained language on a check set.
+
+A check set is a list of (multi-page tif, ground truth) pairs. The ground truth file holds
+the expected text of each page, pages being separated by form feeds (\\f) like tesseract's
+own output, or one page per line when the file has no form feed. Whitespace is ignored
+for the character error rate, the training text has none; the word error rate compares the
+space separated words. Distances are bit-parallel, see django_web/util/edit_distance.py.
+"""
+import os
+import time
+
+from django_web.util.edit_distance import ErrorCounts
+from django_web.util.lazy_import import LazyModule
+
+pytesseract = LazyModule("pytesseract")
+libtiff = LazyModule("libtiff")
+
+
+def read_pages(image_path):
+    """ All pages of a (multi-page) tif, as arrays """
+    tif = libtiff.TIFF.open(image_path, mode='r')
+    try:
+        return [page for page in tif.iter_images()]
+    finally:
+        tif.close()
+
+
+def ocr_pages(image_path, lang, psm, tessdata_dir=None, cache=None):
+    """ Recognize every page of a tif
+    :param tessdata_dir: directory holding {lang}.traineddata, default: tesseract's own tessdata
+    :param cache: optional ocr_cache.OcrCache, only the pages not recognized yet with the same model are
+        recognized
+    :return: list of page texts
+    """
+    config = "-psm %d" % psm
+    if tessdata_dir:
+        config += ' --tessdata-dir "%s"' % tessdata_dir
+
+    def ocr(page):
+        return pytesseract.image_to_string(page, lang, config=config)
+
+    pages = read_pages(image_path)
+    if cache is None:
+        return [ocr(page) for page in pages]
+    return cache.recognize(pages, lang, psm, ocr, tessdata_dir)
+
+
+def load_truth(truth_path):
+    """ Expected text of each page of a check image """
+    with open(truth_path, 'r', encoding='UTF-8') as fp:
+        content = fp.read()
+    pages = content.split('\f') if '\f' in content else content.splitlines()
+    # tesseract ends its output with a form feed, and files usually end with a newline
+    while pages and not pages[-1].strip():
+        pages.pop()
+    return pages
+
+
+def score_check_set(check_set, lang, psm, tessdata_dir=None, cache=None, confusions=False):
+    """ Recognize a check set and compare it to its ground truth
+    :param check_set: list of (image path, ground truth path)
+    :param cache: optional ocr_cache.OcrCache
+    :param confusions: also count which characters are read as which (see edit_distance.ErrorCounts)
+    :return: dict(accuracy, errors, chars, pages, seconds, cache_hits) plus the error rates and counts of
+        ErrorCounts.to_dict (cer, wer, word_errors, words, confusions): accuracy is 1 - character error rate
+    """
+    start = time.time()
+    hits = cache.hits if cache is not None else 0
+    pages = []
+    for image_path, truth_path in check_set:
+        truth = load_truth(truth_path)
+        texts = ocr_pages(image_path, lang, psm, tessdata_dir, cache)
+        if len(truth) != len(texts):
+            raise ValueError("%s has %d pages but %s describes %d" % (
+                os.path.basename(image_path), len(texts), os.path.basename(truth_path), len(truth)))
+        pages.extend(zip(truth, texts))
+    # all pages scored at once, the distances run side by side
+    counts = ErrorCounts(confusions=confusions)
+    counts.add_pages(pages)
+    result = counts.to_dict()
+    accuracy = 1.0 - counts.cer() if counts.chars else 0.0
+    result.update({'accuracy': accuracy, 'errors': counts.char_errors, 'chars': counts.chars, 'pages': counts.pages,
+                   'seconds': time.time() - start,
+                   'cache_hits': cache.hits - hits if cache is not None else 0})
+    return result
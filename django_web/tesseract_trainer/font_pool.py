@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+"""
+Process-wide pool of the training fonts.
+
+ImageFont.truetype reads and parses the font file for every instance, and large collections
+such as simsun.ttc are slow to load. The pool reads each font file once, keyed by the
+sha256 of its content, and hands out sized FreeTypeFont instances kept in an LRU cache,
+so that rendering several sizes, exps or jobs in the same process loads every file once.
+"""
+import io
+import threading
+from collections import OrderedDict
+
+from django_web.util.file_util import file_hash
+from django_web.util.lazy_import import LazyModule
+
+ImageFont = LazyModule("PIL.ImageFont")
+
+MAX_FONTS = 64  # Default number of sized font instances kept
+MAX_FILE_BYTES = 512 * 1024 * 1024  # Default size budget of the font files kept in memory
+
+
+class FontPool(object):
+    """ LRU cache of font files and of their sized FreeTypeFont instances """
+
+    def __init__(self, max_fonts=MAX_FONTS, max_file_bytes=MAX_FILE_BYTES):
+        self.max_fonts = max_fonts
+        self.max_file_bytes = max_file_bytes
+        # font sha256 -> content of the font file
+        self._files = OrderedDict()
+        # (font sha256, size, face index) -> FreeTypeFont
+        self._fonts = OrderedDict()
+        self._lock = threading.Lock()
+        self.file_loads = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, ttf_file, size, index=0):
+        """ A FreeTypeFont of the given size
+        :param ttf_file: path of the font file
+        :param size: font size, in px
+        :param index: face of a .ttc collection
+        """
+        key = (file_hash(ttf_file), size, index)
+        with self._lock:
+            font = self._fonts.get(key)
+            if font is not None:
+                self._fonts.move_to_end(key)
+                self.hits += 1
+                return font
+            self.misses += 1
+            data = self._file_data(key[0], ttf_file)
+            font = ImageFont.truetype(io.BytesIO(data), size, index=index)
+            self._fonts[key] = font
+            while len(self._fonts) > self.max_fonts:
+                self._fonts.popitem(last=False)
+            return font
+
+    def preload(self, ttf_files, sizes=()):
+        """ Load font files, and their sized instances, ahead of rendering """
+        for ttf_file in ttf_files:
+            for size in sizes:
+                self.get(ttf_file, size)
+            if not sizes:
+                with self._lock:
+                    self._file_data(file_hash(ttf_file), ttf_file)
+
+    def _file_data(self, digest, ttf_file):
+        data = self._files.get(digest)
+        if data is not None:
+            self._files.move_to_end(digest)
+            return data
+        with open(ttf_file, 'rb') as fp:
+            data = fp.read()
+        self.file_loads += 1
+        self._files[digest] = data
+        # keep at least the file just loaded
+        while len(self._files) > 1 and sum(len(d) for d in self._files.values()) > self.max_file_bytes:
+            self._files.popitem(last=False)
+        return data
+
+    def stats(self):
+        return {'files': len(self._files), 'fonts': len(self._fonts), 'file_loads': self.file_loads,
+                'hits': self.hits, 'misses': self.misses}
+
+
+_pool = None
+
+
+def get_font_pool():
+    """ The font pool of the current process """
+    global _pool
+    if _pool is None:
+        _pool = FontPool()
+    return _pool
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+"""
+Export of the rendered glyphs as a memory-mapped dataset, for models other than tesseract.
+
+Every boxed character of the rendered pages (after augmentation, exactly as saved for
+box.train) is cropped, scaled to fit a glyph_size x glyph_size square keeping its aspect
+ratio, centered on a white background, and appended to raw uint8 shard files:
+
+    glyphs/
+        manifest.json         glyph size, shard size, number of glyphs, labels, fonts
+        index.npy             one record per glyph: label id, font id, font size
+        shard-00000.u8        shard_size x glyph_size x glyph_size uint8, row major
+        shard-00001.u8        ...
+
+Glyph i is record i of index.npy and row i % shard_size of shard i // shard_size. A loader
+maps the shards with numpy.memmap: a glyph or a run of consecutive glyphs is a view of the
+mapped file, a random minibatch is one fancy indexing per shard, no TIFF is decoded and
+no box file is parsed.
+
+usage:
+    exporter = GlyphExporter("glyphs")  # or TesseractTrainer(..., glyph_export=True)
+    ...
+    export_boxed_pages(exporter, "eng.font.exp0.tif", "eng.font.exp0.box", font, sizes)  # pages already on disk
+    dataset = GlyphDataset("glyphs")
+    for images, labels in dataset.minibatches(256, seed=0):
+        ...
+
+    python -m django_web.tesseract_trainer.glyph_export glyphs   # summary of an export
+
+An export directory is written by one process at a time; running a writer on an existing
+export appends to it.
+"""
+import argparse
+import json
+import os
+import sys
+
+from django_web.model import ServiceException
+from django_web.util.lazy_import import LazyModule
+
+np = LazyModule("numpy")
+Image = LazyModule("PIL.Image")
+
+GLYPH_SIZE = 32  # Default side of the exported glyphs, in px
+SHARD_SIZE = 65536  # Default number of glyphs per shard file
+MANIFEST = 'manifest.json'
+INDEX = 'index.npy'
+INDEX_DTYPE = [('label', '<i4'), ('font', '<u2'), ('size', '<u2')]
+
+
+def _shard_name(shard):
+    return 'shard-%05d.u8' % shard
+
+
+class GlyphExporter(object):
+    """ Append the glyphs of rendered pages to a sharded uint8 array """
+
+    def __init__(self, path, glyph_size=GLYPH_SIZE, shard_size=SHARD_SIZE):
+        """
+        :param path: 导出目录, 已有导出时追加
+        :param glyph_size: 导出字形图片的边长(px)
+        :param shard_size: 每个分片文件包含的字形数
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.labels = []
+        self.fonts = []
+        self.count = 0
+        manifest = os.path.join(path, MANIFEST)
+        if os.path.exists(manifest):
+            with open(manifest, 'r', encoding='UTF-8') as fp:
+                meta = json.load(fp)
+            glyph_size, shard_size = meta['glyph_size'], meta['shard_size']
+            self.labels, self.fonts, self.count = meta['labels'], meta['fonts'], meta['count']
+        self.glyph_size = glyph_size
+        self.shard_size = shard_size
+        self.label_ids = dict((label, idx) for idx, label in enumerate(self.labels))
+        self.font_ids = dict((font, idx) for idx, font in enumerate(self.fonts))
+        self.records = []
+        self.shard_fp = None
+
+    def add_page(self, page, chars, boxes, font, size):
+        """ Append the glyphs of a page
+        :param page: uint8 array HxW
+        :param chars: the character of every box
+        :param boxes: Nx4 array of [x0, y0, x1, y1] in image coordinates, x1/y1 exclusive
+        :param font: path of the font file
+        :param size: font size
+        """
+        page = np.asarray(page)
+        font_id = self.font_ids.get(font)
+        if font_id is None:
+            font_id = self.font_ids[font] = len(self.fonts)
+            self.fonts.append(font)
+        glyphs = np.empty((len(chars), self.glyph_size, self.glyph_size), dtype=np.uint8)
+        for idx, (char, box) in enumerate(zip(chars, np.asarray(boxes).tolist())):
+            glyphs[idx] = self._normalize(page[box[1]:box[3], box[0]:box[2]])
+            label_id = self.label_ids.get(char)
+            if label_id is None:
+                label_id = self.label_ids[char] = len(self.labels)
+                self.labels.append(char)
+            self.records.append((label_id, font_id, size))
+        self._write(glyphs)
+
+    def _normalize(self, crop):
+        """ Scale a crop to fit the glyph square, keeping its aspect ratio, centered on white """
+        side = self.glyph_size
+        glyph = np.full((side, side), 255, dtype=np.uint8)
+        height, width = crop.shape
+        if not height or not width:
+            return glyph
+        scale = float(side) / max(height, width)
+        new_w, new_h = max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+        scaled = np.asarray(Image.fromarray(crop).resize((new_w, new_h), Image.BILINEAR))
+        top, left = (side - new_h) // 2, (side - new_w) // 2
+        glyph[top:top + new_h, left:left + new_w] = scaled
+        return glyph
+
+    def _write(self, glyphs):
+        """ Append glyphs to the shards, opening a new shard each shard_size glyphs """
+        start = 0
+        while start < len(glyphs):
+            shard, offset = divmod(self.count, self.shard_size)
+            if self.shard_fp is None:
+                self._open_shard(shard, offset)
+            take = min(len(glyphs) - start, self.shard_size - offset)
+            self.shard_fp.write(glyphs[start:start + take].tobytes())
+            self.count += take
+            start += take
+            if self.count % self.shard_size == 0:
+                self.shard_fp.close()
+                self.shard_fp = None
+
+    def _open_shard(self, shard, offset):
+        self.shard_fp = open(os.path.join(self.path, _shard_name(shard)), 'ab')
+        # glyphs written after the last manifest (interrupted export) are not indexed, drop them
+        self.shard_fp.truncate(offset * self.glyph_size * self.glyph_size)
+
+    def close(self):
+        """ Flush the shards and write the index and the manifest """
+        if self.shard_fp is not None:
+            self.shard_fp.close()
+            self.shard_fp = None
+        index_path = os.path.join(self.path, INDEX)
+        records = np.array(self.records, dtype=INDEX_DTYPE)
+        if os.path.exists(index_path):
+            records = np.concatenate([np.load(index_path), records])
+        self.records = []
+        if len(records) != self.count:
+            raise ServiceException("%s has %d index records for %d glyphs" % (self.path, len(records), self.count))
+        _write_atomic(index_path, lambda fp: np.save(fp, records))
+        shards = (self.count + self.shard_size - 1) // self.shard_size
+        meta = {'glyph_size': self.glyph_size,
+                'shard_size': self.shard_size,
+                'count': self.count,
+                'shards': [_shard_name(shard) for shard in range(shards)],
+                'labels': self.labels,
+                'fonts': self.fonts}
+        _write_atomic(os.path.join(self.path, MANIFEST),
+                      lambda fp: fp.write(json.dumps(meta, ensure_ascii=False, indent=1).encode('utf-8')))
+        print("**** %d glyphs of %d labels exported to %s" % (self.count, len(self.labels), self.path))
+
+
+def export_boxed_pages(exporter, tif_path, box_path, font, sizes):
+    """ Export the glyphs of pages rendered earlier (stage cache), from their multi-page tif and box file
+    :param sizes: font size of every page, in page order
+    """
+    pages = {}
+    with open(box_path, 'r', encoding='UTF-8') as fp:
+        for line in fp:
+            char, left, bottom, right, top, page_nb = line.rstrip('\n').rsplit(' ', 5)
+            pages.setdefault(int(page_nb), []).append((char, int(left), int(bottom), int(right), int(top)))
+    with Image.open(tif_path) as tif:
+        for page_nb in sorted(pages):
+            tif.seek(page_nb)
+            page = np.asarray(tif.convert('L'))
+            height = page.shape[0]
+            chars = [char for char, _, _, _, _ in pages[page_nb]]
+            # box files count y from the bottom of the page
+            boxes = [[left, height - top, right, height - bottom] for _, left, bottom, right, top in pages[page_nb]]
+            exporter.add_page(page, chars, boxes, font, sizes[page_nb])
+
+
+def _write_atomic(path, write):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fp:
+        write(fp)
+    os.replace(tmp_path, path)
+
+
+class GlyphDataset(object):
+    """ Read side of an export: memory-mapped glyphs and their index """
+
+    def __init__(self, path):
+        with open(os.path.join(path, MANIFEST), 'r', encoding='UTF-8') as fp:
+            meta = json.load(fp)
+        self.path = path
+        self.glyph_size = meta['glyph_size']
+        self.shard_size = meta['shard_size']
+        self.labels = meta['labels']
+        self.fonts = meta['fonts']
+        self.count = meta['count']
+        self.index = np.load(os.path.join(path, INDEX), mmap_mode='r')[:self.count]
+        self.shards = []
+        for shard, name in enumerate(meta['shards']):
+            rows = min(self.shard_size, self.count - shard * self.shard_size)
+            self.shards.append(np.memmap(os.path.join(path, name), dtype=np.uint8, mode='r',
+                                         shape=(rows, self.glyph_size, self.glyph_size)))
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        """ (glyph view, label id) of glyph idx """
+        shard, offset = divmod(int(idx), self.shard_size)
+        return self.shards[shard][offset], int(self.index[idx]['label'])
+
+    def label_name(self, label_id):
+        return self.labels[label_id]
+
+    def batch(self, indices, out=None):
+        """ Glyphs and index records of a set of glyphs, one read per shard
+        :param out: optional uint8 array len(indices) x glyph_size x glyph_size to fill
+        :return: (glyph array, index records)
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if out is None:
+            out = np.empty((len(indices), self.glyph_size, self.glyph_size), dtype=np.uint8)
+        shard_of = indices // self.shard_size
+        for shard in np.unique(shard_of):
+            rows = np.nonzero(shard_of == shard)[0]
+            out[rows] = self.shards[shard][indices[rows] - shard * self.shard_size]
+        return out, self.index[indices]
+
+    def minibatches(self, batch_size, shuffle=True, seed=None):
+        """ Iterate over the dataset by minibatches of (glyphs, label ids) """
+        order = np.arange(self.count)
+        if shuffle:
+            np.random.RandomState(seed).shuffle(order)
+        for start in range(0, self.count, batch_size):
+            # sorted reads inside a batch follow the file order
+            indices = np.sort(order[start:start + batch_size])
+            glyphs, records = self.batch(indices)
+            yield glyphs, records['label']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Summary of a glyph export.')
+    parser.add_argument('path', help="export directory")
+    args = parser.parse_args(argv)
+    dataset = GlyphDataset(args.path)
+    print("%d glyphs of %dx%d px in %d shards, %d labels, %d fonts" % (
+        len(dataset), dataset.glyph_size, dataset.glyph_size, len(dataset.shards), len(dataset.labels),
+        len(dataset.fonts)))
+    counts = np.bincount(dataset.index['label'], minlength=len(dataset.labels))
+    for font_id, font in enumerate(dataset.fonts):
+        print("  %s: %d glyphs" % (font, int((dataset.index['font'] == font_id).sum())))
+    print("glyphs per label: min %d, max %d" % (counts.min(), counts.max()) if len(counts) else "no glyph")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,483 @@
+# -*- coding: utf-8 -*-
+
+"""
+Multi-host training through a job queue on shared storage.
+
+A training run is split into units: one "font" unit per training font (render the pages,
+write the box file, run box.train, as one exp) and one "cluster" unit per language
+(unicharset, mftraining, cntraining, combine_tessdata). Units are rows of a SQLite
+database living next to the training folders, on storage every host mounts at the same
+ref_path. Worker processes on any host claim units under a lease they renew while working;
+a unit whose lease expires (crashed or partitioned worker) is claimed again, up to
+max_attempts times. The coordinator waits for the results and continues its own
+TesseractTrainer run with them.
+
+SQLite needs working POSIX locks on the shared file system (NFSv4 with locking, CephFS...).
+
+With glyph_export, every font unit writes the glyphs of its exp to an export of its own,
+{training folder}/glyphs/exp{N}, an export directory having a single writer.
+
+usage:
+    # on every host
+    python -m django_web.tesseract_trainer.job_queue worker /shared/train_data/queue.db --processes 4
+    # progress
+    python -m django_web.tesseract_trainer.job_queue status /shared/train_data/queue.db
+
+    # coordinator
+    queue = JobQueue("/shared/train_data/queue.db")
+    DistributedTraining(trainer, queue).run()
+    trainer.add_trained_data()
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+
+from django_web.model import ServiceException
+
+LEASE_SECONDS = 600  # Default lease of a claimed unit, renewed every LEASE_SECONDS / 3 while it runs
+MAX_ATTEMPTS = 3  # Default number of times a unit is tried before being marked as failed
+POLL_SECONDS = 2  # Idle wait of workers and coordinators
+LOST_CHECK_SECONDS = 0.5  # a unit whose lease was lost is killed within this time
+
+STATE_PENDING = 'pending'
+STATE_RUNNING = 'running'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    batch TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    owner TEXT,
+    lease_until REAL,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS units_state ON units (state, id);
+CREATE INDEX IF NOT EXISTS units_batch ON units (batch);
+"""
+
+
+class JobQueue(object):
+    """ SQLite backed queue of training units with leases and retries """
+
+    def __init__(self, db_path, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        # autocommit mode, transactions are opened explicitly with BEGIN IMMEDIATE
+        return _Connection(self.db_path)
+
+    def submit(self, batch, kind, payload):
+        """ Add a unit to the queue
+        :param batch: identifier grouping the units of one coordinator run
+        :param kind: unit type, a key of UNIT_HANDLERS
+        :param payload: json-serializable parameters of the unit
+        :return: unit id
+        """
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO units (batch, kind, payload, state, max_attempts, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (batch, kind, json.dumps(payload), STATE_PENDING, self.max_attempts, now, now))
+            return cursor.lastrowid
+
+    def claim(self, owner, kinds=None):
+        """ Take the oldest pending unit, or a running one whose lease expired
+        :return: dict(id, kind, payload, attempts) or None when there is nothing to do
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # units whose last attempt expired are given up
+                conn.execute("UPDATE units SET state = ?, error = 'lease expired', updated = ? "
+                             "WHERE state = ? AND lease_until < ? AND attempts >= max_attempts",
+                             (STATE_FAILED, now, STATE_RUNNING, now))
+                query = ("SELECT id, kind, payload, attempts FROM units WHERE "
+                         "(state = ? OR (state = ? AND lease_until < ?))")
+                args = [STATE_PENDING, STATE_RUNNING, now]
+                if kinds:
+                    query += " AND kind IN (%s)" % ", ".join("?" * len(kinds))
+                    args.extend(kinds)
+                row = conn.execute(query + " ORDER BY id LIMIT 1", args).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                conn.execute("UPDATE units SET state = ?, owner = ?, lease_until = ?, attempts = attempts + 1, "
+                             "updated = ? WHERE id = ?",
+                             (STATE_RUNNING, owner, now + self.lease_seconds, now, row[0]))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return {'id': row[0], 'kind': row[1], 'payload': json.loads(row[2]), 'attempts': row[3] + 1}
+
+    def heartbeat(self, unit_id, owner):
+        """ Extend the lease of a running unit. Return False if the unit was lost to another worker """
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute("UPDATE units SET lease_until = ?, updated = ? "
+                                  "WHERE id = ? AND owner = ? AND state = ?",
+                                  (now + self.lease_seconds, now, unit_id, owner, STATE_RUNNING))
+            return cursor.rowcount == 1
+
+    def complete(self, unit_id, owner, result):
+        with self._connect() as conn:
+            conn.execute("UPDATE units SET state = ?, result = ?, error = NULL, updated = ? "
+                         "WHERE id = ? AND owner = ? AND state = ?",
+                         (STATE_DONE, json.dumps(result), time.time(), unit_id, owner, STATE_RUNNING))
+
+    def fail(self, unit_id, owner, error):
+        """ Record a failed attempt: the unit goes back to pending until max_attempts is reached """
+        with self._connect() as conn:
+            conn.execute("UPDATE units SET state = CASE WHEN attempts >= max_attempts THEN ? ELSE ? END, "
+                         "error = ?, owner = NULL, lease_until = NULL, updated = ? "
+                         "WHERE id = ? AND owner = ? AND state = ?",
+                         (STATE_FAILED, STATE_PENDING, error, time.time(), unit_id, owner, STATE_RUNNING))
+
+    def units(self, unit_ids):
+        """ Current state of some units: id -> dict(state, result, error, attempts, owner) """
+        if not unit_ids:
+            return {}
+        with self._connect() as conn:
+            rows = conn.execute("SELECT id, state, result, error, attempts, owner FROM units WHERE id IN (%s)"
+                                % ", ".join("?" * len(unit_ids)), list(unit_ids)).fetchall()
+        return dict((row[0], {'state': row[1], 'result': json.loads(row[2]) if row[2] else None,
+                              'error': row[3], 'attempts': row[4], 'owner': row[5]}) for row in rows)
+
+    def wait(self, unit_ids, timeout=None, poll=POLL_SECONDS, workers=None):
+        """ Wait until all units are done
+        :param workers: optional local worker processes: when all of them have exited, the units left would
+            never run
+        :return: id -> result
+        :raise ServiceException: as soon as one of them failed for good, on timeout, or when no local worker
+            is left
+        """
+        start = time.time()
+        while True:
+            units = self.units(unit_ids)
+            failed = [(uid, u) for uid, u in units.items() if u['state'] == STATE_FAILED]
+            if failed:
+                uid, unit = failed[0]
+                raise ServiceException("unit %d failed after %d attempts: %s" % (uid, unit['attempts'], unit['error']))
+            if all(u['state'] == STATE_DONE for u in units.values()):
+                return dict((uid, u['result']) for uid, u in units.items())
+            if workers and not any(worker.is_alive() for worker in workers):
+                raise ServiceException("all local workers exited (codes %s) with units %s left" % (
+                    ", ".join(str(worker.exitcode) for worker in workers),
+                    sorted(uid for uid, u in units.items() if u['state'] != STATE_DONE)))
+            if timeout is not None and time.time() - start > timeout:
+                raise ServiceException("timeout waiting for units %s" % sorted(
+                    uid for uid, u in units.items() if u['state'] != STATE_DONE))
+            time.sleep(poll)
+
+    def status(self):
+        """ Number of units per (batch, state) """
+        with self._connect() as conn:
+            return conn.execute("SELECT batch, state, COUNT(*) FROM units GROUP BY batch, state "
+                                "ORDER BY batch, state").fetchall()
+
+
+class _Connection(object):
+    """ sqlite3 connection used as a context manager which also closes it """
+
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, *exc):
+        self.conn.close()
+
+
+# --- trainer <-> payload ---
+
+def trainer_spec(trainer):
+    """ The parameters needed to rebuild a trainer on another host, on the same training folder """
+    # final_path: with a workspace, training_path is a scratch directory of this host only
+    text_file = os.path.join(trainer.final_path, 'training_text.txt')
+    if not os.path.exists(text_file):
+        with open(text_file, 'w', encoding='UTF-8') as fp:
+            fp.write(trainer.training_text)
+    exporter = trainer.glyph_exporter
+    return {'ref_path': trainer.ref_path,
+            'base_lang': trainer.base_lang,
+            'base_psm': trainer.base_psm,
+            'lang_name': trainer.lang_name,
+            'font_name': trainer.font_name,
+            'training_text_file': text_file,
+            'ttf_file_list': trainer.ttf_file_list,
+            'font_properties': list(trainer.font_properties),
+            'font_size': trainer.font_size,
+            'train_id': trainer.train_id,
+            'tessdata_path': trainer.tessdata_path,
+            'word_list': trainer.word_list,
+            'verbose': trainer.verbose,
+            'augment': trainer.augmenter.cache_params() if trainer.augmenter is not None else None,
+            'skip_missing_glyphs': trainer.skip_missing_glyphs,
+            'layout': trainer.layout,
+            'stage_cache': trainer.stage_cache.root if trainer.stage_cache is not None else None,
+            'glyph_export': {'glyph_size': exporter.glyph_size, 'shard_size': exporter.shard_size}
+            if exporter is not None else None}
+
+
+def trainer_from_spec(spec, exp_number=None):
+    """ Rebuild a trainer from trainer_spec(), reusing its training folder
+    :param exp_number: the trainer of a font unit, its glyphs (glyph_export) go to glyphs/exp{exp_number}
+    """
+    from . import TesseractTrainer, ON_EXISTS_KEEP
+    from .augment import Augmenter
+    from .stage_cache import StageCache
+
+    with open(spec['training_text_file'], 'r', encoding='UTF-8') as fp:
+        training_text = fp.read()
+    trainer = TesseractTrainer(spec['ref_path'], spec['base_lang'], spec['base_psm'], spec['lang_name'],
+                               spec['font_name'], training_text, spec['ttf_file_list'],
+                               tuple(spec['font_properties']), spec['font_size'], spec['train_id'],
+                               spec['tessdata_path'],
+                               word_list=spec['word_list'],
+                               verbose=spec['verbose'],
+                               on_exists=ON_EXISTS_KEEP,
+                               augmenter=Augmenter(**spec['augment']) if spec['augment'] else None,
+                               skip_missing_glyphs=spec['skip_missing_glyphs'],
+                               layout=spec['layout'],
+                               stage_cache=StageCache(spec['stage_cache']) if spec['stage_cache'] else None)
+    if exp_number is not None:
+        trainer.exp_number = exp_number
+        if spec.get('glyph_export'):
+            from .glyph_export import GlyphExporter
+
+            export_path = os.path.join(trainer.final_path, 'glyphs', 'exp%d' % exp_number)
+            # left by a failed attempt of the unit
+            shutil.rmtree(export_path, ignore_errors=True)
+            trainer.glyph_exporter = GlyphExporter(export_path, **spec['glyph_export'])
+    return trainer
+
+
+def _run_font_unit(payload):
+    trainer = trainer_from_spec(payload['trainer'], payload['exp_number'])
+    rendered = trainer._train_font(payload['ttf'])
+    trainer._close_glyph_export()
+    features = os.path.join(trainer.training_path, '%s.tr' % trainer._form_file_prefix(trainer.exp_number))
+    if rendered and not os.path.exists(features):
+        # box.train failed: the unit is tried again
+        raise ServiceException("%s was not generated" % features)
+    return {'rendered': rendered, 'exp_number': payload['exp_number']}
+
+
+def _run_cluster_unit(payload):
+    trainer = trainer_from_spec(payload['trainer'])
+    trainer.exp_number = payload['exp_count']
+    trainer._cluster()
+    traineddata = os.path.join(trainer.training_path, '%s.traineddata' % trainer.lang_name)
+    if not os.path.exists(traineddata):
+        raise ServiceException("%s was not generated" % traineddata)
+    return {'traineddata': traineddata}
+
+
+# unit kind -> function(payload) returning a json-serializable result
+UNIT_HANDLERS = {
+    'font': _run_font_unit,
+    'cluster': _run_cluster_unit,
+}
+
+
+class DistributedTraining(object):
+    """ Runs the training of a TesseractTrainer through the queue """
+
+    def __init__(self, trainer, queue, timeout=None):
+        self.trainer = trainer
+        self.queue = queue
+        self.timeout = timeout
+        self.batch = "%s@%s:%d:%d" % (trainer.folder_name, socket.gethostname(), os.getpid(), int(time.time()))
+
+    def run(self, local_workers=0):
+        """ Train through the queue
+        :param local_workers: number of worker processes to start on this host for the run
+        :return: path of the generated traineddata
+        """
+        trainer = self.trainer
+        print("**** start distributed training language = %s, batch %s ****" % (trainer.lang_name, self.batch))
+        spec = trainer_spec(trainer)
+        # fonts without any glyph for the text are left out here so that exp numbers stay contiguous
+        fonts = [ttf for ttf in trainer.ttf_file_list if trainer._font_text(ttf) is not None]
+        if not fonts:
+            raise ServiceException("no font can render the training text")
+        font_units = [self.queue.submit(self.batch, 'font', {'trainer': spec, 'ttf': ttf, 'exp_number': exp})
+                      for exp, ttf in enumerate(fonts)]
+        # the local workers run until the training ends, they are stopped below
+        stop = multiprocessing.Event()
+        processes = [multiprocessing.Process(target=run_worker, args=(self.queue.db_path,),
+                                             kwargs={'stop': stop, 'lease_seconds': self.queue.lease_seconds})
+                     for _ in range(local_workers)]
+        for process in processes:
+            process.start()
+        try:
+            self.queue.wait(font_units, self.timeout, workers=processes)
+            trainer.exp_number = len(fonts)
+            cluster_unit = self.queue.submit(self.batch, 'cluster', {'trainer': spec, 'exp_count': len(fonts)})
+            result = self.queue.wait([cluster_unit], self.timeout, workers=processes)[cluster_unit]
+        finally:
+            stop.set()
+            for process in processes:
+                # idle workers see the stop within a poll, a worker still busy (failed run) is terminated
+                process.join(POLL_SECONDS * 2)
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+        if trainer.verbose:
+            print('The %s.traineddata file has been generated !' % trainer.lang_name)
+        return result['traineddata']
+
+
+def run_worker(db_path, owner=None, kinds=None, idle_exit=None, lease_seconds=LEASE_SECONDS, stop=None):
+    """ Claim and run units until stopped
+    Each unit runs in a child process of its own process group: when the lease of the unit is lost (the
+    heartbeats failed long enough for another worker to claim it), the unit and its tesseract processes are
+    killed and nothing is recorded, the new owner runs it alone.
+    :param owner: worker identity, default host:pid
+    :param kinds: unit kinds this worker accepts, default all
+    :param idle_exit: exit after this many seconds without work, None to run forever
+    :param stop: optional multiprocessing.Event, the worker exits once it is set and no unit is running
+    """
+    queue = JobQueue(db_path, lease_seconds=lease_seconds)
+    owner = owner or "%s:%d" % (socket.gethostname(), os.getpid())
+    if threading.current_thread() is threading.main_thread():
+        # terminate() of the coordinator: the running unit is killed on the way out
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    idle_since = time.time()
+    while stop is None or not stop.is_set():
+        unit = queue.claim(owner, kinds)
+        if unit is None:
+            if idle_exit is not None and time.time() - idle_since > idle_exit:
+                return
+            if stop is not None:
+                stop.wait(POLL_SECONDS)
+            else:
+                time.sleep(POLL_SECONDS)
+            continue
+        print("[%s] unit %d %s, attempt %d" % (owner, unit['id'], unit['kind'], unit['attempts']))
+        lost = threading.Event()
+        done = threading.Event()
+        beat = threading.Thread(target=_heartbeat, args=(queue, unit['id'], owner, done, lost))
+        beat.daemon = True
+        beat.start()
+        try:
+            status, value = _run_unit(unit, lost)
+        finally:
+            done.set()
+            beat.join()
+        if status == 'lost':
+            print("[%s] unit %d: lease lost, unit aborted" % (owner, unit['id']))
+        elif status == 'ok':
+            queue.complete(unit['id'], owner, value)
+        else:
+            queue.fail(unit['id'], owner, value)
+        idle_since = time.time()
+
+
+def _run_unit(unit, lost):
+    """ Run a unit in a child process, killed with its process group as soon as lost is set
+    :return: ('ok', result), ('error', message) or ('lost', None)
+    """
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_unit_main, args=(sender, unit['kind'], unit['payload']))
+    process.start()
+    sender.close()
+    try:
+        while not receiver.poll(LOST_CHECK_SECONDS):
+            if lost.is_set():
+                return 'lost', None
+            if not process.is_alive() and not receiver.poll():
+                return 'error', "unit process exited with code %s" % process.exitcode
+        try:
+            return receiver.recv()
+        except EOFError:
+            return 'error', "unit process exited with code %s" % process.exitcode
+    finally:
+        receiver.close()
+        _kill_unit(process)
+
+
+def _unit_main(conn, kind, payload):
+    if hasattr(os, 'setpgrp'):
+        # the unit and the stage processes it starts can be killed together
+        os.setpgrp()
+    try:
+        outcome = ('ok', UNIT_HANDLERS[kind](payload))
+    except Exception as e:
+        traceback.print_exc()
+        outcome = ('error', "%s: %s" % (type(e).__name__, e))
+    sys.stdout.flush()
+    conn.send(outcome)
+    conn.close()
+
+
+def _kill_unit(process):
+    """ Kill the process group of a unit, its stage processes included, and reap the unit process """
+    if hasattr(os, 'killpg'):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:  # the group is gone
+            pass
+    elif process.is_alive():
+        process.kill()
+    process.join()
+
+
+def _heartbeat(queue, unit_id, owner, done, lost):
+    while not done.wait(queue.lease_seconds / 3.0):
+        if not queue.heartbeat(unit_id, owner):
+            lost.set()
+            return
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Distributed training workers.')
+    parser.add_argument('action', choices=['worker', 'status'])
+    parser.add_argument('db_path', help="path of the queue database, on the shared storage")
+    parser.add_argument('--processes', '-p', type=int, default=1, help="number of local worker processes")
+    parser.add_argument('--kinds', '-k', default=None, help="comma separated unit kinds to accept (font,cluster)")
+    parser.add_argument('--idle-exit', type=float, default=None, help="exit after this many idle seconds")
+    args = parser.parse_args(argv)
+
+    if args.action == 'status':
+        for batch, state, count in JobQueue(args.db_path).status():
+            print("%-60s %-8s %d" % (batch, state, count))
+        return 0
+    kinds = args.kinds.split(',') if args.kinds else None
+    processes = [multiprocessing.Process(target=run_worker, args=(args.db_path,),
+                                         kwargs={'kinds': kinds, 'idle_exit': args.idle_exit})
+                 for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""
+LSTM training mode (tesseract 4 and later).
+
+The legacy pipeline (box.train, mftraining, cntraining) only trains the 3.x classifier,
+while the recent base languages (chi_sim...) ship LSTM models. LSTMTrainer fine-tunes the
+LSTM model of base_lang on text lines:
+
+1. the training text is rendered as single-line pages by MultiPageTif, one WordStr box per
+   line, in shards of lines_per_shard lines (one shard = one exp);
+2. `tesseract shard.tif shard --psm 13 lstm.train` turns every shard into a .lstmf file,
+   shards being processed by `workers` processes while the next shards are rendered;
+3. `lstmtraining` continues the LSTM of base_lang on the .lstmf files, writing checkpoints
+   into the training folder;
+4. `lstmtraining --stop_training` converts the best checkpoint into {lang_name}.traineddata.
+
+A run started again on the same training folder (on_exists='keep') reuses the .lstmf files
+already generated and resumes lstmtraining from its last checkpoint, unless it ran in a
+scratch workspace, which only keeps the final traineddata.
+
+The fine-tuned model keeps the unicharset of base_lang: characters base_lang does not know
+can not be learnt this way.
+"""
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+from django_web.model import ServiceException
+from . import TesseractTrainer
+from .multipage_tif import MultiPageTif, BOX_LEVEL_LINE
+from .traineddata import TrainedData
+
+LINE_PSM = 13  # Raw line: the rendered pages hold a single line of text
+LINES_PER_SHARD = 200  # Default number of lines per rendered tif / .lstmf file
+MAX_ITERATIONS = 10000  # Default number of lstmtraining iterations
+EVAL_RATIO = 0.1  # Default part of the shards kept aside to evaluate the checkpoints
+
+
+class LSTMTrainer(TesseractTrainer):
+    """ Fine-tune the LSTM model of base_lang on rendered text lines """
+
+    def __init__(self, *args, max_iterations=MAX_ITERATIONS, target_error_rate=None, learning_rate=None,
+                 lines_per_shard=LINES_PER_SHARD, eval_ratio=EVAL_RATIO, workers=None, **kwargs):
+        """
+        Same arguments as TesseractTrainer, plus:
+        :param max_iterations: lstmtraining的最大迭代次数
+        :param target_error_rate: 可选, 字符错误率(%)低于该值时提前结束
+        :param learning_rate: 可选, lstmtraining的学习率
+        :param lines_per_shard: 每个tif/.lstmf包含的行数
+        :param eval_ratio: 用于评估checkpoint的分片比例
+        :param workers: 并行运行lstm.train的进程数, 默认cpu数
+        """
+        TesseractTrainer.__init__(self, *args, **kwargs)
+        self.max_iterations = max_iterations
+        self.target_error_rate = target_error_rate
+        self.learning_rate = learning_rate
+        self.lines_per_shard = lines_per_shard
+        self.eval_ratio = eval_ratio
+        self.workers = workers or os.cpu_count() or 1
+        self.checkpoint_dir = os.path.join(self.training_path, 'checkpoints')
+        self.base_traineddata = os.path.join(self.tessdata_path, '%s.traineddata' % self.base_lang)
+
+    def training(self):
+        print("**** start LSTM training language = %s ****" % self.lang_name)
+        if not os.path.exists(self.base_traineddata):
+            raise ServiceException("%s is needed to fine-tune its LSTM model" % self.base_traineddata)
+        if self.skip_missing_glyphs:
+            self.report_coverage()
+        with self._in_workspace():
+            lstmf_files = self._generate_lstmf()
+            if not lstmf_files:
+                raise ServiceException("no font can render the training text")
+            self._close_glyph_export()
+            # no lstm.train is running any more, files can be moved safely
+            self._spill()
+            train_list, eval_list = self._write_lists(lstmf_files)
+            self._lstm_training(train_list, eval_list)
+            self._stop_training()
+        if self.verbose:
+            print('The %s.traineddata file has been generated !' % self.lang_name)
+
+    def _line_width(self):
+        return self.layout.get('wrap_len', 12)
+
+    def _generate_lstmf(self):
+        """ Render the line shards of every font, and run lstm.train on each of them as soon
+            as it is rendered
+        :return: list of .lstmf paths
+        """
+        shard_chars = self.lines_per_shard * self._line_width()
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for ttf in self.ttf_file_list:
+                text = self._font_text(ttf)
+                if text is None:
+                    continue
+                for start in range(0, len(text), shard_chars):
+                    prefix = self._form_file_prefix(self.exp_number)
+                    lstmf = os.path.join(self.training_path, prefix + '.lstmf')
+                    if not self._is_fresh(lstmf, prefix):
+                        self._render_lines(ttf, text[start:start + shard_chars])
+                        futures.append(executor.submit(self._lstm_train, prefix))
+                    elif self.verbose:
+                        print("%s already generated" % lstmf)
+                    self.exp_number += 1
+            # wait for every shard, the first error is raised
+            for future in futures:
+                future.result()
+        lstmf_files = [os.path.join(self.training_path, self._form_file_prefix(idx) + '.lstmf')
+                       for idx in range(self.exp_number)]
+        return [path for path in lstmf_files if os.path.exists(path)]
+
+    def _is_fresh(self, lstmf, prefix):
+        """ True if the .lstmf of a shard exists and is newer than its box file (resumed run) """
+        box = os.path.join(self.training_path, prefix + '.box')
+        return os.path.exists(lstmf) and os.path.exists(box) and os.path.getmtime(lstmf) >= os.path.getmtime(box)
+
+    def _render_lines(self, ttf, text):
+        mp = MultiPageTif(self.training_path, text, self.font_name, [ttf], self.font_size, self.exp_number,
+                          self.lang_name, self.verbose, augmenter=self.augmenter, layout=self.layout,
+                          box_level=BOX_LEVEL_LINE)
+        mp.indiv_page_prefix = '%s.page' % self._form_file_prefix(self.exp_number)
+        mp.glyph_exporter = self.glyph_exporter
+        mp.generate_tif()
+        mp.generate_boxfile()
+
+    def _lstm_train(self, prefix):
+        """ Generate the .lstmf file of a shard """
+        # the base_lang model checked in training(), not the one of tesseract's own tessdata
+        self._run('lstm.train', ['tesseract', prefix + '.tif', prefix, '--tessdata-dir', self.tessdata_path,
+                                 '-l', self.base_lang, '--psm', str(LINE_PSM), 'lstm.train'])
+        if not os.path.exists(os.path.join(self.training_path, prefix + '.lstmf')):
+            raise ServiceException("lstm.train did not generate %s.lstmf" % prefix)
+
+    def _write_lists(self, lstmf_files):
+        """ Split the shards into the training and evaluation lists of lstmtraining """
+        files = sorted(lstmf_files)
+        random.Random(self.train_id).shuffle(files)
+        n_eval = int(len(files) * self.eval_ratio) if len(files) > 1 else 0
+        eval_files, train_files = files[:n_eval], files[n_eval:]
+        train_list = os.path.join(self.training_path, '%s.training_files.txt' % self.lang_name)
+        eval_list = os.path.join(self.training_path, '%s.eval_files.txt' % self.lang_name)
+        for path, content in ((train_list, train_files), (eval_list, eval_files)):
+            with open(path, 'w', encoding='UTF-8') as fp:
+                fp.write("\n".join(content) + "\n")
+        return train_list, eval_list if eval_files else None
+
+    def _checkpoint(self):
+        return os.path.join(self.checkpoint_dir, '%s_checkpoint' % self.lang_name)
+
+    def _lstm_training(self, train_list, eval_list):
+        """ Fine-tune, from the last checkpoint if a previous run was interrupted """
+        base_lstm = os.path.join(self.training_path, '%s.lstm' % self.base_lang)
+        if not os.path.exists(base_lstm):
+            with TrainedData(self.base_traineddata) as base:
+                if 'lstm' not in base.offsets:
+                    raise ServiceException("%s has no LSTM model to fine-tune" % self.base_traineddata)
+                base.extract('lstm', base_lstm)
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        checkpoint = self._checkpoint()
+        if os.path.exists(checkpoint):
+            print("resuming from %s" % checkpoint)
+            continue_from = checkpoint
+        else:
+            continue_from = base_lstm
+        cmd = ['lstmtraining',
+               '--model_output', os.path.join(self.checkpoint_dir, self.lang_name),
+               '--continue_from', continue_from,
+               '--traineddata', self.base_traineddata,
+               '--train_listfile', train_list,
+               '--max_iterations', str(self.max_iterations)]
+        if eval_list:
+            cmd += ['--eval_listfile', eval_list]
+        if self.target_error_rate is not None:
+            cmd += ['--target_error_rate', str(self.target_error_rate)]
+        if self.learning_rate is not None:
+            cmd += ['--learning_rate', str(self.learning_rate)]
+        self._run('lstmtraining', cmd)
+
+    def _stop_training(self):
+        """ Convert the last checkpoint into the traineddata of the language """
+        checkpoint = self._checkpoint()
+        if not os.path.exists(checkpoint):
+            raise ServiceException("lstmtraining wrote no checkpoint in %s" % self.checkpoint_dir)
+        self._run('stop_training', ['lstmtraining', '--stop_training',
+                                    '--continue_from', checkpoint,
+                                    '--traineddata', self.base_traineddata,
+                                    '--model_output',
+                                    os.path.join(self.training_path, '%s.traineddata' % self.lang_name)])
+
+    def _run(self, stage, cmd):
+        run = self._run_stage(stage, cmd)
+        if run.returncode != 0:
+            tail = str(run.stderr, 'utf-8', 'replace').strip().splitlines()[-5:]
+            raise ServiceException("%s failed: %s" % (cmd[0], " / ".join(tail)))
@@ -10,22 +10,35 @@ UTF-8 encoded characters are supported.
 """
 
 import random
-from PIL import Image
-from PIL import ImageFont
-from PIL import ImageDraw
-import numpy as np
-from django_web.model import *
+import re
 import glob
 import subprocess
 import os
 import codecs
+from django_web.model import ServiceException
+from django_web.util.lazy_import import LazyModule
+from .font_pool import get_font_pool
+from .page_check import check_page
+
+# PIL and numpy are imported on first use, so that importing the trainer stays cheap
+Image = LazyModule("PIL.Image")
+ImageFont = LazyModule("PIL.ImageFont")
+ImageDraw = LazyModule("PIL.ImageDraw")
+np = LazyModule("numpy")
+
+
+# Page layout parameters which can be overridden through the 'layout' argument
+LAYOUT_KEYS = ('start_x', 'start_y', 'row_gap', 'col_gap', 'word_per_page', 'wrap_len')
+
+BOX_LEVEL_CHAR = 'char'
+BOX_LEVEL_LINE = 'line'
 
 
 class MultiPageTif(object):
     """ A class allowing generation of a multi-page tif. """
 
     def __init__(self, training_path, text, font_name, ttf_file_list, fontsize, exp_number,
-                 lang_name, verbose):
+                 lang_name, verbose, augmenter=None, layout=None, box_level=BOX_LEVEL_CHAR):
         self.training_path = training_path
         # Width of the generated tifs (in px)
         self.W = 800
@@ -36,15 +49,20 @@ class MultiPageTif(object):
         # Y coordinate of the first letter of the page
         self.start_y = 20
 
-        # Text to be written in generated multipage tif
-        self.text = [word for word in text.split(' ')]
+        # Text to be written in generated multipage tif, words separated by whitespace
+        self.text = text
 
-        # Font used when "writing" the text into the tif
-        self.fontsize = fontsize
+        # Font sizes used when "writing" the text into the tif: an int or a list of sizes,
+        # all rendered in the same multipage tif
+        self.font_sizes = list(fontsize) if isinstance(fontsize, (list, tuple)) else [fontsize]
+        self.fontsize = self.font_sizes[0]
+        # Fonts come from the process-wide pool: each file is loaded once for all sizes and exps
+        self.font_pool = get_font_pool()
+        self.ttf_file_list = list(ttf_file_list)
         self.true_type_list = list()
         print("***** ttf files used *****")
-        for ttf_file in ttf_file_list:
-            ttf = ImageFont.truetype(ttf_file, fontsize)
+        for ttf_file in self.ttf_file_list:
+            ttf = self.font_pool.get(ttf_file, self.fontsize)
             print(" ".join(ttf.getname()))
             self.true_type_list.append(ttf)
 
@@ -71,6 +89,35 @@ class MultiPageTif(object):
         self.word_per_page = 50
         self.wrap_len = 12
 
+        # Optional Augmenter, degrading the rendered pages before they are saved
+        self.augmenter = augmenter
+        # Rendered pages not saved yet: (page_nb, image, chars, Nx4 box array in PIL coordinates, (font file, size))
+        self.pending_pages = []
+        # Number of rendered pages kept in memory before being augmented and saved
+        self.page_batch = 32
+        # Check every rendered page before it is saved, see page_check.py
+        self.check_pages = True
+        self.check_stats = {'pages': 0, 'rerendered': 0, 'dropped_chars': 0, 'dropped_pages': 0}
+        # Optional glyph_export.GlyphExporter receiving the glyphs of the saved pages
+        self.glyph_exporter = None
+        self.current_font = None
+        # Font size of every saved page, in page order
+        self.page_sizes = []
+
+        # Layout overrides, a dict with keys in LAYOUT_KEYS
+        for key, value in (layout or {}).items():
+            if key not in LAYOUT_KEYS:
+                raise ServiceException("unknown layout parameter %s" % key)
+            setattr(self, key, value)
+
+        # One box per character (legacy training) or one WordStr box per text line (LSTM training).
+        # Line pages hold a single line of wrap_len characters.
+        if box_level not in (BOX_LEVEL_CHAR, BOX_LEVEL_LINE):
+            raise ServiceException("box_level must be %s or %s" % (BOX_LEVEL_CHAR, BOX_LEVEL_LINE))
+        self.box_level = box_level
+        if box_level == BOX_LEVEL_LINE:
+            self.word_per_page = self.wrap_len
+
     def generate_tif(self):
         """ Create several individual tifs from text and merge them
             into a multi-page tif, and finally delete all individual tifs.
@@ -133,7 +180,7 @@ class MultiPageTif(object):
                     print('Generating individual tif image %s' % (self.indiv_page_prefix + str(page_nb) + '.tif'))
                 tif = self._new_tif()  # new page
                 draw = ImageDraw.Draw(tif)  # write on this new page
-            for word in self.text:
+            for word in self.text.split():
                 word += ' '  # add a space between each word
                 wordsize_w, wordsize_h = true_type.getsize(word)
                 # Check if word can fit the line, if not, newline
@@ -182,6 +229,29 @@ class MultiPageTif(object):
             char, tess_bottom_left[0], tess_bottom_left[1], tess_top_right[0], tess_top_right[1], page_nb)
         self.boxlines.append(boxline)
 
+    def _write_boxlines(self, chars, boxes, height, page_nb):
+        """ Append the boxfile lines of a whole page to self.boxlines
+        :param boxes: Nx4 array of [x0, y0, x1, y1] in PIL coordinates, one per char
+        """
+        boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+        if self.box_level == BOX_LEVEL_LINE:
+            self._write_line_boxlines("".join(chars), boxes, height, page_nb)
+            return
+        # left bottom right top, with (0, 0) at the bottom left corner for tesseract
+        tess = np.stack([boxes[:, 0], height - boxes[:, 3], boxes[:, 2], height - boxes[:, 1]], axis=1)
+        suffix = ' %d' % page_nb
+        self.boxlines.extend('%s %d %d %d %d' % (char, left, bottom, right, top) + suffix
+                             for char, (left, bottom, right, top) in zip(chars, tess.tolist()))
+
+    def _write_line_boxlines(self, line, boxes, height, page_nb):
+        """ Box lines of a text line for lstm.train: a WordStr box around the whole line
+            holding its text, then the end of line marker box
+        """
+        left, right = int(boxes[:, 0].min()), int(boxes[:, 2].max())
+        bottom, top = height - int(boxes[:, 3].max()), height - int(boxes[:, 1].min())
+        self.boxlines.append('WordStr %d %d %d %d %d #%s' % (left, bottom, right, top, page_nb, line))
+        self.boxlines.append('\t %d %d %d %d %d' % (right, bottom, right + 1, top, page_nb))
+
     def _multipage_tif(self):
         """ Generate a multipage tif from all the generated tifs.
             The multipage tif will be named {self.prefix}.tif
@@ -210,67 +280,184 @@ class MultiPageTif(object):
 
     def _new_fill_pages(self):
         word_per_page = self.word_per_page
-        text = "".join(self.text)
-        text = text.replace(" ", "")
-        # text = list(text)
-        # random.shuffle(text)
+        text = self.text
+        if re.search(r'\s', text):
+            text = "".join(text.split())
         word_len = len(text)
         page_sum = int(word_len / word_per_page) + (1 if word_len % word_per_page > 0 else 0)
         page_nb = 0
-        for true_type in self.true_type_list:
-            for index in range(page_sum):
-                sub_text = text[index * word_per_page:(index + 1) * word_per_page]
-                self._ttf_plot(true_type, sub_text, self.fontsize, page_nb, self.wrap_len)
-                page_nb += 1
+        chars = set(text)
+        for ttf_file in self.ttf_file_list:
+            # font file of the pages being drawn, pooled fonts are loaded from memory and have no path
+            self.current_font = ttf_file
+            for size in self.font_sizes:
+                true_type = self.font_pool.get(ttf_file, size)
+                # 格子宽度要容纳最宽的字和向左出头的字, 每种字体字号只量一次
+                extents = np.array([true_type.getbbox(char) for char in chars]).reshape(-1, 4)
+                ink_left = min(0, int(extents[:, 0].min()))
+                cell_width = max(size, int(extents[:, 2].max())) - ink_left
+                for index in range(page_sum):
+                    sub_text = text[index * word_per_page:(index + 1) * word_per_page]
+                    # page numbers stay contiguous when a page is dropped by the page check
+                    if self._ttf_plot(true_type, sub_text, size, page_nb, self.wrap_len, cell_width, ink_left):
+                        page_nb += 1
+        self._flush_pages()
+        stats = self.check_stats
+        if stats['rerendered'] or stats['dropped_pages'] or stats['dropped_chars']:
+            print("page check of %s: %d pages, %d drawn again, %d characters and %d pages dropped" % (
+                self.prefix, stats['pages'], stats['rerendered'], stats['dropped_chars'], stats['dropped_pages']))
+        if page_nb == 0:
+            raise ServiceException("no page of %s passed the page check" % self.prefix)
+        if self.augmenter is not None:
+            self.augmenter.close()
+
+    def _flush_pages(self):
+        """ Augment the pending pages if an augmenter is set, then write their
+            box lines and save them to disk.
+        """
+        pages = self.pending_pages
+        self.pending_pages = []
+        if not pages:
+            return
+        if self.augmenter is not None:
+            if self.verbose:
+                print("Augmenting %d pages" % len(pages))
+            augmented = self.augmenter.augment_pages(
+                [(page_nb, np.asarray(image), boxes) for page_nb, image, chars, boxes, source in pages])
+            pages = [(page_nb, Image.fromarray(array), chars, boxes, source)
+                     for (page_nb, _, chars, _, source), (array, boxes) in zip(pages, augmented)]
+        for page_nb, image, chars, boxes, source in pages:
+            self._write_boxlines(chars, boxes, image.size[1], page_nb)
+            self._save_tif(image, page_nb)
+            self.page_sizes.append(source[1])
+            if self.glyph_exporter is not None:
+                self.glyph_exporter.add_page(np.asarray(image), chars, boxes, *source)
 
-    def _ttf_plot(self, ttf_font, word: str, size: int, page_nb: int, wrap_len: int = 10):
+    def _ttf_plot(self, ttf_font, word: str, size: int, page_nb: int, wrap_len: int = 10, cell_width: int = None,
+                  ink_left: int = 0):
         """
         根据给的true type字体生成文字图片和对应的box文件
         :param ttf_font: ImageFont.FreeTypeFont实例
         :param word: 需要绘制的文字
         :param size: 文字大小，即绘制在size x size的一个方格中
         :param wrap_len: 每行最多绘制的文字数量，超过则自动换行
-        :return:
+        :param cell_width: 方格宽度, 默认size; 比size宽的字体(如拉丁字母W)传入最宽字的宽度
+        :param ink_left: 字形最左端相对绘制起点的位置(<=0), 字在方格中右移-ink_left
+        :return: 页面是否保留; 页面检查不通过且没有可用的字时丢弃该页
         """
         if self.verbose:
             print('Generating individual tif image %s' % (self.indiv_page_prefix + str(page_nb) + '.tif'))
-        row_gap = self.row_gap  # 行间距
-        col_gap = self.col_gap  # 列间距
+        render = (ttf_font, size, wrap_len, cell_width or size, ink_left)
+        image, boxes = self._render_page(word, *render)
+        if self.check_pages:
+            word, image, boxes = self._check_page(page_nb, word, image, boxes, render)
+            if not word:
+                return False
+        # 图片和box在_flush_pages中统一增强和存储
+        self.pending_pages.append((page_nb, image, list(word), boxes, (self.current_font, size)))
+        if len(self.pending_pages) >= self.page_batch:
+            self._flush_pages()
+        return True
+
+    def _render_page(self, word, ttf_font, size, wrap_len, cell_width, ink_left, extra=0):
+        """ Draw a page and derive the boxes of its characters from the ink
+        :param extra: 页边距和行列间距额外增加的像素
+        :return: (image, int32 array Nx4 of [x0, y0, x1, y1])
+        """
+        row_gap = self.row_gap + extra  # 行间距
+        col_gap = self.col_gap + extra  # 列间距
+        start_x, start_y = self.start_x + extra, self.start_y + extra
         # if word is None or len(word) == 0:
         word_len = len(word)
         row_num = int(word_len / wrap_len) + (1 if word_len % wrap_len > 0 else 0)
-        img_height = int(size * row_num + row_gap * row_num) + self.start_y*2  # 计算图片高度
+        img_height = int(size * row_num + row_gap * row_num) + start_y*2  # 计算图片高度
         col_num = 0
         if word_len < wrap_len:
             col_num = word_len
         else:
             col_num = wrap_len
-        img_width = int(col_num * size + col_gap * (col_num - 1)) + self.start_x*2  # 计算图片宽度
+        img_width = int(col_num * cell_width + col_gap * (col_num - 1)) + start_x*2  # 计算图片宽度
         image = Image.new("L", (img_width, img_height), 255)  # 生成空白图像
         draw = ImageDraw.Draw(image)  # 绘图句柄
-        box_array = list()  # 存放文字的box信息
-        y = self.start_y
-        for row in range(row_num):
-            # 计算文字左上角的坐标
-            x = self.start_x
-            for col in range(col_num):
-                index = row * wrap_len + col
-                if index >= word_len:
-                    break
-                char = word[index]
-                draw.text((x, y), char, font=ttf_font)  # 绘图
-                offsetx, offsety = ttf_font.getoffset(char)  # 获得文字的offset位置
-                width, height = ttf_font.getsize(char)  # 获得文件的大小
-                top_left =  [offsetx + x, offsety + y]
-                # top_left = [x, y]
-                bottom_right = [x + width, y + height]
-                # 写入box行
-                self._write_boxline(char, top_left, bottom_right, img_height, page_nb)
-                # 改变横坐标位置
-                x += width + col_gap
-            y += size + row_gap
-        # 存储图片
-        self._save_tif(image, page_nb)
+        # 每个字画在固定大小的格子里: 格子宽cell_width + col_gap, 高size + row_gap
+        pitch = (cell_width + col_gap, size + row_gap)
+        for index, char in enumerate(word):
+            row, col = divmod(index, col_num)
+            draw.text((start_x + col * pitch[0] - ink_left, start_y + row * pitch[1]), char, font=ttf_font)
+        # box取自绘制出的图片: 每个格子中墨迹的外接矩形 [x0, y0, x1, y1]
+        # 格子左移半个列间距, 上移1/4个行间距, 左侧出头的字(如J)和下沉的字(如g)都落在自己的格子里
+        grid_origin = (start_x - col_gap // 2, start_y - row_gap // 4)
+        boxes = ink_boxes(np.asarray(image), grid_origin, pitch, (row_num, col_num))[:word_len]
+        # 没有墨迹的格子退回到整个字的方格, 由页面检查剔除
+        empty = boxes[:, 0] < 0
+        if empty.any():
+            cells = np.arange(word_len)[empty]
+            x0 = start_x + (cells % col_num) * pitch[0]
+            y0 = start_y + (cells // col_num) * pitch[1]
+            boxes[empty] = np.stack([x0, y0, x0 + cell_width, y0 + size], axis=1)
+        return image, boxes
+
+    def _check_page(self, page_nb, word, image, boxes, render):
+        """ Pre-flight check of a rendered page (see page_check.py). A page with clipped glyphs,
+            stray ink or overlapping boxes is drawn again with more spacing, then the characters
+            which still fail are removed from the page.
+        :return: (word, image, boxes) to keep, word is empty if the page is dropped
+        """
+        report = check_page(np.asarray(image), boxes, page_nb)
+        self.check_stats['pages'] += 1
+        if report.ok:
+            return word, image, boxes
+        print("page %d of %s: %s" % (page_nb, self.prefix, report.describe()))
+        extra = 0
+        if report.page_issue or report.box_issues['overlap'].any():
+            extra = render[1] // 2
+            image, boxes = self._render_page(word, *render, extra=extra)
+            report = check_page(np.asarray(image), boxes, page_nb)
+            self.check_stats['rerendered'] += 1
+        if not report.page_issue and report.bad_boxes.any():
+            bad = report.bad_boxes
+            self.check_stats['dropped_chars'] += int(bad.sum())
+            word = "".join(char for char, drop in zip(word, bad) if not drop)
+            if word:
+                image, boxes = self._render_page(word, *render, extra=extra)
+                report = check_page(np.asarray(image), boxes, page_nb)
+        if not word or not report.ok:
+            self.check_stats['dropped_pages'] += 1
+            return "", None, None
+        return word, image, boxes
+
+
+def ink_boxes(page, origin, pitch, shape, threshold=128):
+    """ Tight bounding boxes of the ink in each cell of a regular grid
+    :param page: uint8 array HxW, dark ink on a light background
+    :param origin: (x, y) of the top-left corner of the first cell
+    :param pitch: (width, height) of a cell
+    :param shape: (rows, cols) of the grid
+    :return: int32 array (rows * cols)x4 of [x0, y0, x1, y1] in page coordinates, in row major
+             order, x1/y1 exclusive. Cells without ink are [-1, -1, -1, -1].
+             Ink overflowing its cell is counted in the neighbouring cell.
+    """
+    rows, cols = shape
+    pitch_x, pitch_y = pitch
+    origin_x, origin_y = origin
+    grid_h, grid_w = rows * pitch_y, cols * pitch_x
+    # the grid may extend beyond the page on any side
+    pad_top, pad_left = max(0, -origin_y), max(0, -origin_x)
+    ink = page[max(0, origin_y):origin_y + grid_h, max(0, origin_x):origin_x + grid_w] < threshold
+    ink = np.pad(ink, ((pad_top, grid_h - pad_top - ink.shape[0]), (pad_left, grid_w - pad_left - ink.shape[1])))
+    cells = ink.reshape(rows, pitch_y, cols, pitch_x)
+    ink_cols = cells.any(axis=1)  # rows x cols x pitch_x
+    ink_rows = cells.any(axis=3).transpose(0, 2, 1)  # rows x cols x pitch_y
+    x0 = ink_cols.argmax(axis=2)
+    x1 = pitch_x - ink_cols[:, :, ::-1].argmax(axis=2)
+    y0 = ink_rows.argmax(axis=2)
+    y1 = pitch_y - ink_rows[:, :, ::-1].argmax(axis=2)
+    cell_x = origin_x + np.arange(cols) * pitch_x
+    cell_y = origin_y + np.arange(rows) * pitch_y
+    boxes = np.stack([x0 + cell_x[None, :], y0 + cell_y[:, None],
+                      x1 + cell_x[None, :], y1 + cell_y[:, None]], axis=2).reshape(-1, 4).astype(np.int32)
+    boxes[~ink_cols.any(axis=2).reshape(-1)] = -1
+    return boxes
 
 
 # Utility functions
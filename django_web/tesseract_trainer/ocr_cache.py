@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent cache of OCR results.
+
+Evaluations and regression runs recognize the same check pages again and again while most
+of the time neither the page nor the model changed. A recognized text is stored in a SQLite
+database under:
+
+- the hash of the page content (pixels, shape and type),
+- the hash of the model: tesseract version and content of every traineddata of the
+  language ("chi_sim+eng" has two), in order,
+- the psm and extra configuration.
+
+The language names are not part of the key: traineddata files with the same content share
+their results whatever their name (the combinations of a sweep are named apart). Replacing
+a traineddata or upgrading tesseract changes the model hash, the pages are then recognized
+again. When the traineddata can not be located the results are not cached.
+
+The database holds at most max_entries results, the least recently used ones are evicted.
+"""
+import hashlib
+import os
+import sqlite3
+import subprocess
+import time
+
+from django_web.util.file_util import file_hash
+
+MAX_ENTRIES = 200000  # Default maximum number of cached results
+
+# results of the first version were also keyed by language name, they are dropped
+_SCHEMA = """
+DROP TABLE IF EXISTS results;
+CREATE TABLE IF NOT EXISTS texts (
+    page TEXT NOT NULL,
+    model TEXT NOT NULL,
+    psm INTEGER NOT NULL,
+    config TEXT NOT NULL,
+    text TEXT NOT NULL,
+    used REAL NOT NULL,
+    PRIMARY KEY (page, model, psm, config)
+);
+CREATE INDEX IF NOT EXISTS texts_used ON texts (used);
+"""
+
+# tesseract command -> (version, default tessdata directory), asked once per process
+_engine_memo = dict()
+
+
+class OcrCache(object):
+    """ OCR results keyed by page, model content and psm, with LRU eviction """
+
+    def __init__(self, db_path, max_entries=MAX_ENTRIES, tesseract_cmd='tesseract'):
+        """
+        :param db_path: sqlite数据库路径, 不存在时创建
+        :param max_entries: 最多缓存的识别结果数, 超过后删除最久未使用的结果
+        :param tesseract_cmd: tesseract命令, 用于获取版本和默认tessdata目录
+        """
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.tesseract_cmd = tesseract_cmd
+        self.hits = 0
+        self.misses = 0
+        self.uncached = 0
+        folder = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(folder, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.executescript(_SCHEMA)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+
+    @staticmethod
+    def page_hash(page):
+        """ Hash of a page given as an array """
+        sha = hashlib.sha256()
+        sha.update(("%s %s\n" % (page.dtype.str, page.shape)).encode('ascii'))
+        sha.update(memoryview(page.tobytes()))
+        return sha.hexdigest()
+
+    def model_hash(self, lang, tessdata_dir=None):
+        """ Hash of the tesseract version and of the content of the traineddata files of a language,
+        their names left out
+        :return: hex digest, None if a traineddata can not be found
+        """
+        version, default_dir = self._engine()
+        sha = hashlib.sha256(version.encode('utf-8'))
+        for name in lang.split('+'):
+            path = find_traineddata(name, tessdata_dir, default_dir)
+            if path is None:
+                return None
+            sha.update(("%s\n" % file_hash(path)).encode('ascii'))
+        return sha.hexdigest()
+
+    def _engine(self):
+        engine = _engine_memo.get(self.tesseract_cmd)
+        if engine is None:
+            engine = _engine_memo[self.tesseract_cmd] = _ask_engine(self.tesseract_cmd)
+        return engine
+
+    def get_many(self, pages, model, psm, config=''):
+        """ Cached texts of pages
+        :param pages: list of page hashes
+        :return: dict page hash -> text, for the pages found
+        """
+        found = {}
+        if model is None:
+            return found
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for page in set(pages):
+                row = conn.execute("SELECT text FROM texts WHERE page = ? AND model = ? AND psm = ? AND config = ?",
+                                   (page, model, psm, config)).fetchone()
+                if row is not None:
+                    found[page] = row[0]
+                    conn.execute("UPDATE texts SET used = ? WHERE page = ? AND model = ? AND psm = ? AND config = ?",
+                                 (now, page, model, psm, config))
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return found
+
+    def put_many(self, texts, model, psm, config=''):
+        """ Store texts
+        :param texts: dict page hash -> text
+        """
+        if model is None or not texts:
+            return
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("INSERT OR REPLACE INTO texts (page, model, psm, config, text, used) "
+                             "VALUES (?, ?, ?, ?, ?, ?)",
+                             [(page, model, psm, config, text, now) for page, text in texts.items()])
+            extra = conn.execute("SELECT COUNT(*) FROM texts").fetchone()[0] - self.max_entries
+            if extra > 0:
+                conn.execute("DELETE FROM texts WHERE rowid IN "
+                             "(SELECT rowid FROM texts ORDER BY used LIMIT ?)", (extra,))
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def recognize(self, pages, lang, psm, ocr, tessdata_dir=None, config=''):
+        """ Texts of pages, recognizing only the pages which are not cached
+        :param pages: list of page arrays
+        :param ocr: function page -> text
+        """
+        model = self.model_hash(lang, tessdata_dir)
+        keys = [self.page_hash(page) for page in pages]
+        found = self.get_many(keys, model, psm, config)
+        texts = []
+        new = {}
+        for page, key in zip(pages, keys):
+            text = found.get(key)
+            if text is None:
+                text = new.get(key)
+            if text is None:
+                text = new[key] = ocr(page)
+                if model is None:
+                    self.uncached += 1
+                else:
+                    self.misses += 1
+            else:
+                self.hits += 1
+            texts.append(text)
+        self.put_many(new, model, psm, config)
+        return texts
+
+    def stats(self):
+        looked_up = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'uncached': self.uncached,
+                'hit_rate': float(self.hits) / looked_up if looked_up else 0.0}
+
+    def describe(self):
+        stats = self.stats()
+        return "ocr cache: %d hits, %d misses (hit rate %.1f%%), %d uncached" % (
+            stats['hits'], stats['misses'], 100.0 * stats['hit_rate'], stats['uncached'])
+
+
+def find_traineddata(lang, tessdata_dir=None, default_dir=None):
+    """ Path of {lang}.traineddata in tessdata_dir, else where tesseract looks for it """
+    folders = [tessdata_dir] if tessdata_dir else []
+    prefix = os.environ.get('TESSDATA_PREFIX')
+    if prefix:
+        folders += [prefix, os.path.join(prefix, 'tessdata')]
+    if default_dir:
+        folders.append(default_dir)
+    for folder in folders:
+        path = os.path.join(folder, '%s.traineddata' % lang)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _ask_engine(tesseract_cmd):
+    """ (version, default tessdata directory) of a tesseract command """
+    try:
+        version = subprocess.run([tesseract_cmd, '--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        langs = subprocess.run([tesseract_cmd, '--list-langs'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError:
+        return 'unknown', None
+    # tesseract 3 writes its version to stderr
+    version_line = 'unknown'
+    if version.returncode == 0:
+        version_line = version.stdout.decode('utf-8', 'replace').strip().split('\n')[0]
+    # first line: List of available languages in "/usr/share/tesseract-ocr/4.00/tessdata/" (N):
+    default_dir = None
+    first = langs.stdout.decode('utf-8', 'replace').strip().split('\n')[0]
+    if '"' in first:
+        default_dir = first.split('"')[1]
+    return version_line, default_dir
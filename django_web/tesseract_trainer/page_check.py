@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pre-flight check of the rendered pages, before tesseract box.train runs on them.
+
+box.train is the most expensive stage and it fails, or silently learns wrong samples,
+on pages where a glyph is clipped by the page size, a character rendered nothing (missing
+glyph), a box lies outside of the image or boxes overlap. check_page measures, for all
+the boxes of a page at once (summed-area table of the ink, pairwise box intersections):
+
+- outside:   box outside of the image or empty
+- empty:     no ink in the box
+- sparse:    ink density of the box below min_density
+- overlap:   box intersecting another box of the page
+- clipped:   ink touching the border of the page (page level)
+- stray ink: ink outside of every box (page level)
+
+MultiPageTif renders a page again with more spacing when it has page level issues or
+overlapping boxes, then drops the characters which still fail, and the page if none is left.
+
+usage, on pages already rendered:
+    python -m django_web.tesseract_trainer.page_check lang.font.exp0.tif lang.font.exp0.box
+"""
+import argparse
+import sys
+from collections import OrderedDict
+
+from django_web.util.lazy_import import LazyModule
+
+np = LazyModule("numpy")
+
+INK_THRESHOLD = 128  # Default gray level below which a pixel is ink
+MIN_DENSITY = 0.02  # Default minimum ratio of ink pixels in a box
+MAX_STRAY = 0  # Default number of ink pixels allowed outside of the boxes
+
+BOX_ISSUES = ('outside', 'empty', 'sparse', 'overlap')
+PAGE_ISSUES = ('clipped', 'stray_ink')
+
+
+class PageReport(object):
+    """ Result of the check of one page """
+
+    def __init__(self, page_nb, box_issues, clipped, stray_ink):
+        """
+        :param box_issues: dict issue -> bool array, one flag per box
+        """
+        self.page_nb = page_nb
+        self.box_issues = box_issues
+        self.clipped = clipped
+        self.stray_ink = stray_ink
+
+    @property
+    def bad_boxes(self):
+        """ bool array: boxes with at least one issue """
+        flags = list(self.box_issues.values())
+        bad = flags[0].copy()
+        for flag in flags[1:]:
+            bad |= flag
+        return bad
+
+    @property
+    def page_issue(self):
+        """ True if the page itself is bad: clipped glyphs or ink outside of the boxes """
+        return self.clipped or self.stray_ink > 0
+
+    @property
+    def ok(self):
+        return not self.page_issue and not self.bad_boxes.any()
+
+    def counts(self):
+        counts = OrderedDict((issue, int(flag.sum())) for issue, flag in self.box_issues.items())
+        counts['clipped'] = int(self.clipped)
+        counts['stray_ink'] = int(self.stray_ink)
+        return counts
+
+    def describe(self):
+        return ", ".join("%s %d" % (issue, count) for issue, count in self.counts().items() if count)
+
+
+def check_page(page, boxes, page_nb=0, threshold=INK_THRESHOLD, min_density=MIN_DENSITY, max_stray=MAX_STRAY):
+    """ Check the boxes of a rendered page against its ink
+    :param page: uint8 array HxW, dark ink on a light background
+    :param boxes: Nx4 array of [x0, y0, x1, y1] in image coordinates, x1/y1 exclusive
+    :return: PageReport
+    """
+    ink = np.asarray(page) < threshold
+    height, width = ink.shape
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    x0, y0, x1, y1 = boxes.T
+    outside = (x0 < 0) | (y0 < 0) | (x1 > width) | (y1 > height) | (x1 <= x0) | (y1 <= y0)
+    cx0, cx1 = np.clip(x0, 0, width), np.clip(x1, 0, width)
+    cy0, cy1 = np.clip(y0, 0, height), np.clip(y1, 0, height)
+
+    # ink of every box from the summed-area table
+    integral = np.zeros((height + 1, width + 1), dtype=np.int32)
+    ink.cumsum(axis=0, dtype=np.int32, out=integral[1:, 1:])
+    integral[1:, 1:].cumsum(axis=1, out=integral[1:, 1:])
+    box_ink = integral[cy1, cx1] - integral[cy0, cx1] - integral[cy1, cx0] + integral[cy0, cx0]
+    area = np.maximum((cx1 - cx0) * (cy1 - cy0), 1)
+    empty = box_ink == 0
+    sparse = ~empty & (box_ink < min_density * area)
+
+    # pairwise intersections
+    inter_w = np.minimum(x1[:, None], x1[None, :]) - np.maximum(x0[:, None], x0[None, :])
+    inter_h = np.minimum(y1[:, None], y1[None, :]) - np.maximum(y0[:, None], y0[None, :])
+    intersect = (inter_w > 0) & (inter_h > 0)
+    np.fill_diagonal(intersect, False)
+    overlap = intersect.any(axis=1)
+
+    clipped = bool(ink[0].any() or ink[-1].any() or ink[:, 0].any() or ink[:, -1].any())
+
+    # pixels covered by at least one box: a page holds tens of boxes, painting the slices is
+    # cheaper than the cumulative sums of a difference array over the whole page
+    covered = np.zeros_like(ink)
+    for bx0, by0, bx1, by1 in zip(cx0.tolist(), cy0.tolist(), cx1.tolist(), cy1.tolist()):
+        covered[by0:by1, bx0:bx1] = True
+    stray = int(integral[-1, -1]) - int(np.count_nonzero(ink & covered))
+
+    box_issues = OrderedDict([('outside', outside), ('empty', empty), ('sparse', sparse), ('overlap', overlap)])
+    return PageReport(page_nb, box_issues, clipped, stray if stray > max_stray else 0)
+
+
+def read_boxfile(box_path):
+    """ Box lines of a box file, grouped by page
+    :return: dict page number -> (list of chars, Nx4 array of tesseract coordinates left bottom right top)
+    """
+    pages = {}
+    with open(box_path, 'r', encoding='UTF-8') as fp:
+        for line in fp:
+            fields = line.rstrip('\n').rsplit(' ', 5)
+            if len(fields) != 6:
+                continue
+            char, left, bottom, right, top, page_nb = fields
+            chars, coords = pages.setdefault(int(page_nb), ([], []))
+            chars.append(char)
+            coords.append((int(left), int(bottom), int(right), int(top)))
+    return dict((page_nb, (chars, np.array(coords, dtype=np.int64).reshape(-1, 4)))
+                for page_nb, (chars, coords) in pages.items())
+
+
+def check_files(tif_path, box_path, **kwargs):
+    """ Check a multi-page tif against its box file
+    :return: list of PageReport, one per page of the tif
+    """
+    from PIL import Image
+
+    boxes_by_page = read_boxfile(box_path)
+    reports = []
+    with Image.open(tif_path) as tif:
+        for page_nb in range(getattr(tif, 'n_frames', 1)):
+            tif.seek(page_nb)
+            page = np.asarray(tif.convert('L'))
+            chars, coords = boxes_by_page.get(page_nb, ([], np.zeros((0, 4), dtype=np.int64)))
+            height = page.shape[0]
+            # back to image coordinates, (0, 0) at the top left corner
+            boxes = np.stack([coords[:, 0], height - coords[:, 3], coords[:, 2], height - coords[:, 1]], axis=1)
+            reports.append(check_page(page, boxes, page_nb, **kwargs))
+    return reports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check rendered training pages against their box file.')
+    parser.add_argument('tif', help="multi-page tif")
+    parser.add_argument('box', help="box file of the tif")
+    parser.add_argument('--min-density', type=float, default=MIN_DENSITY)
+    args = parser.parse_args(argv)
+    reports = check_files(args.tif, args.box, min_density=args.min_density)
+    bad = [r for r in reports if not r.ok]
+    for report in bad:
+        print("page %d: %s" % (report.page_nb, report.describe()))
+    print("%d pages, %d with issues" % (len(reports), len(bad)))
+    return 1 if bad else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+"""
+Atomic, versioned publishing of traineddata files.
+
+Copying a new {lang}.traineddata over the live file lets a running OCR process read a
+torn model. The ArtifactStore keeps every published model in a content-addressed
+directory of tessdata:
+
+    tessdata/{lang}.traineddata                           live file, for plain tesseract
+    tessdata/.versions/{lang}/{digest}/{lang}.traineddata  one directory per version
+    tessdata/.versions/{lang}/manifest.json               current version and history
+
+Every file is written to a temporary name and renamed into place, so readers see either
+the old or the new model. A version directory is never modified once created: recognizers
+load the model with --tessdata-dir pointing at the current version directory, and a
+ModelWatcher tells them when the manifest changes so they can switch without restart.
+Rollback only rewrites the manifest and relinks the live file.
+
+usage:
+    python -m django_web.tesseract_trainer.publish list TESSDATA LANG
+    python -m django_web.tesseract_trainer.publish publish TESSDATA LANG FILE
+    python -m django_web.tesseract_trainer.publish rollback TESSDATA LANG [DIGEST]
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+from contextlib import contextmanager
+
+from django_web.model import ServiceException
+from django_web.util.file_util import file_hash
+
+try:
+    import fcntl
+except ImportError:  # windows: publishers are not serialized
+    fcntl = None
+
+VERSIONS_DIR = '.versions'
+MANIFEST_NAME = 'manifest.json'
+DIGEST_LEN = 16  # number of hex digits of the sha256 naming a version directory
+
+
+class ArtifactStore(object):
+    """ Versioned traineddata store living in a tessdata directory """
+
+    def __init__(self, tessdata_path):
+        if not os.path.isdir(tessdata_path):
+            raise ServiceException("The %s directory does not exist. Aborting." % tessdata_path)
+        self.tessdata_path = tessdata_path
+
+    def lang_dir(self, lang):
+        return os.path.join(self.tessdata_path, VERSIONS_DIR, lang)
+
+    def version_dir(self, lang, digest):
+        """ The directory to use as --tessdata-dir to load this version """
+        return os.path.join(self.lang_dir(lang), digest)
+
+    def manifest(self, lang):
+        """ Manifest of a language: {"lang", "version", "current", "history": [...]} """
+        manifest_path = os.path.join(self.lang_dir(lang), MANIFEST_NAME)
+        if not os.path.exists(manifest_path):
+            return {'lang': lang, 'version': 0, 'current': None, 'history': []}
+        with open(manifest_path, 'r') as fp:
+            return json.load(fp)
+
+    def publish(self, lang, traineddata_path):
+        """ Store a traineddata file as a new version of lang and make it the current one
+        :return: digest of the published version
+        """
+        digest = file_hash(traineddata_path)[:DIGEST_LEN]
+        with self._locked(lang):
+            version_dir = self.version_dir(lang, digest)
+            if not os.path.exists(version_dir):
+                # fill a temporary directory, then rename it: a version directory is always complete
+                tmp_dir = "%s.%d.tmp" % (version_dir, os.getpid())
+                os.makedirs(tmp_dir)
+                target = os.path.join(tmp_dir, '%s.traineddata' % lang)
+                shutil.copyfile(traineddata_path, target)
+                _fsync(target)
+                os.rename(tmp_dir, version_dir)
+            manifest = self.manifest(lang)
+            history = [entry for entry in manifest['history'] if entry['digest'] != digest]
+            history.append({'digest': digest,
+                            'published_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+                            'source': os.path.abspath(traineddata_path),
+                            'size': os.path.getsize(traineddata_path)})
+            self._activate(lang, digest, manifest, history)
+        return digest
+
+    def rollback(self, lang, digest=None):
+        """ Make a previous version current again
+        :param digest: version to restore, default: the one published before the current one
+        :return: digest of the restored version
+        """
+        with self._locked(lang):
+            manifest = self.manifest(lang)
+            digests = [entry['digest'] for entry in manifest['history']]
+            if digest is None:
+                if manifest['current'] not in digests or digests.index(manifest['current']) == 0:
+                    raise ServiceException("no previous version of %s to roll back to" % lang)
+                digest = digests[digests.index(manifest['current']) - 1]
+            elif digest not in digests:
+                raise ServiceException("unknown version %s of %s" % (digest, lang))
+            self._activate(lang, digest, manifest, manifest['history'])
+        return digest
+
+    def current_dir(self, lang):
+        """ tessdata directory of the current version, None if lang was never published here """
+        digest = self.manifest(lang)['current']
+        return self.version_dir(lang, digest) if digest else None
+
+    def _activate(self, lang, digest, manifest, history):
+        # live file first, then the manifest watched by the recognizers
+        source = os.path.join(self.version_dir(lang, digest), '%s.traineddata' % lang)
+        live = os.path.join(self.tessdata_path, '%s.traineddata' % lang)
+        tmp_live = os.path.join(self.tessdata_path, '.%s.traineddata.%d.tmp' % (lang, os.getpid()))
+        try:
+            os.link(source, tmp_live)
+        except OSError:
+            shutil.copyfile(source, tmp_live)
+            _fsync(tmp_live)
+        os.replace(tmp_live, live)
+        manifest = dict(manifest)
+        manifest.update({'lang': lang, 'version': manifest['version'] + 1, 'current': digest, 'history': history})
+        manifest_path = os.path.join(self.lang_dir(lang), MANIFEST_NAME)
+        tmp_manifest = "%s.%d.tmp" % (manifest_path, os.getpid())
+        with open(tmp_manifest, 'w') as fp:
+            json.dump(manifest, fp, indent=2)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_manifest, manifest_path)
+
+    @contextmanager
+    def _locked(self, lang):
+        lang_dir = self.lang_dir(lang)
+        if not os.path.exists(lang_dir):
+            os.makedirs(lang_dir, exist_ok=True)
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(lang_dir, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class ModelWatcher(object):
+    """ Follows the manifest of a language, for recognizers swapping models without restart """
+
+    def __init__(self, tessdata_path, lang, interval=1.0):
+        """
+        :param interval: 两次检查manifest之间的最小间隔(秒)
+        """
+        self.store = ArtifactStore(tessdata_path)
+        self.lang = lang
+        self.interval = interval
+        self.manifest_path = os.path.join(self.store.lang_dir(lang), MANIFEST_NAME)
+        self._checked_at = 0
+        self._mtime = None
+        self.version = 0
+        self.digest = None
+        self.listeners = []
+
+    def tessdata_dir(self):
+        """ tessdata directory holding the current model of the language.
+            Falls back to the tessdata directory itself for a language never published through the store.
+        """
+        self.check()
+        return self.store.version_dir(self.lang, self.digest) if self.digest else self.store.tessdata_path
+
+    def check(self):
+        """ Reload the manifest if it changed, and notify the listeners
+        :return: True if the current version changed
+        """
+        now = time.time()
+        if now - self._checked_at < self.interval:
+            return False
+        self._checked_at = now
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        manifest = self.store.manifest(self.lang)
+        changed = manifest['current'] != self.digest
+        self.version, self.digest = manifest['version'], manifest['current']
+        if changed:
+            for listener in self.listeners:
+                listener(self.lang, self.digest, self.tessdata_dir())
+        return changed
+
+
+def _fsync(file_path):
+    with open(file_path, 'rb') as fp:
+        os.fsync(fp.fileno())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Publish, list and roll back traineddata versions.')
+    parser.add_argument('action', choices=['list', 'publish', 'rollback'])
+    parser.add_argument('tessdata_path')
+    parser.add_argument('lang')
+    parser.add_argument('target', nargs='?', help="traineddata file to publish, or digest to roll back to")
+    args = parser.parse_args(argv)
+
+    store = ArtifactStore(args.tessdata_path)
+    if args.action == 'publish':
+        if not args.target:
+            parser.error("publish needs a traineddata file")
+        print(store.publish(args.lang, args.target))
+    elif args.action == 'rollback':
+        print(store.rollback(args.lang, args.target))
+    else:
+        manifest = store.manifest(args.lang)
+        for entry in manifest['history']:
+            flag = '*' if entry['digest'] == manifest['current'] else ' '
+            print("%s %s  %s  %10d  %s" % (flag, entry['digest'], entry['published_at'], entry['size'],
+                                           entry['source']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
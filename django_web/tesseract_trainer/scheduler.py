@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+
+"""
+Admission control of the tesseract stage processes of a host.
+
+Fonts, shards and batch jobs run in parallel, and box.train, mftraining, shapeclustering or
+lstmtraining processes compete for memory: mftraining on a large CJK unicharset takes
+gigabytes, and too many of them at once get the host OOM-killed. Every stage process is
+started through a ResourceScheduler, which admits it only when it fits:
+
+- its memory estimate, added to the estimates of the running stages, stays under
+  memory_budget;
+- MemAvailable, minus what the running stages are still expected to take (their estimate
+  minus their current RSS), keeps at least min_free bytes free;
+- the threads of the running stages stay within cpu_budget (the cpus of the host): a stage
+  takes one cpu slot, lstmtraining takes the slots free when it starts, at most max_threads
+  (half of cpu_budget by default) so that the other stages keep some.
+
+Each stage process gets its thread budget, its number of slots, through OMP_THREAD_LIMIT,
+OMP_NUM_THREADS and the BLAS equivalents: tesseract built with OpenMP otherwise starts a
+thread per core in every process, and parallel stages thrash. With pin_cpus, a stage is also
+bound to its own cpus (sched_setaffinity in the child before it execs, so that no thread starts
+elsewhere), picked among the cpus no other stage holds.
+
+A stage which does not fit waits until running stages finish. Waiting stages hold a ticket in
+the ledger and are admitted strictly in ticket order: a later, smaller stage never overtakes
+the oldest waiter, so a large stage (mftraining, lstmtraining) can not starve behind a stream
+of small ones. A stage is always admitted when nothing else runs, so that an estimate larger
+than the budget never blocks.
+
+Running and waiting stages are recorded in a ledger file shared by all the processes of the host (batch
+workers, job queue workers, the shard threads of an LSTM training), under an fcntl lock.
+The peak RSS of every finished stage (VmHWM sampled while it runs) is stored in an estimates
+file: the estimate of a stage is the largest of its recent peaks plus a margin, per size
+bucket (number of characters...), and a default value until the stage has run once.
+
+Budgets can be set for the processes started later through the environment:
+    TESSER_MEMORY_BUDGET (MB), TESSER_CPU_BUDGET, TESSER_MAX_THREADS, TESSER_PIN_CPUS (1 to pin)
+
+usage:
+    python -m django_web.tesseract_trainer.scheduler status   # running stages and estimates
+"""
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # windows: stages are started without admission control
+    fcntl = None
+
+MB = 1024 * 1024
+LEDGER_PATH = os.path.join(tempfile.gettempdir(), 'tesser_train_ledger.json')  # Default ledger of the host
+ESTIMATES_PATH = os.path.join(os.path.expanduser('~'), '.tesser_train', 'stage_memory.json')  # Default estimates
+MEMORY_FRACTION = 0.8  # Default memory budget, part of the total memory of the host
+MIN_FREE = 256 * MB  # Default memory left free for everything else
+POLL_SECONDS = 0.5  # Wait between two admission attempts
+SAMPLE_SECONDS = 0.2  # Wait between two samples of the memory of a running stage
+HISTORY = 20  # peaks kept per stage and size bucket
+MARGIN = 1.25  # estimate = largest recent peak * MARGIN
+MEMORY_BUDGET_ENV = 'TESSER_MEMORY_BUDGET'
+CPU_BUDGET_ENV = 'TESSER_CPU_BUDGET'
+MAX_THREADS_ENV = 'TESSER_MAX_THREADS'
+PIN_CPUS_ENV = 'TESSER_PIN_CPUS'
+# thread limits of the OpenMP runtime and of the BLAS libraries tesseract may be linked with
+THREAD_VARS = ('OMP_THREAD_LIMIT', 'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+# cpu slots of a stage, 1 when not listed; 0: the slots free when the stage starts, at most max_threads
+STAGE_THREADS = {
+    'lstmtraining': 0,
+}
+
+# memory of a stage never run on this host
+DEFAULT_ESTIMATES = {
+    'tesseract': 400 * MB,
+    'box.train': 400 * MB,
+    'lstm.train': 600 * MB,
+    'unicharset_extractor': 100 * MB,
+    'shapeclustering': 2048 * MB,
+    'mftraining': 2048 * MB,
+    'cntraining': 512 * MB,
+    'combine_tessdata': 256 * MB,
+    'lstmtraining': 2048 * MB,
+}
+DEFAULT_ESTIMATE = 512 * MB
+
+
+class ResourceScheduler(object):
+    """ Start stage processes within a memory and cpu budget shared by the host """
+
+    def __init__(self, memory_budget=None, cpu_budget=None, min_free=MIN_FREE, ledger_path=LEDGER_PATH,
+                 estimates_path=ESTIMATES_PATH, pin_cpus=False, max_threads=None):
+        """
+        :param memory_budget: 所有阶段进程的内存预算(byte), 默认主机内存的MEMORY_FRACTION
+        :param cpu_budget: 所有阶段进程的线程总数上限, 默认本进程可用的cpu数
+        :param min_free: 保留给其他程序的空闲内存(byte)
+        :param ledger_path: 记录本机正在运行的阶段的文件, 本机所有训练进程共用
+        :param estimates_path: 各阶段历史内存峰值文件
+        :param pin_cpus: 是否把每个阶段进程绑定到各自的cpu上
+        :param max_threads: 占用空闲cpu的阶段(lstmtraining)最多使用的线程数, 默认cpu_budget的一半
+        """
+        total = _meminfo().get('MemTotal')
+        if memory_budget is None and total:
+            memory_budget = int(total * MEMORY_FRACTION)
+        self.memory_budget = memory_budget
+        self.cpus = _allowed_cpus()
+        self.cpu_budget = cpu_budget or len(self.cpus)
+        self.max_threads = max_threads or max(1, self.cpu_budget // 2)
+        self.pin_cpus = pin_cpus and hasattr(os, 'sched_setaffinity')
+        self.min_free = min_free
+        self.ledger_path = ledger_path
+        self.estimates_path = estimates_path
+        self.waited = 0.0
+
+    # --- public api ---
+
+    def run(self, stage, cmd, cwd=None, size=None, env=None, threads=None):
+        """ Run a stage process once it is admitted
+        :param stage: stage name, key of the learned estimates (box.train, mftraining...)
+        :param cmd: command, a list of arguments
+        :param size: optional size of the input (number of characters...), estimates are kept per
+            power of two of size
+        :param threads: cpu slots of the stage, default STAGE_THREADS; 0: the free slots, at most max_threads
+        :return: subprocess.CompletedProcess with stdout and stderr as bytes
+        """
+        if threads is None:
+            threads = STAGE_THREADS.get(stage, 1)
+        if fcntl is None:
+            return subprocess.run(cmd, cwd=cwd, env=_thread_env(env, threads or self.max_threads),
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        key = _estimate_key(stage, size)
+        estimate = self.estimate(stage, size)
+        token, entry = self._admit(stage, estimate, threads)
+        try:
+            run, peak = self._spawn(token, entry, cmd, cwd, env)
+        finally:
+            self._release(token)
+        if peak:
+            self._learn(key, peak)
+        return run
+
+    def estimate(self, stage, size=None):
+        """ Expected peak memory of a stage, in bytes """
+        estimates = _read_json(self.estimates_path)
+        peaks = estimates.get(_estimate_key(stage, size))
+        if peaks:
+            return int(max(peaks) * MARGIN)
+        if size:
+            # closest smaller bucket of the stage, scaled linearly to the size
+            bucket = _bucket(size)
+            known = [(b, max(p)) for b, p in ((_key_bucket(k, stage), p) for k, p in estimates.items())
+                     if b is not None and b < bucket]
+            if known:
+                b, peak = max(known)
+                return int(peak * MARGIN * 2 ** (bucket - b))
+        return DEFAULT_ESTIMATES.get(stage, DEFAULT_ESTIMATE)
+
+    def running(self):
+        """ Stages running on the host: list of ledger entries with their current rss """
+        with self._ledger() as ledger:
+            entries = _admitted(ledger)
+        for entry in entries:
+            entry['rss'] = _rss(entry['child']) if entry['child'] else 0
+        return entries
+
+    # --- admission ---
+
+    def waiting(self):
+        """ Stages waiting for admission on the host, oldest ticket first """
+        with self._ledger() as ledger:
+            return [ledger[token] for token in _tickets(ledger)]
+
+    def _admit(self, stage, estimate, threads):
+        """ Take a ticket, wait until it is the oldest one and the stage fits, then record it in the ledger
+        :return: (token, ledger entry)
+        """
+        token = uuid.uuid4().hex
+        ticket = {'owner': os.getpid(), 'child': None, 'stage': stage, 'memory': estimate, 'threads': threads,
+                  'cores': [], 'since': time.time(), 'waiting': True}
+        start = time.time()
+        reported = False
+        try:
+            while True:
+                with self._ledger() as ledger:
+                    ledger.setdefault(token, ticket)
+                    older = _tickets(ledger).index(token)
+                    if older:
+                        reason = "%d older stages waiting" % older
+                    else:
+                        reason = self._refusal(ledger, estimate, threads)
+                    if reason is None:
+                        entry = ledger[token] = self._entry(ledger, stage, estimate, threads)
+                        break
+                if not reported:
+                    print("**** %s (%.0f MB expected) waits: %s" % (stage, estimate / float(MB), reason))
+                    reported = True
+                time.sleep(POLL_SECONDS)
+        except BaseException:
+            # the ticket must not hold back the stages behind it
+            self._release(token)
+            raise
+        waited = time.time() - start
+        self.waited += waited
+        if reported:
+            print("**** %s admitted after %.1fs" % (stage, waited))
+        return token, entry
+
+    def _entry(self, ledger, stage, estimate, threads):
+        """ Ledger entry of an admitted stage, with its thread budget and its cpus when pinned """
+        used = sum(entry['threads'] for entry in _admitted(ledger))
+        threads = threads or max(1, min(self.max_threads, self.cpu_budget - used))
+        cores = []
+        if self.pin_cpus:
+            held = [core for entry in _admitted(ledger) for core in entry['cores']]
+            # free cpus first, then the least shared ones
+            cores = sorted(self.cpus, key=lambda core: (held.count(core), core))[:threads]
+        return {'owner': os.getpid(), 'child': None, 'stage': stage, 'memory': estimate, 'threads': threads,
+                'cores': cores, 'since': time.time()}
+
+    def _refusal(self, ledger, estimate, threads):
+        """ Why a stage needing estimate bytes and threads cpu slots can not start now, None if it can """
+        running = _admitted(ledger)
+        if not running:
+            return None
+        used = sum(entry['threads'] for entry in running)
+        if used + max(1, threads) > self.cpu_budget:
+            return "%d of %d cpu slots used" % (used, self.cpu_budget)
+        reserved = sum(entry['memory'] for entry in running)
+        if self.memory_budget and reserved + estimate > self.memory_budget:
+            return "%.0f MB reserved, budget %.0f MB" % (reserved / float(MB), self.memory_budget / float(MB))
+        available = _meminfo().get('MemAvailable')
+        if available is not None:
+            # memory the running stages are still expected to take
+            pending = sum(max(0, entry['memory'] - (_rss(entry['child']) if entry['child'] else 0))
+                          for entry in running)
+            if available - pending - estimate < self.min_free:
+                return "%.0f MB available, %.0f MB still expected by the running stages" % (
+                    available / float(MB), pending / float(MB))
+        return None
+
+    def _release(self, token):
+        with self._ledger() as ledger:
+            ledger.pop(token, None)
+
+    @contextmanager
+    def _ledger(self):
+        """ The ledger under an exclusive lock, entries of dead processes removed """
+        with _locked(self.ledger_path):
+            ledger = _read_json(self.ledger_path)
+            for token in [t for t, entry in ledger.items() if not _alive(entry['owner'])]:
+                del ledger[token]
+            yield ledger
+            _write_json(self.ledger_path, ledger)
+
+    # --- process ---
+
+    def _spawn(self, token, entry, cmd, cwd, env):
+        """ Run the process, its outputs going to temporary files so that nothing blocks on pipes
+        :return: (CompletedProcess, peak rss in bytes, 0 if the process was too short to be measured)
+        """
+        with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+            cores = entry['cores']
+            # bound in the child before exec: every thread of the program inherits the cpus
+            preexec_fn = (lambda: os.sched_setaffinity(0, cores)) if cores else None
+            proc = subprocess.Popen(cmd, cwd=cwd, env=_thread_env(env, entry['threads']), stdout=out, stderr=err,
+                                    preexec_fn=preexec_fn)
+            try:
+                with self._ledger() as ledger:
+                    if token in ledger:
+                        ledger[token]['child'] = proc.pid
+                # peak rss of the program: VmHWM, sampled while it runs. The ru_maxrss of the child
+                # would count the memory of this process, shared by the child until it execs
+                peak = 0
+                while True:
+                    try:
+                        proc.wait(timeout=SAMPLE_SECONDS)
+                        break
+                    except subprocess.TimeoutExpired:
+                        peak = max(peak, _proc_status(proc.pid, 'VmHWM'))
+            except BaseException:
+                proc.kill()
+                proc.wait()
+                raise
+            out.seek(0)
+            err.seek(0)
+            return subprocess.CompletedProcess(cmd, proc.returncode, out.read(), err.read()), peak
+
+    def _learn(self, key, peak):
+        path = self.estimates_path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with _locked(path):
+            estimates = _read_json(path)
+            peaks = estimates.setdefault(key, [])
+            peaks.append(peak)
+            del peaks[:-HISTORY]
+            _write_json(path, estimates)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """ The scheduler of the process, configured by TESSER_MEMORY_BUDGET / TESSER_CPU_BUDGET / TESSER_MAX_THREADS /
+    TESSER_PIN_CPUS
+    """
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                memory = os.environ.get(MEMORY_BUDGET_ENV)
+                cpus = os.environ.get(CPU_BUDGET_ENV)
+                max_threads = os.environ.get(MAX_THREADS_ENV)
+                _scheduler = ResourceScheduler(memory_budget=int(float(memory) * MB) if memory else None,
+                                               cpu_budget=int(cpus) if cpus else None,
+                                               max_threads=int(max_threads) if max_threads else None,
+                                               pin_cpus=os.environ.get(PIN_CPUS_ENV) == '1')
+    return _scheduler
+
+
+def _admitted(ledger):
+    """ Ledger entries of the running stages """
+    return [entry for entry in ledger.values() if not entry.get('waiting')]
+
+
+def _tickets(ledger):
+    """ Tokens of the waiting stages, oldest ticket first """
+    return [token for _, token in sorted((entry['since'], token) for token, entry in ledger.items()
+                                         if entry.get('waiting'))]
+
+
+def _allowed_cpus():
+    """ Ids of the cpus this process may run on """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _thread_env(env, threads):
+    """ Environment of a stage process, its thread count limited to threads """
+    env = dict(os.environ if env is None else env)
+    for name in THREAD_VARS:
+        env[name] = str(threads)
+    return env
+
+
+def _bucket(size):
+    return int(math.log(max(1, size), 2))
+
+
+def _estimate_key(stage, size):
+    return stage if not size else "%s:%d" % (stage, _bucket(size))
+
+
+def _key_bucket(key, stage):
+    """ Size bucket of an estimate key of the stage, None for other stages or keys without size """
+    name, _, bucket = key.partition(':')
+    return int(bucket) if name == stage and bucket else None
+
+
+def _meminfo():
+    """ /proc/meminfo values in bytes, empty if not available """
+    values = {}
+    try:
+        with open('/proc/meminfo', 'r') as fp:
+            for line in fp:
+                name, _, rest = line.partition(':')
+                fields = rest.split()
+                if fields:
+                    values[name] = int(fields[0]) * 1024
+    except OSError:
+        pass
+    return values
+
+
+def _rss(pid):
+    """ Resident memory of a process in bytes, 0 if it is gone """
+    return _proc_status(pid, 'VmRSS')
+
+
+def _proc_status(pid, field):
+    """ A memory field of /proc/<pid>/status in bytes, 0 if the process is gone """
+    prefix = field + ':'
+    try:
+        with open('/proc/%d/status' % pid, 'r') as fp:
+            for line in fp:
+                if line.startswith(prefix):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@contextmanager
+def _locked(path):
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _read_json(path):
+    try:
+        with open(path, 'r', encoding='UTF-8') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_json(path, content):
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, 'w', encoding='UTF-8') as fp:
+        json.dump(content, fp)
+    os.replace(tmp_path, path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stage processes admitted on this host.')
+    parser.add_argument('action', choices=['status'])
+    parser.parse_args(argv)
+    scheduler = get_scheduler()
+    print("memory budget %.0f MB, cpu budget %d%s, %d threads at most per stage, %.0f MB available" % (
+        (scheduler.memory_budget or 0) / float(MB), scheduler.cpu_budget, " (pinned)" if scheduler.pin_cpus else "",
+        scheduler.max_threads,
+        _meminfo().get('MemAvailable', 0) / float(MB)))
+    for entry in scheduler.running():
+        print("  pid %s %-18s expected %6.0f MB, rss %6.0f MB, %d threads%s, running for %.0fs" % (
+            entry['child'], entry['stage'], entry['memory'] / float(MB), entry['rss'] / float(MB),
+            entry['threads'], " on cpus %s" % entry['cores'] if entry['cores'] else "",
+            time.time() - entry['since']))
+    for entry in scheduler.waiting():
+        print("  waiting %-18s expected %6.0f MB for %.0fs" % (
+            entry['stage'], entry['memory'] / float(MB), time.time() - entry['since']))
+    for key, peaks in sorted(_read_json(scheduler.estimates_path).items()):
+        print("  %-24s last peaks %s MB" % (key, ", ".join("%.0f" % (p / float(MB)) for p in peaks[-5:])))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
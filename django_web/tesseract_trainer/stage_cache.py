@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""
+Cache of the outputs of the training stages.
+
+Training runs which only differ in their late parameters (base_psm, clustering) produce
+the very same pages and box files, and runs which share the page layout and psm produce
+the same .tr files. A stage output is stored under the hash of everything it depends on:
+text, font contents, sizes, layout, base language... and linked into the training folder
+of any later run asking for the same key.
+
+Computing a key holds a lock on it, so that parallel jobs needing the same stage wait
+for the first one instead of computing it again.
+"""
+import hashlib
+import json
+import os
+import shutil
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # windows: parallel jobs may compute the same stage twice
+    fcntl = None
+
+
+class StageCache(object):
+    """ Content-addressed store of stage outputs """
+
+    def __init__(self, root):
+        self.root = root
+        if not os.path.exists(root):
+            os.makedirs(root, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(stage, **params):
+        """ Cache key of a stage, from json-serializable parameters """
+        payload = json.dumps({'stage': stage, 'params': params}, sort_keys=True, ensure_ascii=True)
+        return "%s-%s" % (stage, hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32])
+
+    def _entry(self, key):
+        return os.path.join(self.root, key)
+
+    def fetch(self, key, files):
+        """ Copy the cached outputs of a stage into the training folder
+        :param files: dict of cached name -> destination path
+        :return: True on a cache hit
+        """
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            self.misses += 1
+            return False
+        for name, target in files.items():
+            _link_or_copy(os.path.join(entry, name), target)
+        self.hits += 1
+        return True
+
+    def store(self, key, files):
+        """ Store the outputs of a stage
+        :param files: dict of cached name -> path of the file produced by the stage
+        """
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            return
+        tmp_entry = "%s.%d.tmp" % (entry, os.getpid())
+        os.makedirs(tmp_entry)
+        for name, source in files.items():
+            _link_or_copy(source, os.path.join(tmp_entry, name))
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # stored meanwhile by another process
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    @contextmanager
+    def lock(self, key):
+        """ Serialize the computation of a stage between processes """
+        if fcntl is None:
+            yield
+            return
+        with open(self._entry(key) + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root, exist_ok=True)
+
+
+def _link_or_copy(source, target):
+    # cached files are never modified in place, a hard link is enough
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
@@ -0,0 +1,203 @@
+# coding:utf-8
+"""
+Parallel hyperparameter sweep over the rendering and psm settings.
+
+usage:
+    python -m django_web.tesseract_trainer.sweep sweep.json [--workers N] [--output results.json]
+
+Each combination of the grid is trained as a separate job, scored on a held-out check set
+(see evaluate.py) and the combinations are ranked by accuracy, then by training plus
+recognition time. Jobs share a stage cache: combinations differing only in base_psm reuse
+the rendered pages, identical renders and psm reuse the box.train output.
+
+    {
+        "ref_path": "/web/train_data",
+        "tessdata_path": "/usr/local/share/tessdata",
+        "workers": 4,
+        "job": {"lang_name": "han", "training_text": "resource/train_text/han",
+                "fonts": ["resource/ttf/simhei.ttf", "resource/ttf/simsun.ttc"],
+                "base_lang": "chi_sim", "max_repeat": 3},
+        "grid": {"font_size": [40, 60], "row_gap": [20, 30], "col_gap": [7, 12],
+                 "wrap_len": [12], "word_per_page": [50], "base_psm": [6, 7]},
+        "random": 8,
+        "seed": 0,
+        "check_set": [["resource/check_case/address_sample.tif",
+                       "resource/check_case/address_sample.gt.txt"]]
+    }
+
+"random" is optional: when set, only that many combinations of the grid are drawn.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import time
+
+from django_web.model import ServiceException
+from . import FONT_SIZE
+from .batch import JOB_DEFAULTS, TrainingJob, run_batch
+from .multipage_tif import LAYOUT_KEYS
+
+# parameters a sweep can vary
+SWEEP_KEYS = LAYOUT_KEYS + ('font_size', 'base_psm')
+
+
+class SweepJob(TrainingJob):
+    """ A training job of the sweep, scored on the check set once trained """
+
+    def __init__(self, params, check_set, ocr_cache=None, **kwargs):
+        TrainingJob.__init__(self, **kwargs)
+        self.params = params
+        self.check_set = check_set
+        self.ocr_cache = ocr_cache
+
+    def run(self):
+        from .evaluate import score_check_set
+        from .ocr_cache import OcrCache
+
+        start = time.time()
+        trainer = self.make_trainer()
+        trainer.training()
+        train_seconds = time.time() - start
+        # the traineddata is read from the training folder, nothing is published
+        cache = OcrCache(self.ocr_cache) if self.ocr_cache else None
+        score = score_check_set(self.check_set, self.lang_name, self.base_psm, tessdata_dir=trainer.training_path,
+                                cache=cache)
+        return {'output': os.path.join(trainer.training_path, '%s.traineddata' % self.lang_name),
+                'params': self.params,
+                'accuracy': score['accuracy'],
+                'errors': score['errors'],
+                'chars': score['chars'],
+                'wer': score['wer'],
+                'train_seconds': train_seconds,
+                'ocr_seconds': score['seconds'],
+                'ocr_cache_hits': score['cache_hits']}
+
+
+def expand_grid(grid, sample=None, seed=0):
+    """ All combinations of the grid, or 'sample' of them drawn at random
+    :return: list of dict param -> value
+    """
+    unknown = set(grid) - set(SWEEP_KEYS)
+    if unknown:
+        raise ServiceException("can not sweep over %s" % ", ".join(sorted(unknown)))
+    keys = sorted(grid)
+    combos = [dict(zip(keys, values)) for values in itertools.product(*[grid[key] for key in keys])]
+    if sample is not None and sample < len(combos):
+        combos = random.Random(seed).sample(combos, sample)
+    # combinations rendering the same pages run next to each other, the later ones wait
+    # for the stage cache instead of rendering again
+    combos.sort(key=lambda c: json.dumps(dict((k, v) for k, v in c.items() if k != 'base_psm'), sort_keys=True))
+    return combos
+
+
+def load_sweep(sweep_path):
+    """ Read a sweep file
+    :return: (list of SweepJob, worker budget found in the file or None)
+    """
+    with open(sweep_path, 'r', encoding='UTF-8') as fp:
+        sweep = json.load(fp)
+    base_dir = os.path.dirname(os.path.abspath(sweep_path))
+
+    def resolve(path):
+        if isinstance(path, dict):
+            return dict((key, resolve(value)) for key, value in path.items())
+        return path if path is None else os.path.join(base_dir, os.path.expanduser(path))
+
+    spec = dict(JOB_DEFAULTS)
+    spec.update(sweep['job'])
+    fonts = spec.pop('fonts', None)
+    if not fonts or not spec['lang_name'] or not spec['training_text']:
+        raise ServiceException("the sweep job needs a lang_name, a training_text and fonts")
+    check_set = [(resolve(image), resolve(truth)) for image, truth in sweep.get('check_set', [])]
+    if not check_set:
+        raise ServiceException("a sweep needs a check_set to score the combinations")
+    ref_path = resolve(sweep['ref_path'])
+    stage_cache = resolve(spec['stage_cache']) if spec['stage_cache'] else os.path.join(ref_path, '.stage_cache')
+    # the ocr cache is keyed by traineddata content, not name: combinations producing the same
+    # traineddata are only recognized once
+    ocr_cache = os.path.join(ref_path, '.ocr_cache.db')
+
+    jobs = []
+    for idx, params in enumerate(expand_grid(sweep['grid'], sweep.get('random'), sweep.get('seed', 0))):
+        lang_name = "%s_sw%03d" % (spec['lang_name'], idx)
+        layout = dict(spec['layout'] or {})
+        layout.update((key, value) for key, value in params.items() if key in LAYOUT_KEYS)
+        jobs.append(SweepJob(params=params,
+                             check_set=check_set,
+                             ocr_cache=ocr_cache,
+                             name=lang_name,
+                             ref_path=ref_path,
+                             tessdata_path=resolve(sweep['tessdata_path']),
+                             lang_name=lang_name,
+                             training_text=resolve(spec['training_text']),
+                             font_set='sweep',
+                             ttf_file_list=[resolve(f) for f in fonts],
+                             font_size=params.get('font_size', spec['font_sizes'] or FONT_SIZE),
+                             base_lang=spec['base_lang'],
+                             base_psm=params.get('base_psm', spec['base_psm']),
+                             font_name=spec['font_name'],
+                             font_properties=spec['font_properties'],
+                             train_id=spec['train_id'],
+                             word_list=resolve(spec['word_list']),
+                             on_exists='clean',
+                             publish=False,
+                             verbose=spec['verbose'],
+                             augment=spec['augment'],
+                             max_repeat=spec['max_repeat'],
+                             min_count=spec['min_count'],
+                             shuffle_seed=spec['shuffle_seed'],
+                             layout=layout,
+                             stage_cache=stage_cache,
+                             scratch=spec['scratch']))
+    return jobs, sweep.get('workers')
+
+
+def rank_results(results):
+    """ Successful combinations first, by decreasing accuracy then increasing total time """
+    done = [r for r in results if r['status'] == 'ok']
+    failed = [r for r in results if r['status'] != 'ok']
+    done.sort(key=lambda r: (-r['accuracy'], r['train_seconds'] + r['ocr_seconds']))
+    return done + failed
+
+
+def format_ranking(results, keys):
+    header = ["rank", "job"] + list(keys) + ["accuracy", "wer", "train(s)", "ocr(s)"]
+    rows = []
+    for rank, r in enumerate(results, 1):
+        if r['status'] == 'ok':
+            rows.append([str(rank), r['name']] + [str(r['params'][k]) for k in keys] +
+                        ["%.4f" % r['accuracy'], "%.4f" % r['wer'], "%.1f" % r['train_seconds'], "%.1f" % r['ocr_seconds']])
+        else:
+            rows.append(["-", r['name']] + [str(r['params'][k]) for k in keys] + ["failed", "", "", r['error'] or ""])
+    widths = [max(len(row[i]) for row in rows + [header]) for i in range(len(header))]
+    lines = ["  ".join(cell.ljust(width) for cell, width in zip(row, widths)) for row in [header] + rows]
+    lines.insert(1, "-" * len(lines[0]))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sweep rendering and psm parameters of a training.')
+    parser.add_argument('sweep', help="path of the json sweep description")
+    parser.add_argument('--workers', '-w', type=int, default=None, help="number of jobs running at the same time")
+    parser.add_argument('--output', '-o', default=None, help="write the ranked results to this json file")
+    args = parser.parse_args(argv)
+
+    jobs, sweep_workers = load_sweep(args.sweep)
+    keys = sorted(set(k for job in jobs for k in job.params))
+    results = rank_results(run_batch(jobs, args.workers or sweep_workers))
+    # failed jobs returned no params
+    params = dict((job.name, job.params) for job in jobs)
+    for r in results:
+        r.setdefault('params', params[r['name']])
+    print(format_ranking(results, keys))
+    if args.output:
+        with open(args.output, 'w', encoding='UTF-8') as fp:
+            json.dump(results, fp, indent=2, ensure_ascii=False)
+    return 0 if any(r['status'] == 'ok' for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+"""
+Reader and writer of .traineddata files, without combine_tessdata.
+
+A traineddata is the concatenation of the files of a language (unicharset, inttemp,
+normproto, dawgs, lstm...) behind an offset table, as written by TessdataManager:
+
+    int32 number of entries, then one int64 offset per entry (-1: component absent),
+    then the components; a component ends where the next present component starts.
+
+tesseract 3.04/3.05 write 17 entries, tesseract 4 and later 24 (the lstm components and
+the version string). Files are little endian, files written on a big endian host are
+read as well.
+
+TrainedData maps the file: listing, hashing, comparing or extracting a component reads it
+in place, nothing is unpacked to disk. write_traineddata combines component files the way
+`combine_tessdata lang.` does, and replace_components swaps single components (a new
+word list dawg...) of an existing file.
+
+usage:
+    python -m django_web.tesseract_trainer.traineddata list chi_sim.traineddata [more.traineddata...]
+    python -m django_web.tesseract_trainer.traineddata extract chi_sim.traineddata unicharset [output]
+    python -m django_web.tesseract_trainer.traineddata compare a.traineddata b.traineddata
+    python -m django_web.tesseract_trainer.traineddata replace chi_sim.traineddata word-dawg=new.dawg
+"""
+import argparse
+import hashlib
+import mmap
+import os
+import shutil
+import struct
+import sys
+
+from django_web.model import ServiceException
+
+# component names, in the order of the offset table (TessdataType)
+COMPONENTS = ('config', 'unicharset', 'unicharambigs', 'inttemp', 'pffmtable', 'normproto',
+              'punc-dawg', 'word-dawg', 'number-dawg', 'freq-dawg', 'fixed-length-dawgs',
+              'cube-unicharset', 'cube-word-dawg', 'shapetable', 'bigram-dawg', 'unambig-dawg',
+              'params-model', 'lstm', 'lstm-punc-dawg', 'lstm-word-dawg', 'lstm-number-dawg',
+              'lstm-unicharset', 'lstm-recoder', 'version')
+LEGACY_ENTRIES = 17  # entries of the files written by tesseract 3.04/3.05
+COPY_CHUNK = 1024 * 1024
+
+
+class TrainedData(object):
+    """ A memory-mapped traineddata """
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = open(path, 'rb')
+        size = os.fstat(self.fp.fileno()).st_size
+        if size < 4:
+            self.fp.close()
+            raise ServiceException("%s is not a traineddata" % path)
+        self.data = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.num_entries, self.byte_order = _read_entry_count(self.data, path)
+        table_end = 4 + 8 * self.num_entries
+        offsets = struct.unpack_from('%s%dq' % (self.byte_order, self.num_entries), self.data, 4)
+        # a component ends where the next present one starts, the last one at the end of the file
+        self.offsets = {}
+        present = sorted((offset, idx) for idx, offset in enumerate(offsets) if offset >= 0)
+        ends = [offset for offset, _ in present[1:]] + [size]
+        for (offset, idx), end in zip(present, ends):
+            if offset < table_end or end < offset or end > size:
+                self.close()
+                raise ServiceException("%s: invalid offset of %s" % (path, COMPONENTS[idx]))
+            self.offsets[COMPONENTS[idx]] = (offset, end - offset)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+            self.fp.close()
+
+    def names(self):
+        """ Names of the present components, in file order """
+        return [name for name in COMPONENTS if name in self.offsets]
+
+    def size(self, name):
+        return self._locate(name)[1]
+
+    def view(self, name):
+        """ The bytes of a component, as a memoryview of the mapped file (no copy). Release the
+            view before closing the TrainedData.
+        """
+        offset, size = self._locate(name)
+        return memoryview(self.data)[offset:offset + size]
+
+    def digest(self, name):
+        """ sha256 of a component """
+        view = self.view(name)
+        try:
+            return hashlib.sha256(view).hexdigest()
+        finally:
+            view.release()
+
+    def extract(self, name, output_path):
+        """ Write a component to a file """
+        view = self.view(name)
+        try:
+            with open(output_path, 'wb') as fp:
+                fp.write(view)
+        finally:
+            view.release()
+
+    def version(self):
+        """ The version string of tesseract 4 files, None for older ones """
+        if 'version' not in self.offsets:
+            return None
+        view = self.view('version')
+        try:
+            return bytes(view).decode('utf-8', 'replace')
+        finally:
+            view.release()
+
+    def _locate(self, name):
+        if name not in COMPONENTS:
+            raise ServiceException("unknown traineddata component %s" % name)
+        location = self.offsets.get(name)
+        if location is None:
+            raise ServiceException("%s has no %s" % (self.path, name))
+        return location
+
+
+def _read_entry_count(data, path):
+    """ Number of entries of the offset table, and byte order of the file """
+    for byte_order in ('<', '>'):
+        num_entries = struct.unpack_from(byte_order + 'i', data, 0)[0]
+        if 0 < num_entries <= len(COMPONENTS) and 4 + 8 * num_entries <= len(data):
+            return num_entries, byte_order
+    raise ServiceException("%s is not a traineddata" % path)
+
+
+def compare(path_a, path_b):
+    """ Compare the components of two traineddata files
+    :return: list of (component, status) with status same, differs, only in a, only in b
+    """
+    with TrainedData(path_a) as a, TrainedData(path_b) as b:
+        result = []
+        for name in COMPONENTS:
+            in_a, in_b = name in a.offsets, name in b.offsets
+            if in_a and in_b:
+                same = a.size(name) == b.size(name) and _same_bytes(a, b, name)
+                result.append((name, 'same' if same else 'differs'))
+            elif in_a or in_b:
+                result.append((name, 'only in a' if in_a else 'only in b'))
+        return result
+
+
+def _same_bytes(a, b, name):
+    view_a, view_b = a.view(name), b.view(name)
+    try:
+        return view_a == view_b
+    finally:
+        view_a.release()
+        view_b.release()
+
+
+def write_traineddata(output_path, components, num_entries=None):
+    """ Write a traineddata
+    :param components: dict component name -> path of a file or bytes-like object
+    :param num_entries: size of the offset table, default: 17 (read by tesseract 3 and later), or 24 when
+        a tesseract 4 component is given
+    """
+    unknown = set(components) - set(COMPONENTS)
+    if unknown:
+        raise ServiceException("unknown traineddata components: %s" % ", ".join(sorted(unknown)))
+    if not components:
+        raise ServiceException("no component to write in %s" % output_path)
+    needed = max(COMPONENTS.index(name) for name in components) + 1
+    if num_entries is None:
+        num_entries = LEGACY_ENTRIES if needed <= LEGACY_ENTRIES else len(COMPONENTS)
+    if num_entries < needed:
+        raise ServiceException("%d entries can not hold %s" % (num_entries, COMPONENTS[needed - 1]))
+    sizes = {}
+    for name, source in components.items():
+        sizes[name] = os.path.getsize(source) if isinstance(source, str) else memoryview(source).nbytes
+    offsets = []
+    offset = 4 + 8 * num_entries
+    for name in COMPONENTS[:num_entries]:
+        # an empty file is still a present (zero length) component, like with combine_tessdata
+        if name in sizes:
+            offsets.append(offset)
+            offset += sizes[name]
+        else:
+            offsets.append(-1)
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'wb') as fp:
+        fp.write(struct.pack('<i%dq' % num_entries, num_entries, *offsets))
+        for name in COMPONENTS[:num_entries]:
+            if name not in sizes:
+                continue
+            source = components[name]
+            if isinstance(source, str):
+                with open(source, 'rb') as src:
+                    shutil.copyfileobj(src, fp, COPY_CHUNK)
+            else:
+                fp.write(source)
+    os.replace(tmp_path, output_path)
+
+
+def combine(prefix):
+    """ Equivalent of `combine_tessdata prefix`: write {prefix}traineddata from the existing
+        {prefix}<component> files
+    :param prefix: path prefix ending with a dot, e.g. /path/lang.
+    :return: list of the components written
+    """
+    components = dict((name, prefix + name) for name in COMPONENTS if os.path.exists(prefix + name))
+    write_traineddata(prefix + 'traineddata', components)
+    return [name for name in COMPONENTS if name in components]
+
+
+def replace_components(path, replacements, output_path=None):
+    """ Replace, add or remove components of a traineddata, the others being copied from the mapped file
+    :param replacements: dict component name -> path of a file, bytes-like object, or None to remove it
+    :param output_path: default: path, replaced atomically
+    """
+    unknown = set(replacements) - set(COMPONENTS)
+    if unknown:
+        raise ServiceException("unknown traineddata components: %s" % ", ".join(sorted(unknown)))
+    output_path = output_path or path
+    with TrainedData(path) as source:
+        components = dict((name, source.view(name)) for name in source.names() if name not in replacements)
+        components.update((name, content) for name, content in replacements.items() if content is not None)
+        needed = max([COMPONENTS.index(name) for name in components] + [0]) + 1
+        try:
+            num_entries = source.num_entries if needed <= source.num_entries else len(COMPONENTS)
+            write_traineddata(output_path, components, num_entries)
+        finally:
+            for content in components.values():
+                if isinstance(content, memoryview):
+                    content.release()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect and edit traineddata files in place.')
+    sub = parser.add_subparsers(dest='action')
+    sub.required = True
+    list_parser = sub.add_parser('list', help="components, sizes and hashes")
+    list_parser.add_argument('paths', nargs='+')
+    extract_parser = sub.add_parser('extract', help="write one component to a file")
+    extract_parser.add_argument('path')
+    extract_parser.add_argument('component', choices=COMPONENTS)
+    extract_parser.add_argument('output', nargs='?', help="default: {lang}.{component} next to the traineddata")
+    compare_parser = sub.add_parser('compare', help="compare the components of two files")
+    compare_parser.add_argument('a')
+    compare_parser.add_argument('b')
+    replace_parser = sub.add_parser('replace', help="replace components: name=file, or name= to remove one")
+    replace_parser.add_argument('path')
+    replace_parser.add_argument('components', nargs='+')
+    replace_parser.add_argument('--output', help="default: replace the file")
+    args = parser.parse_args(argv)
+
+    if args.action == 'list':
+        for path in args.paths:
+            with TrainedData(path) as data:
+                version = data.version()
+                print("%s: %d entries%s" % (path, data.num_entries, ", version %s" % version if version else ""))
+                for name in data.names():
+                    print("  %-20s %10d  %s" % (name, data.size(name), data.digest(name)[:16]))
+    elif args.action == 'extract':
+        output = args.output
+        if output is None:
+            output = "%s.%s" % (os.path.splitext(args.path)[0], args.component)
+        with TrainedData(args.path) as data:
+            data.extract(args.component, output)
+        print(output)
+    elif args.action == 'compare':
+        result = compare(args.a, args.b)
+        for name, status in result:
+            print("  %-20s %s" % (name, status))
+        return 0 if all(status == 'same' for _, status in result) else 1
+    else:
+        replacements = {}
+        for item in args.components:
+            name, sep, source = item.partition('=')
+            if not sep:
+                parser.error("components are given as name=file")
+            replacements[name] = source or None
+        replace_components(args.path, replacements, args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
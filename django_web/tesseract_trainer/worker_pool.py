@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pre-forked pool of warm worker processes.
+
+A fresh worker pays for importing numpy/cv2/PIL/django and for parsing the training fonts
+(simsun.ttc...) before doing any work; for short jobs (sweep combinations, one font set per
+job) this startup dominates. WarmPool starts one template process which imports these
+modules and loads the fonts into its font pool (see font_pool.py) once, then forks a
+worker for every submitted task: the worker starts with everything already in memory,
+shared copy-on-write with the template, and dispatching a task takes a few ms.
+
+Every task runs in its own forked process, which exits once the task is done, so tasks
+do not leak state (cwd, globals, memory) into each other, as with a fresh process.
+
+usage:
+    with WarmPool(max_workers=4, fonts=["simsun.ttc"], font_sizes=[40]) as pool:
+        futures = [pool.submit(run_job, job) for job in jobs]
+        for future in as_completed(futures):
+            print(future.result())
+
+The template process is forked from the caller when the pool is created: create the pool
+before starting threads, or pass start_method='forkserver' to start the template from the
+forkserver process (it then imports the preloaded modules itself). Needs os.fork (linux, mac).
+"""
+import importlib
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import Future
+from multiprocessing import connection
+
+from django_web.model import ServiceException
+
+# modules imported by the template process, missing ones are skipped
+PRELOAD_MODULES = ('numpy', 'cv2', 'PIL.Image', 'PIL.ImageDraw', 'PIL.ImageFont', 'libtiff', 'django',
+                   'django_web.tesseract_trainer', 'django_web.tesseract_trainer.multipage_tif',
+                   'django_web.tesseract_trainer.augment', 'django_web.tesseract_trainer.lstm',
+                   'django_web.tesseract_trainer.evaluate', 'django_web.util.img_util')
+
+
+def fork_supported():
+    return hasattr(os, 'fork')
+
+
+class WarmPool(object):
+    """ Executor running every task in a process forked from a preloaded template process """
+
+    def __init__(self, max_workers=None, preload=PRELOAD_MODULES, fonts=(), font_sizes=(), start_method='fork'):
+        """
+        :param max_workers: 同时运行的任务数, 默认cpu数
+        :param preload: 模板进程预先导入的模块
+        :param fonts: 模板进程预先加载的字体文件
+        :param font_sizes: 预先创建的字号, 为空时只读入字体文件
+        :param start_method: 启动模板进程的方式, 'fork'或'forkserver'(调用者有其他线程时, 不会继承被占用的锁)
+        """
+        if not fork_supported():
+            raise ServiceException("the warm worker pool needs os.fork")
+        self.max_workers = max(1, max_workers or os.cpu_count() or 1)
+        self._futures = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._closed = False
+        # fork of a worker -> start of its task, in seconds
+        self.dispatch_seconds = []
+        task_recv, self._task_send = multiprocessing.Pipe(duplex=False)
+        self._result_recv, result_send = multiprocessing.Pipe(duplex=False)
+        # buffered output would be written again by every forked process
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self._template = multiprocessing.get_context(start_method).Process(
+            target=_template_main, args=(task_recv, result_send, self.max_workers, preload, fonts, font_sizes),
+            name='warm-pool-template', daemon=True)
+        self._template.start()
+        task_recv.close()
+        result_send.close()
+        self._collector = threading.Thread(target=self._collect, name='warm-pool-collector', daemon=True)
+        self._collector.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def submit(self, fn, *args, **kwargs):
+        """ Run fn(*args, **kwargs) in a worker; fn and its arguments must be picklable
+        :return: concurrent.futures.Future
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise ServiceException("the warm worker pool is shut down")
+            task_id = self._next_id
+            self._next_id += 1
+            self._futures[task_id] = future
+            self._task_send.send((task_id, fn, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True):
+        """ Stop accepting tasks; the template process exits once the submitted tasks are done """
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._task_send.send(None)
+                self._task_send.close()
+        if wait:
+            self._collector.join()
+            self._template.join()
+
+    def _collect(self):
+        """ Resolve the futures with the results sent back by the template process """
+        while True:
+            try:
+                task_id, ok, value, dispatch = self._result_recv.recv()
+            except EOFError:
+                break
+            with self._lock:
+                future = self._futures.pop(task_id)
+            if dispatch is not None:
+                self.dispatch_seconds.append(dispatch)
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+        self._result_recv.close()
+        with self._lock:
+            lost, self._futures = list(self._futures.values()), {}
+        for future in lost:
+            future.set_exception(ServiceException("the warm worker pool template process exited"))
+
+
+def _template_main(task_recv, result_send, max_workers, preload, fonts, font_sizes):
+    """ Template process: preload, then fork a worker per task, at most max_workers at a time """
+    start = time.time()
+    loaded = _preload(preload)
+    if fonts:
+        from .font_pool import get_font_pool
+        get_font_pool().preload(fonts, font_sizes)
+    print("**** warm pool ready in %.1fs: %s, %d fonts" % (time.time() - start, ", ".join(loaded), len(fonts)))
+
+    pending = deque()
+    running = {}  # result connection of a worker -> (pid, task_id)
+    accepting = True
+    while accepting or pending or running:
+        while pending and len(running) < max_workers:
+            task_id, fn, args, kwargs = pending.popleft()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            worker_recv, worker_send = multiprocessing.Pipe(duplex=False)
+            forked = time.time()
+            pid = os.fork()
+            if pid == 0:
+                worker_recv.close()
+                task_recv.close()
+                result_send.close()
+                _worker_main(worker_send, fn, args, kwargs, forked)
+            worker_send.close()
+            running[worker_recv] = (pid, task_id)
+        ready = connection.wait(list(running) + ([task_recv] if accepting else []))
+        for conn in ready:
+            if conn is task_recv:
+                try:
+                    task = task_recv.recv()
+                except EOFError:
+                    task = None
+                if task is None:
+                    accepting = False
+                else:
+                    pending.append(task)
+                continue
+            pid, task_id = running.pop(conn)
+            try:
+                ok, value, dispatch = conn.recv()
+            except EOFError:
+                ok, value, dispatch = False, None, None
+            conn.close()
+            _, status = os.waitpid(pid, 0)
+            if value is None and not ok:
+                value = ServiceException("worker %d of task %d exited with code %d without a result"
+                                         % (pid, task_id, os.waitstatus_to_exitcode(status)))
+            result_send.send((task_id, ok, value, dispatch))
+    result_send.close()
+
+
+def _worker_main(conn, fn, args, kwargs, forked):
+    """ Forked worker: run one task, send its result and exit """
+    dispatch = time.time() - forked
+    # the forked workers would otherwise all draw the same numpy random numbers
+    if 'numpy' in sys.modules:
+        sys.modules['numpy'].random.seed()
+    code = 0
+    try:
+        try:
+            result = (True, fn(*args, **kwargs), dispatch)
+        except BaseException as e:
+            traceback.print_exc()
+            result = (False, e, dispatch)
+        try:
+            conn.send(result)
+        except Exception as e:
+            # unpicklable result or exception
+            conn.send((False, ServiceException("%s: %s" % (type(e).__name__, e)), dispatch))
+    except BaseException:
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def _preload(modules):
+    """ Import the modules which are installed
+    :return: names of the imported modules
+    """
+    loaded = []
+    for name in modules:
+        try:
+            importlib.import_module(name)
+            loaded.append(name)
+        except ImportError:
+            pass
+    return loaded
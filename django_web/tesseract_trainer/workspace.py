@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+"""
+Scratch workspace of a training.
+
+Without a workspace, every intermediate file of a training (single-page tifs, multi-page
+tifs, box files, .tr files, unicharset, inttemp...) is written to the training folder
+under ref_path and stays there. With a Workspace, the training runs in a scratch directory
+on a RAM-backed file system (tmpfs, /dev/shm by default):
+
+- the scratch directory is capped: when it grows over scratch_cap, its oldest files are
+  moved to a spill directory on disk and replaced by symbolic links;
+- at the end of the training only the retained files (the traineddata by default) are
+  moved to the training folder, then the scratch and spill directories are removed with
+  one rmtree each;
+- when tmpfs is missing or has not enough free space, the scratch directory is created on
+  disk, in the training folder, with the same retention.
+
+The stage cache keeps its own copies of the stage outputs, nothing it needs is lost.
+A workspace is local to the host: distributed training (job_queue) does not use one.
+"""
+import fnmatch
+import os
+import shutil
+import time
+import uuid
+
+SCRATCH_ROOT = '/dev/shm/tesser_train'  # Default root of the RAM-backed scratch directories
+SCRATCH_CAP = 2 * 1024 * 1024 * 1024  # Default maximum size of a scratch directory, in bytes
+SPILL_TARGET = 0.8  # spilling stops once the scratch directory is below this part of the cap
+RETAIN = ('{lang}.traineddata',)  # Default files kept in the training folder, {lang} is the language name
+WORK_DIR_NAME = '.work'  # scratch directory in the training folder when tmpfs can not be used
+SPILL_DIR_NAME = '.spill'
+
+
+class Workspace(object):
+    """ Scratch directory of one training, with size cap, spill to disk and retention """
+
+    def __init__(self, scratch_root=SCRATCH_ROOT, scratch_cap=SCRATCH_CAP, retain=RETAIN):
+        """
+        :param scratch_root: 内存文件系统上存放临时目录的路径, None则临时目录放在磁盘上
+        :param scratch_cap: 临时目录的大小上限(byte), 超过后最旧的文件转移到磁盘
+        :param retain: 训练结束后保留在训练目录中的文件名(支持通配符, {lang}替换为语言名)
+        """
+        self.scratch_root = scratch_root
+        self.scratch_cap = scratch_cap
+        self.retain = tuple(retain)
+        self.final_path = None
+        self.work_path = None
+        self.spill_path = None
+        self.in_memory = False
+        self.spilled = 0
+
+    def open(self, final_path):
+        """ Create the scratch directory of a training
+        :param final_path: the training folder, on disk
+        :return: path of the directory the training must run in
+        """
+        self.final_path = final_path
+        self.spill_path = os.path.join(final_path, SPILL_DIR_NAME)
+        name = "%s-%s" % (os.path.basename(os.path.normpath(final_path)), uuid.uuid4().hex[:8])
+        if self.scratch_root and _free_space(self.scratch_root) >= self.scratch_cap:
+            self.work_path = os.path.join(self.scratch_root, name)
+            self.in_memory = True
+        else:
+            self.work_path = os.path.join(final_path, WORK_DIR_NAME, name)
+            self.in_memory = False
+        os.makedirs(self.work_path)
+        print("**** scratch directory %s (%s)" % (self.work_path, "memory" if self.in_memory else "disk"))
+        return self.work_path
+
+    def usage(self):
+        """ Bytes used by the files of the scratch directory, spilled files excluded """
+        total = 0
+        for entry in _walk_files(self.work_path):
+            if not entry.is_symlink():
+                total += entry.stat(follow_symlinks=False).st_blocks * 512
+        return total
+
+    def spill(self):
+        """ Move the oldest files to disk while the scratch directory is over its cap
+        :return: number of bytes moved
+        """
+        if not self.in_memory:
+            return 0
+        used = self.usage()
+        if used <= self.scratch_cap:
+            return 0
+        target = self.scratch_cap * SPILL_TARGET
+        entries = [e for e in _walk_files(self.work_path) if not e.is_symlink()]
+        entries.sort(key=lambda e: e.stat(follow_symlinks=False).st_mtime)
+        moved = 0
+        for entry in entries:
+            if used - moved <= target:
+                break
+            size = entry.stat(follow_symlinks=False).st_blocks * 512
+            relative = os.path.relpath(entry.path, self.work_path)
+            destination = os.path.join(self.spill_path, relative)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.move(entry.path, destination)
+            os.symlink(destination, entry.path)
+            moved += size
+        self.spilled += moved
+        print("**** spilled %.1f MB of %s to disk" % (moved / 1048576.0, self.work_path))
+        return moved
+
+    def finalize(self, lang_name):
+        """ Move the retained files to the training folder and remove everything else
+        :return: the training folder
+        """
+        patterns = [pattern.format(lang=lang_name) for pattern in self.retain]
+        for name in os.listdir(self.work_path):
+            if any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                source = os.path.realpath(os.path.join(self.work_path, name))
+                target = os.path.join(self.final_path, name)
+                if os.path.isdir(target) and not os.path.islink(target):
+                    shutil.rmtree(target)
+                shutil.move(source, target)
+        self.discard()
+        return self.final_path
+
+    def discard(self):
+        """ Remove the scratch and spill directories """
+        start = time.time()
+        for path in (self.work_path, self.spill_path):
+            if path:
+                shutil.rmtree(path, ignore_errors=True)
+        work_root = os.path.join(self.final_path, WORK_DIR_NAME)
+        if os.path.isdir(work_root) and not os.listdir(work_root):
+            os.rmdir(work_root)
+        print("**** scratch directory removed in %.2fs" % (time.time() - start))
+
+
+def _free_space(path):
+    try:
+        os.makedirs(path, exist_ok=True)
+        stat = os.statvfs(path)
+    except (OSError, AttributeError):
+        return 0
+    return stat.f_bavail * stat.f_frsize
+
+
+def _walk_files(path):
+    """ All file entries under path, symbolic links included but not followed """
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    yield entry
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+
+"""
+Training jobs submitted through the web api.
+
+A submitted job is a batch.TrainingJob (one language, one font set, one font size or a list
+of sizes) with a server side id. Jobs wait in a FIFO queue and at most `workers` of them
+run at the same time, each in a process forked from a warm template process (see
+tesseract_trainer.worker_pool) or, where os.fork is missing, in a cold worker process.
+
+Job states are kept in memory: they are lost when the server restarts, the trained files
+stay in {ref_path}/{lang_name}_{job id}. Clients never pass server paths: fonts are names of
+files of the font directory or sha256 of fonts uploaded to the input store, the training
+text is given inline or as the sha256 of an uploaded corpus. The hashes of stored inputs are
+the keys of their fonts in the font pool and of the stage cache, the files are not hashed again.
+
+The api is not authenticated: a job only publishes its traineddata to the served tessdata
+when the server allows it (allow_publish), names are checked before they reach a path, and
+the numbers of the option dicts (processes, iterations, sizes) are clamped into OPTION_LIMITS
+and font sizes must be a short list of integers of FONT_SIZE_LIMITS.
+The warm template process is started by the forkserver, not forked from a request thread
+which may share the process with threads holding locks.
+"""
+import math
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django_web.input_store import DIGEST_RE, KIND_FONT, KIND_TEXT
+from django_web.model import ServiceException
+
+WORKERS = 2  # Default number of trainings running at the same time
+MAX_QUEUED = 64  # Default number of waiting jobs, further submissions are refused
+MAX_TEXT_CHARS = 200000  # Default length limit of a submitted training text
+FONT_SIZE_LIMITS = (8, 200)  # font sizes a job may render
+MAX_FONT_SIZES = 8  # length limit of a list of font sizes
+KEEP_FINISHED = 1000  # finished jobs whose status is kept
+LATENCY_WINDOW = 1024  # number of recent jobs the queue wait percentiles are computed on
+
+STATE_QUEUED = 'queued'
+STATE_RUNNING = 'running'
+STATE_OK = 'ok'
+STATE_FAILED = 'failed'
+
+# job options a client may set, see batch.JOB_DEFAULTS (no server paths); 'publish' only when the server allows it
+CLIENT_OPTIONS = ('base_lang', 'base_psm', 'font_name', 'font_properties', 'augment', 'max_repeat', 'min_count',
+                  'shuffle_seed', 'layout', 'mode', 'lstm', 'glyph_export')
+# option dicts of a job: bounds of their numeric keys, values are clamped into them ('cpus': the cpu count).
+# lstm and glyph_export only take these keys, augment also takes the other options of augment.Augmenter
+OPTION_LIMITS = {
+    'lstm': {'max_iterations': (1, 100000), 'target_error_rate': (0.0, 100.0), 'learning_rate': (0.0, 1.0),
+             'lines_per_shard': (1, 10000), 'eval_ratio': (0.0, 0.5), 'workers': (1, 'cpus')},
+    'glyph_export': {'glyph_size': (8, 256), 'shard_size': (1, 1000000)},
+    'augment': {'workers': (1, 'cpus'), 'chunk_size': (1, 256)},
+}
+OPEN_OPTIONS = ('augment',)
+
+
+class TrainingService(object):
+    """ Queue of the training jobs of the api, run by a bounded set of workers """
+
+    def __init__(self, ref_path, tessdata_path, font_path, workers=WORKERS, max_queued=MAX_QUEUED, warm=True,
+                 input_store=None, allow_publish=False):
+        """
+        :param ref_path: 训练目录的根目录
+        :param tessdata_path: 语言包目录
+        :param font_path: 字体目录, 提交的任务只能使用其中的字体或input_store中的字体
+        :param workers: 同时运行的训练数
+        :param max_queued: 最多排队的任务数, 超过后拒绝提交
+        :param warm: 从预先导入依赖的模板进程fork训练进程(worker_pool.WarmPool)
+        :param input_store: 可选的input_store.InputStore, 任务可以用sha256引用上传的语料和字体
+        :param allow_publish: 是否允许任务把训练结果发布到tessdata_path(publish选项), 会替换正在使用的语言包
+        """
+        from django_web.tesseract_trainer.worker_pool import WarmPool, fork_supported
+
+        for path in (ref_path, tessdata_path, font_path):
+            if not os.path.isdir(path):
+                raise ServiceException("%s is not a directory" % path)
+        self.ref_path = ref_path
+        self.tessdata_path = tessdata_path
+        self.font_path = font_path
+        self.workers = workers
+        self.max_queued = max_queued
+        self.input_store = input_store
+        self.allow_publish = allow_publish
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.queue_waits = deque(maxlen=LATENCY_WINDOW)
+        self.submitted = 0
+        self.refused = 0
+        if warm and fork_supported():
+            # the template forks the workers, itself started from a process without threads when possible
+            self.pool = WarmPool(workers, start_method=template_start_method())
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            self.pool = ProcessPoolExecutor(max_workers=workers)
+        # one thread per running job, waiting for its worker process
+        self.runner = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='train-job')
+
+    def submit(self, spec):
+        """ Queue a training job
+        :param spec: dict with lang_name, text or text_sha256, fonts (file names of the font directory or
+            sha256 of stored fonts), font_size, and optionally the CLIENT_OPTIONS
+        :return: job id
+        """
+        with self.lock:
+            queued = len([1 for status in self.jobs.values() if status['state'] == STATE_QUEUED])
+            if queued >= self.max_queued:
+                self.refused += 1
+                raise ServiceException("too many queued trainings, retry later")
+        job_id = uuid.uuid4().hex[:12]
+        job = self._make_job(job_id, spec)
+        with self.lock:
+            self.jobs[job_id] = {'id': job_id, 'lang_name': job.lang_name, 'state': STATE_QUEUED,
+                                 'submitted': time.time(), 'started': None, 'finished': None,
+                                 'output': None, 'error': None}
+            self.submitted += 1
+            self._forget_finished()
+        self.runner.submit(self._run, job_id, job)
+        return job_id
+
+    def _make_job(self, job_id, spec):
+        from django_web.tesseract_trainer.batch import JOB_DEFAULTS, MODES, TrainingJob
+
+        client_options = CLIENT_OPTIONS + (('publish',) if self.allow_publish else ())
+        if 'publish' in spec and not self.allow_publish:
+            raise ServiceException("publishing trained languages is disabled on this server")
+        unknown = set(spec) - set(client_options + ('lang_name', 'text', 'text_sha256', 'fonts', 'font_size'))
+        if unknown:
+            raise ServiceException("unknown job keys: %s" % ", ".join(sorted(unknown)))
+        for key in ('lang_name', 'fonts', 'font_size'):
+            if not spec.get(key):
+                raise ServiceException("the job needs a %s" % key)
+        if bool(spec.get('text')) == bool(spec.get('text_sha256')):
+            raise ServiceException("the job needs either a text or a text_sha256")
+        lang_name = spec['lang_name']
+        # these end up in file names
+        for key in ('lang_name', 'base_lang', 'font_name'):
+            if key in spec and not _is_name(spec[key]):
+                raise ServiceException("%s must be letters, digits and _" % key)
+        _check_font_size(spec['font_size'])
+        text = spec.get('text')
+        if text is not None and (not isinstance(text, str) or len(text) > MAX_TEXT_CHARS):
+            raise ServiceException("text must be a string of at most %d characters" % MAX_TEXT_CHARS)
+        # path -> sha256 of the stored inputs of the job
+        file_hashes = {}
+        text_file = None
+        if spec.get('text_sha256'):
+            text_file = self._stored_input(spec['text_sha256'], KIND_TEXT, file_hashes)
+        fonts = spec['fonts'] if isinstance(spec['fonts'], list) else [spec['fonts']]
+        ttf_files = []
+        for font in fonts:
+            if isinstance(font, str) and DIGEST_RE.match(font):
+                ttf_files.append(self._stored_input(font, KIND_FONT, file_hashes))
+                continue
+            if not isinstance(font, str) or os.path.basename(font) != font:
+                raise ServiceException("fonts are file names of the font directory or sha256 of stored fonts")
+            ttf_file = os.path.join(self.font_path, font)
+            if not os.path.isfile(ttf_file):
+                raise ServiceException("unknown font %s" % font)
+            ttf_files.append(ttf_file)
+        options = dict((key, JOB_DEFAULTS[key]) for key in CLIENT_OPTIONS + ('publish',))
+        options.update((key, spec[key]) for key in client_options if key in spec)
+        if options['mode'] not in MODES:
+            raise ServiceException("mode must be one of %s" % ", ".join(MODES))
+        for key in OPTION_LIMITS:
+            options[key] = _clamp_options(key, options[key])
+
+        training_path = os.path.join(self.ref_path, "%s_%s" % (lang_name, job_id))
+        os.makedirs(training_path)
+        if text_file is None:
+            text_file = os.path.join(training_path, 'training_text.txt')
+            with open(text_file, 'w', encoding='UTF-8') as fp:
+                fp.write(text)
+        return TrainingJob(name=job_id, ref_path=self.ref_path, tessdata_path=self.tessdata_path,
+                           lang_name=lang_name, training_text=text_file, font_set='api', ttf_file_list=ttf_files,
+                           font_size=spec['font_size'], train_id=job_id, word_list=None, on_exists='keep',
+                           verbose=False, file_hashes=file_hashes, **options)
+
+    def _stored_input(self, sha256, kind, file_hashes):
+        if self.input_store is None:
+            raise ServiceException("no input store is configured")
+        path = self.input_store.path(sha256, kind)
+        file_hashes[path] = sha256
+        return path
+
+    def _run(self, job_id, job):
+        from django_web.tesseract_trainer.batch import run_job
+
+        status = self.jobs[job_id]
+        with self.lock:
+            status['state'] = STATE_RUNNING
+            status['started'] = time.time()
+            self.queue_waits.append(status['started'] - status['submitted'])
+        try:
+            result = self.pool.submit(run_job, job).result()
+        except Exception as e:
+            result = {'status': STATE_FAILED, 'output': None, 'error': "%s: %s" % (type(e).__name__, e)}
+        with self.lock:
+            status['state'] = STATE_OK if result['status'] == 'ok' else STATE_FAILED
+            status['finished'] = time.time()
+            status['output'] = result['output']
+            status['error'] = result['error']
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, status in self.jobs.items() if status['finished'] is not None]
+        for job_id in finished[:max(0, len(finished) - KEEP_FINISHED)]:
+            del self.jobs[job_id]
+
+    def status(self, job_id):
+        with self.lock:
+            status = self.jobs.get(job_id)
+            if status is None:
+                raise KeyError(job_id)
+            status = dict(status)
+        end = status['finished'] or time.time()
+        status['seconds'] = end - status['started'] if status['started'] else None
+        # only the training folder name is returned, not the server path
+        if status['output']:
+            status['output'] = os.path.relpath(status['output'], self.ref_path)
+        return status
+
+    def snapshot(self):
+        """ Queue and worker statistics """
+        with self.lock:
+            states = [status['state'] for status in self.jobs.values()]
+            waits = sorted(self.queue_waits)
+            snapshot = {'workers': self.workers,
+                        'submitted': self.submitted,
+                        'refused': self.refused}
+        for state in (STATE_QUEUED, STATE_RUNNING, STATE_OK, STATE_FAILED):
+            snapshot[state] = states.count(state)
+        snapshot['busy_workers'] = snapshot[STATE_RUNNING]
+        snapshot['queue_wait_ms'] = dict(
+            ('p%d' % p, 1000.0 * waits[max(0, int(math.ceil(p / 100.0 * len(waits))) - 1)] if waits else None)
+            for p in (50, 90, 99))
+        return snapshot
+
+
+def _is_name(value):
+    return isinstance(value, str) and value.replace('_', '').isalnum()
+
+
+def _clamp_options(key, value):
+    """ Option dict of a job (or true, or None) with its numbers clamped into OPTION_LIMITS[key] """
+    if value is None or value is True or value is False:
+        return value
+    if not isinstance(value, dict):
+        raise ServiceException("%s must be an object or true" % key)
+    limits = OPTION_LIMITS[key]
+    unknown = set(value) - set(limits)
+    if unknown and key not in OPEN_OPTIONS:
+        raise ServiceException("unknown %s options: %s" % (key, ", ".join(sorted(unknown))))
+    clamped = dict(value)
+    for name, (low, high) in limits.items():
+        if name not in value or value[name] is None:
+            continue
+        if high == 'cpus':
+            high = os.cpu_count() or 1
+        number = value[name]
+        if isinstance(number, bool) or not isinstance(number, (int, float)) or \
+                (isinstance(low, int) and not isinstance(number, int)):
+            raise ServiceException("%s.%s must be %s" % (key, name, "an integer" if isinstance(low, int) else "a number"))
+        clamped[name] = min(max(number, low), high)
+    return clamped
+
+
+def _check_font_size(font_size):
+    """ A font size or a list of at most MAX_FONT_SIZES of them, integers of FONT_SIZE_LIMITS """
+    sizes = font_size if isinstance(font_size, list) else [font_size]
+    low, high = FONT_SIZE_LIMITS
+    if len(sizes) > MAX_FONT_SIZES or not all(
+            isinstance(size, int) and not isinstance(size, bool) and low <= size <= high for size in sizes):
+        raise ServiceException("font_size must be an integer from %d to %d or a list of at most %d of them" % (
+            low, high, MAX_FONT_SIZES))
+
+
+def template_start_method():
+    """ Start method of the warm pool template: the forkserver does not inherit the locks of other threads """
+    import multiprocessing
+
+    return 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'fork'
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_training_service():
+    """ The training service of the process, configured from the django settings """
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                from django.conf import settings
+                from django_web.input_store import get_input_store
+
+                input_store = get_input_store() if getattr(settings, 'INPUT_STORE_PATH', None) else None
+                _service = TrainingService(settings.TRAIN_REF_PATH, settings.OCR_TESSDATA_PATH,
+                                           settings.TRAIN_FONT_PATH,
+                                           workers=getattr(settings, 'TRAIN_WORKERS', WORKERS),
+                                           max_queued=getattr(settings, 'TRAIN_MAX_QUEUED', MAX_QUEUED),
+                                           input_store=input_store,
+                                           allow_publish=getattr(settings, 'TRAIN_ALLOW_PUBLISH', False))
+    return _service
@@ -0,0 +1,94 @@
+# coding:utf-8
+"""
+Streaming corpus reader.
+
+A training corpus can be several GB while the character set it covers is small.
+CharIndex memory-maps the corpus, decodes it chunk by chunk and counts every character
+in a single pass, so the text itself is never held in memory. The training text is then
+derived from the index: every character once, or repeated up to a frequency cap,
+optionally shuffled with a fixed seed.
+"""
+import codecs
+import io
+import mmap
+import os
+import random
+from collections import Counter
+
+# bytes decoded at a time when reading a corpus
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class CharIndex(object):
+    """ Character frequency index of a corpus """
+
+    def __init__(self, counts=None):
+        # character -> number of occurrences, in order of first appearance
+        self.counts = Counter(counts or {})
+
+    @classmethod
+    def from_file(cls, file_path, encoding="UTF-8", chunk_size=CHUNK_SIZE):
+        """ Build the index of a text file in one pass, without loading the whole file
+        :param file_path: path of the corpus
+        :param encoding: encoding of the corpus
+        :param chunk_size: number of bytes decoded at a time
+        :return: CharIndex
+        """
+        index = cls()
+        decoder = codecs.getincrementaldecoder(encoding)()
+        with open(file_path, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                return index
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for start in range(0, len(mm), chunk_size):
+                    # the incremental decoder keeps multi-byte characters cut by the chunk boundary
+                    index.add_text(decoder.decode(mm[start:start + chunk_size]))
+        index.add_text(decoder.decode(b'', final=True))
+        return index
+
+    def add_text(self, text):
+        """ Count the non-whitespace characters of text """
+        self.counts.update(text)
+        for char in [c for c in self.counts if c.isspace()]:
+            del self.counts[char]
+
+    def unique_chars(self):
+        """ All indexed characters, most frequent first """
+        return [char for char, _ in self.counts.most_common()]
+
+    def __len__(self):
+        return len(self.counts)
+
+    def total(self):
+        """ Number of indexed characters, repetitions included """
+        return sum(self.counts.values())
+
+    def training_text(self, max_repeat=1, min_count=1, shuffle_seed=None):
+        """ Derive the training character sequence from the index
+        :param max_repeat: 每个字最多重复的次数, None则保留全部出现次数(训练文本与语料去掉空白后一样长)
+        :param min_count: 出现次数少于min_count的字不参与训练
+        :param shuffle_seed: 不为None时用该种子打乱字符顺序, 同一种子结果相同(需要一个每个字一项的列表)
+        :return: training text, without whitespace
+        """
+        chars = [(char, count) for char, count in self.counts.most_common() if count >= min_count]
+        if max_repeat is not None:
+            chars = [(char, min(count, max_repeat)) for char, count in chars]
+        # repeat in rounds: every character once, then the ones appearing twice and so on,
+        # so that a page always mixes different characters. chars is sorted by decreasing
+        # count, the characters of a round are thus a prefix of it, written as a slice of
+        # the string of all characters: the text is built once, without a list of its characters
+        order = "".join(char for char, _ in chars)
+        text = io.StringIO()
+        size = len(chars)
+        round_nb = 0
+        while size > 0:
+            while size > 0 and chars[size - 1][1] <= round_nb:
+                size -= 1
+            text.write(order[:size])
+            round_nb += 1
+        text = text.getvalue()
+        if shuffle_seed is not None:
+            sequence = list(text)
+            random.Random(shuffle_seed).shuffle(sequence)
+            text = "".join(sequence)
+        return text
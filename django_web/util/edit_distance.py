@@ -0,0 +1,316 @@
+# coding:utf-8
+"""
+Edit distances and error rates of recognized text against its ground truth.
+
+The Levenshtein distance is computed with the bit-parallel algorithm of Myers, in the form
+given by Hyyrö: a column of the dynamic programming matrix is held in the bits of two
+integers and advanced by one item of the other sequence with a dozen bitwise operations.
+- distance() uses python ints as bit vectors, of any length: a 5000 character page costs
+  5000 steps over 80 machine words instead of 25 million python operations;
+- distances() scores many pairs at once: the pairs whose shorter side (after removing the
+  common prefix and suffix) fits in 64 items run side by side in numpy uint64 lanes, one
+  step advancing every lane; the others go through distance().
+
+Items may be characters (strings) or words (lists of strings): the word error rate uses
+the same code on split text.
+
+The confusion counts (which character was read as which) need the alignment itself: the
+bit vectors of every column are kept and the path is traced back through them, reading
+only the cells along it.
+
+usage:
+    distance("中华人民共和国", "中华人民共合国")   # 1
+    distances([(truth, text), ...])                  # list of distances
+
+    counts = ErrorCounts(confusions=True)
+    counts.add_pages(zip(truth_pages, recognized_pages))
+    counts.cer(), counts.wer(), counts.top_confusions(10)
+"""
+from collections import Counter
+
+from django_web.util.lazy_import import LazyModule
+
+np = LazyModule("numpy")
+
+LANE_BITS = 64  # items of the shorter side of a pair held by one numpy lane
+LANE_BLOCK = 4096  # pairs advanced together by distances()
+EQ_COLUMNS = 64  # items of the longer sides compared at a time when building the match masks
+MAX_ALIGN_CELLS = 200 * 1000 * 1000  # Default largest matrix aligned for the confusion counts (25MB per vector)
+
+# set bits of an int (int.bit_count from python 3.10)
+_popcount = getattr(int, 'bit_count', None) or (lambda value: bin(value).count('1'))
+
+
+def _trim(a, b):
+    """ Length of the common prefix and suffix of two sequences, found by bisection on slices """
+    limit = min(len(a), len(b))
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    prefix = low
+    low, high = 0, limit - prefix
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[len(a) - middle:] == b[len(b) - middle:]:
+            low = middle
+        else:
+            high = middle - 1
+    return prefix, low
+
+
+def _middle(a, b):
+    prefix, suffix = _trim(a, b)
+    return a[prefix:len(a) - suffix], b[prefix:len(b) - suffix]
+
+
+def distance(a, b):
+    """ Levenshtein distance of two sequences (strings, lists of words...) """
+    a, b = _middle(a, b)
+    # the longer side is the bit vector: the python loop runs over the shorter one
+    pattern, text = (a, b) if len(a) >= len(b) else (b, a)
+    m = len(pattern)
+    if not text:
+        return m
+    peq = {}
+    for i, item in enumerate(pattern):
+        peq[item] = peq.get(item, 0) | (1 << i)
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    pv, mv, score = mask, 0, m
+    for item in text:
+        eq = peq.get(item, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+    return score
+
+
+def distances(pairs):
+    """ Levenshtein distances of many pairs of sequences
+    :param pairs: iterable of (a, b)
+    :return: list of distances, in the order of the pairs
+    """
+    results = []
+    lanes = []
+    vocabulary = {}
+    for index, (a, b) in enumerate(pairs):
+        a, b = _middle(a, b)
+        short, long_ = (a, b) if len(a) <= len(b) else (b, a)
+        results.append(len(long_))
+        if not short:
+            continue
+        if len(short) > LANE_BITS:
+            results[index] = distance(short, long_)
+        else:
+            lanes.append((len(long_), index, _codes(short, vocabulary), _codes(long_, vocabulary)))
+    # lanes of similar lengths together: a block runs as many steps as its longest text
+    lanes.sort(key=lambda lane: lane[0])
+    for start in range(0, len(lanes), LANE_BLOCK):
+        block = lanes[start:start + LANE_BLOCK]
+        for (_, index, _, _), score in zip(block, _lane_distances(block)):
+            results[index] = int(score)
+    return results
+
+
+def _codes(sequence, vocabulary):
+    """ Items of a sequence as integers: code points for strings, vocabulary numbers otherwise """
+    if isinstance(sequence, str):
+        return np.frombuffer(sequence.encode('utf-32-le'), dtype='<u4').astype(np.int64)
+    # above the unicode range, words never equal characters
+    return np.array([vocabulary.setdefault(item, 0x110000 + len(vocabulary)) for item in sequence], dtype=np.int64)
+
+
+def _lane_distances(block):
+    """ Myers/Hyyrö advanced on all lanes of a block at once
+    :param block: list of (text length, index, pattern codes, text codes), patterns of LANE_BITS items at most
+    """
+    count = len(block)
+    steps = block[-1][0]
+    patterns = np.full((count, LANE_BITS), -1, dtype=np.int64)
+    texts = np.full((count, steps), -2, dtype=np.int64)
+    lengths = np.empty(count, dtype=np.int64)
+    masks = np.empty(count, dtype=np.uint64)
+    highs = np.empty(count, dtype=np.uint64)
+    for lane, (length, _, pattern, text) in enumerate(block):
+        patterns[lane, :len(pattern)] = pattern
+        texts[lane, :length] = text
+        lengths[lane] = length
+        masks[lane] = (1 << len(pattern)) - 1
+        highs[lane] = 1 << (len(pattern) - 1)
+    # eq[lane, j]: bits of the pattern items equal to item j of the text
+    eq = np.empty((count, steps), dtype=np.uint64)
+    for column in range(0, steps, EQ_COLUMNS):
+        equal = patterns[:, None, :] == texts[:, column:column + EQ_COLUMNS, None]
+        eq[:, column:column + EQ_COLUMNS] = np.packbits(equal, axis=-1, bitorder='little').view('<u8')[..., 0]
+    one = np.uint64(1)
+    pv = masks.copy()
+    mv = np.zeros(count, dtype=np.uint64)
+    scores = np.array([len(lane[2]) for lane in block], dtype=np.int64)
+    # bits above a lane's pattern hold garbage: carries and shifts only move it up, it never reaches high
+    for j in range(steps):
+        current = eq[:, j]
+        xv = current | mv
+        xh = (((current & pv) + pv) ^ pv) | current
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        active = lengths > j
+        scores += ((ph & highs) != 0) & active
+        scores -= ((mh & highs) != 0) & active
+        ph = (ph << one) | one
+        mh = mh << one
+        pv = mh | ~(xv | ph)
+        mv = ph & xv
+    return scores
+
+
+def _columns(pattern, text):
+    """ Vertical deltas of every column of the matrix, as (pv, mv) bit vectors: bit i - 1 of pv (mv) is set when
+    D[i][j] - D[i - 1][j] is +1 (-1)
+    """
+    m = len(pattern)
+    peq = {}
+    for i, item in enumerate(pattern):
+        peq[item] = peq.get(item, 0) | (1 << i)
+    mask = (1 << m) - 1
+    pv, mv = mask, 0
+    columns = []
+    for item in text:
+        eq = peq.get(item, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+        columns.append((pv, mv))
+    return columns
+
+
+def align(a, b, max_cells=MAX_ALIGN_CELLS):
+    """ Edit operations turning a into b, matches omitted
+    The bit vectors of every column are kept: any cell of the matrix is D[0][j] plus the vertical deltas above
+    it, and the trace back reads the few cells along the path.
+    :param max_cells: largest matrix aligned (a bit per cell and per vector)
+    :return: list of (item of a or None, item of b or None): substitutions, deletions (None in b),
+        insertions (None in a); None when the matrix exceeds max_cells
+    """
+    a, b = _middle(a, b)
+    n, m = len(a), len(b)
+    if not n or not m:
+        return [(item, None) for item in a] + [(None, item) for item in b]
+    if n * m > max_cells:
+        return None
+    columns = _columns(a, b)
+
+    def cost(i, j):
+        if j == 0:
+            return i
+        pv, mv = columns[j - 1]
+        low = (1 << i) - 1
+        return j + _popcount(pv & low) - _popcount(mv & low)
+
+    operations = []
+    i, j = n, m
+    here = cost(i, j)
+    while i > 0 and j > 0:
+        diagonal = cost(i - 1, j - 1)
+        if diagonal + (a[i - 1] != b[j - 1]) == here:
+            if a[i - 1] != b[j - 1]:
+                operations.append((a[i - 1], b[j - 1]))
+            i, j, here = i - 1, j - 1, diagonal
+        elif cost(i - 1, j) + 1 == here:
+            operations.append((a[i - 1], None))
+            i, here = i - 1, here - 1
+        else:
+            operations.append((None, b[j - 1]))
+            j, here = j - 1, here - 1
+    operations.extend((a[k], None) for k in range(i - 1, -1, -1))
+    operations.extend((None, b[k]) for k in range(j - 1, -1, -1))
+    operations.reverse()
+    return operations
+
+
+class ErrorCounts(object):
+    """ Character and word errors of recognized pages against their ground truth """
+
+    def __init__(self, confusions=False, ignore_whitespace=True, max_align_cells=MAX_ALIGN_CELLS):
+        """
+        :param confusions: 是否统计字符混淆(期望字符 -> 识别结果), 需要回溯对齐, 比只算距离慢
+        :param ignore_whitespace: 字符错误率不计空白字符
+        :param max_align_cells: 对齐的最大矩阵大小(字符数之积), 超过的页面不统计混淆(见unaligned)
+        """
+        self.ignore_whitespace = ignore_whitespace
+        self.max_align_cells = max_align_cells
+        self.char_errors = 0
+        self.chars = 0
+        self.word_errors = 0
+        self.words = 0
+        self.pages = 0
+        # (expected char or '', recognized char or '') -> occurrences
+        self.confusions = Counter() if confusions else None
+        # pages with too many errors to be aligned
+        self.unaligned = 0
+
+    def add(self, expected, actual):
+        self.add_pages([(expected, actual)])
+
+    def add_pages(self, pages):
+        """ Count the errors of (expected text, recognized text) pairs, scored together """
+        pages = list(pages)
+        if self.ignore_whitespace:
+            chars = [("".join(expected.split()), "".join(actual.split())) for expected, actual in pages]
+        else:
+            chars = pages
+        words = [(expected.split(), actual.split()) for expected, actual in pages]
+        char_distances = distances(chars)
+        self.char_errors += sum(char_distances)
+        self.chars += sum(len(expected) for expected, _ in chars)
+        self.word_errors += sum(distances(words))
+        self.words += sum(len(expected) for expected, _ in words)
+        self.pages += len(pages)
+        if self.confusions is None:
+            return
+        for (expected, actual), dist in zip(chars, char_distances):
+            if not dist:
+                continue
+            operations = align(expected, actual, self.max_align_cells)
+            if operations is None:
+                self.unaligned += 1
+                continue
+            self.confusions.update((wanted or '', found or '') for wanted, found in operations)
+
+    def cer(self):
+        """ Character error rate: edit distance / expected characters """
+        return float(self.char_errors) / self.chars if self.chars else 0.0
+
+    def wer(self):
+        """ Word error rate: edit distance over words / expected words """
+        return float(self.word_errors) / self.words if self.words else 0.0
+
+    def top_confusions(self, count=20):
+        """ Most frequent errors: list of ((expected char or '', recognized char or ''), occurrences) """
+        return self.confusions.most_common(count) if self.confusions is not None else []
+
+    def to_dict(self, confusions=20):
+        result = {'cer': self.cer(), 'wer': self.wer(), 'char_errors': self.char_errors, 'chars': self.chars,
+                  'word_errors': self.word_errors, 'words': self.words, 'pages': self.pages}
+        if self.confusions is not None:
+            result['confusions'] = [[wanted, found, occurrences]
+                                    for (wanted, found), occurrences in self.top_confusions(confusions)]
+            result['unaligned'] = self.unaligned
+        return result
@@ -1,6 +1,12 @@
 # coding:utf-8
+import hashlib
 import os
 
+# bytes hashed at a time
+HASH_CHUNK_SIZE = 1024 * 1024
+# (path, size, mtime) -> sha256, so that a file is only hashed once per process
+_hash_memo = dict()
+
 
 def read_file(path, filename):
     """
@@ -11,13 +17,9 @@ def read_file(path, filename):
     :return:
     """
     file_path = os.path.join(path, filename)
-    fopen = open(file_path, 'r',encoding="UTF-8")
-    result = ""
-    for eachline in fopen:
-        # 剪切开头的日期得到操作对象的json字符串
-        result += eachline
-    fopen.close()
-    return result
+    # 一次性读入, 逐行拼接字符串在大文件上是平方复杂度; 超大语料请用corpus.CharIndex
+    with open(file_path, 'r', encoding="UTF-8") as fopen:
+        return fopen.read()
 
 
 def writeFile(path, filename, data):
@@ -34,6 +36,35 @@ def writeFile(path, filename, data):
     fopen.close()
 
 
+def file_hash(file_path):
+    """
+    文件内容的sha256, 按块读取, 同一进程内文件未修改时不重复计算
+    :param file_path:
+    :return: hex digest
+    """
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    digest = _hash_memo.get(key)
+    if digest is None:
+        sha = hashlib.sha256()
+        with open(file_path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        _hash_memo[key] = digest
+    return digest
+
+
+def remember_hash(file_path, digest):
+    """
+    记录已经算好的文件sha256(例如上传时边接收边计算的), file_hash不再读取文件; 文件修改后失效
+    :param file_path:
+    :param digest: hex digest
+    """
+    stat = os.stat(file_path)
+    _hash_memo[(os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)] = digest
+
+
 if __name__ == '__main__':
     from django_web.django_setting import *
     resource = os.path.join(BASE_DIR,"django_web/resource/train_text")
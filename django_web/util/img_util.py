@@ -1,17 +1,17 @@
 # -*- coding: utf-8 -*-
 import os
-import cv2
-from numpy import ndarray, array
-import numpy as np
 import sys
 import time
-from django.conf import settings
-from libtiff import TIFF
 import logging
-from PIL import Image
+from img_ai_trainer.settings import BASE_DIR
+from django_web.util.lazy_import import LazyModule
+
+# heavy dependencies are only imported when an image function actually needs them
+cv2 = LazyModule("cv2")
+np = LazyModule("numpy")
+libtiff = LazyModule("libtiff")
 
 logger = logging.getLogger('django_logger')
-BASE_DIR = settings.BASE_DIR
 
 RESOURCE = os.path.join(BASE_DIR, "django_web/resource")
 TEMP = os.path.join(BASE_DIR, "django_web/temp")
@@ -67,7 +67,7 @@ def write_tif_image(img, path, file_name):
     if file_name.find(".tif") < 0:
         file_name += ".tif"
     file_path = os.path.join(path, file_name)
-    out_tiff = TIFF.open(file_path, mode='w')
+    out_tiff = libtiff.TIFF.open(file_path, mode='w')
     out_tiff.write_image(img, compression=None, write_rgb=True)
     out_tiff.close()
 
@@ -85,10 +85,10 @@ def img_resize(img, dwidth):
     :param dwidth:
     :return:
     """
-    if isinstance(img, ndarray):
+    if isinstance(img, np.ndarray):
         size = img.shape
     elif isinstance(img, list):
-        img = array(img)
+        img = np.array(img)
         size = img.size
         if len(size) < 2:
             return None
@@ -109,10 +109,10 @@ def img_resize_with_scale(img, dwidth, restrict_width_to_long_side=False):
     :param restrict_width_to_long_side
     :return:
     """
-    if isinstance(img, ndarray):
+    if isinstance(img, np.ndarray):
         size = img.shape
     elif isinstance(img, list):
-        img = array(img)
+        img = np.array(img)
         size = img.size
         if len(size) < 2:
             return None
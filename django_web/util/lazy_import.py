@@ -0,0 +1,35 @@
+# coding:utf-8
+"""
+Deferred module imports.
+
+cv2, PIL, libtiff, numpy and django are expensive to import, and most worker
+processes (page rendering, a single tesseract stage, a CLI invocation) only
+need a few of them. A LazyModule stands in for the real module and imports it
+the first time one of its attributes is used.
+"""
+import importlib
+
+
+class LazyModule(object):
+    """ Proxy importing the wrapped module on first attribute access """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    @property
+    def loaded(self):
+        """ True once the wrapped module has actually been imported """
+        return self._module is not None
+
+    def __getattr__(self, item):
+        return getattr(self._load(), item)
+
+    def __repr__(self):
+        state = "loaded" if self.loaded else "not loaded"
+        return "<LazyModule %s (%s)>" % (self._name, state)
@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-scale mask matching: locate the fields of a document (id card labels...) in a photo
+taken at an unknown distance, and estimate the rotation of the document.
+
+Every mask (see img_util.get_mask) is searched at all scales at once with normalized cross
+correlation (NCC):
+- the correlations are products in the Fourier domain: the photo is transformed once per
+  pyramid level, the zero-mean masks are transformed once per scale and cached, one batched
+  inverse FFT gives the correlation maps of a whole stack of masks/scales. The scales are
+  powers of scale_step, the cached spectra serve photos of any size;
+- the local mean and energy of the photo under a mask come from integral images, for every
+  mask size with a few vectorized slices;
+- the search runs on a small level of the photo pyramid (work_width px wide), the best
+  match of each mask is then refined on a larger level (refine_width) in a window around
+  it, at the neighbouring scales and a few rotations of the mask.
+
+When masks come with their anchor (position of the mask in the reference document), a
+similarity transform reference -> photo is fitted on the pair of found fields most others
+agree with; fields missed or misplaced by the search are looked for again where the
+transform puts them. The angle comes from img_util.get_angle_from_transform.
+
+usage:
+    matcher = MaskMatcher({'name': get_mask('name.png', 0), 'number': get_mask('number.png', 0)},
+                          anchors={'name': (40, 60), 'number': (200, 400)})
+    result = matcher.match(gray_photo)
+    result['regions']['name']   # Match: region [x, y, w, h] in the photo, score, scale, angle
+    result['angle']             # degrees, None with less than 2 anchored fields found
+
+see test/bench_mask_match.py for the latency and accuracy on generated samples.
+"""
+import hashlib
+import math
+import time
+from collections import OrderedDict
+
+from django_web.util.img_util import find_max_region, get_angle_from_transform
+from django_web.util.lazy_import import LazyModule
+
+cv2 = LazyModule("cv2")
+np = LazyModule("numpy")
+Image = LazyModule("PIL.Image")
+
+MIN_SCALE = 0.5  # Default smallest scale of the document in the photo, relative to the masks
+MAX_SCALE = 2.0  # Default largest scale
+SCALE_STEP = 1.13  # Default ratio between two searched scales
+ANGLES = (-4.0, -2.0, 0.0, 2.0, 4.0)  # Default rotations of the masks tried when refining, in degrees
+WORK_WIDTH = 320  # Default width of the pyramid level searched at all scales, in px
+REFINE_WIDTH = 1000  # Default width of the level the matches are refined on, in px
+MIN_SCORE = 0.5  # Default NCC below which a mask is reported as not found
+COARSE_RATIO = 0.6  # coarse matches scoring below COARSE_RATIO * min_score are not refined
+MIN_MASK_SIDE = 6  # masks scaled below this size are not searched on a level
+FFT_BATCH = 16  # masks x scales correlated by one batched FFT
+MAX_CACHED_IMAGES = 8  # pyramids of recent photos kept, keyed by content
+MAX_CACHED_SPECTRA = 256  # spectra of scaled masks kept
+MAX_CACHED_MASKS = 1024  # scaled and rotated masks kept
+
+_cv2_available = None
+
+
+class Match(object):
+    """ Location of a mask in a photo """
+    __slots__ = ('name', 'region', 'score', 'scale', 'angle')
+
+    def __init__(self, name, region, score, scale, angle=0.0):
+        self.name = name
+        # [x, y, w, h] in the photo, box of the unrotated mask around the found center
+        self.region = region
+        self.score = score
+        self.scale = scale
+        self.angle = angle
+
+    def center(self):
+        x, y, w, h = self.region
+        return x + w / 2.0, y + h / 2.0
+
+    def __repr__(self):
+        return "<Match %s %s score %.3f scale %.3f angle %.1f>" % (self.name, self.region, self.score, self.scale,
+                                                                   self.angle)
+
+
+class MaskMatcher(object):
+    """ Search a set of masks in photos, at all scales of a range """
+
+    def __init__(self, masks, anchors=None, min_scale=MIN_SCALE, max_scale=MAX_SCALE, scale_step=SCALE_STEP,
+                 angles=ANGLES, work_width=WORK_WIDTH, refine_width=REFINE_WIDTH, min_score=MIN_SCORE):
+        """
+        :param masks: dict 名称 -> 灰度mask图片(numpy数组), 参考文档分辨率下的大小
+        :param anchors: 可选, dict 名称 -> mask中心在参考文档中的坐标(x, y), 用于估计旋转角度和补找漏掉的mask
+        :param min_scale: 照片中文档相对mask的最小缩放
+        :param max_scale: 最大缩放
+        :param scale_step: 相邻两个搜索缩放的比例
+        :param angles: 精确定位时尝试的mask旋转角度(度, 逆时针为正)
+        :param work_width: 全尺度搜索使用的图片宽度(px)
+        :param refine_width: 精确定位使用的图片宽度(px)
+        :param min_score: NCC低于此值时认为没有找到
+        """
+        if not masks:
+            raise ValueError("no mask to match")
+        if not 0 < min_scale <= max_scale or scale_step <= 1:
+            raise ValueError("scales must satisfy 0 < min_scale <= max_scale and scale_step > 1")
+        self.masks = OrderedDict((name, _gray(mask).astype(np.float32)) for name, mask in masks.items())
+        self.anchors = dict(anchors or {})
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.scale_step = scale_step
+        self.angles = tuple(angles) or (0.0,)
+        self.work_width = work_width
+        self.refine_width = refine_width
+        self.min_score = min_score
+        # (mask name, scale, angle) -> zero-mean scaled mask and its norm
+        self._mask_cache = OrderedDict()
+        # (mask name, ladder index, fft shape) -> conjugate spectrum of the scaled mask
+        self._spectrum_cache = OrderedDict()
+        self._image_cache = OrderedDict()
+
+    def match(self, image):
+        """ Locate the masks in a photo
+        :param image: grayscale or BGR photo
+        :return: dict with regions (name -> Match, masks found), bounds (region holding the found fields,
+            None if nothing found), angle (degrees, or None), transform (2x3 reference -> photo matrix in the
+            form of cv2.getRotationMatrix2D, or None), seconds
+        """
+        start = time.time()
+        levels = self._pyramid(image)
+        work, work_factor = levels['work']
+        regions = {}
+        for name, (score, scale, x, y) in self._search(work, work_factor).items():
+            if score < self.min_score * COARSE_RATIO:
+                continue
+            mask_h, mask_w = self.masks[name].shape
+            center = (x / work_factor + mask_w * scale / 2.0, y / work_factor + mask_h * scale / 2.0)
+            step = math.sqrt(self.scale_step)
+            match = self._refine(levels, name, (scale / step, scale, scale * step), self.angles, center,
+                                 2.0 / work_factor)
+            if match.score >= self.min_score:
+                regions[name] = match
+        transform = self._fit_transform(regions)
+        if transform is not None:
+            regions = self._verify(levels, regions)
+            transform = self._fit_transform(regions)
+        angle = get_angle_from_transform(np.vstack([transform, [0, 0, 1]])) if transform is not None else None
+        bounds = find_max_region([m.region for m in regions.values()]) if regions else None
+        return {'regions': regions,
+                'bounds': [int(v) for v in bounds] if bounds is not None else None,
+                'angle': float(angle) if angle is not None else None,
+                'transform': transform,
+                'seconds': time.time() - start}
+
+    def _pyramid(self, image):
+        """ Work and refine levels of a photo, cached by content for repeated photos """
+        image = _gray(image)
+        key = hashlib.sha1(np.ascontiguousarray(image).view(np.uint8)).hexdigest() + str(image.shape)
+        levels = self._image_cache.get(key)
+        if levels is not None:
+            self._image_cache.move_to_end(key)
+            return levels
+        height, width = image.shape
+        levels = {'full': (image.astype(np.float32), 1.0)}
+        for level, target in (('refine', self.refine_width), ('work', self.work_width)):
+            factor = min(1.0, float(target) / width)
+            if factor < 1.0:
+                size = (max(1, int(round(width * factor))), max(1, int(round(height * factor))))
+                levels[level] = (_resize(image, size).astype(np.float32), size[0] / float(width))
+            else:
+                levels[level] = levels['full']
+        self._image_cache[key] = levels
+        while len(self._image_cache) > MAX_CACHED_IMAGES:
+            self._image_cache.popitem(last=False)
+        return levels
+
+    def _scaled_mask(self, name, scale, angle=0.0):
+        """ Zero-mean mask at a scale and rotation, and its L2 norm """
+        key = (name, round(scale, 6), angle)
+        cached = self._mask_cache.get(key)
+        if cached is not None:
+            self._mask_cache.move_to_end(key)
+            return cached
+        mask = self.masks[name]
+        height, width = mask.shape
+        size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+        scaled = mask if size == (width, height) else _resize(mask, size).astype(np.float32)
+        if angle:
+            scaled = _rotate(scaled, angle)
+        scaled = scaled - scaled.mean()
+        cached = self._mask_cache[key] = (scaled, float(np.sqrt((scaled * scaled).sum())))
+        while len(self._mask_cache) > MAX_CACHED_MASKS:
+            self._mask_cache.popitem(last=False)
+        return cached
+
+    def _ladder(self, factor):
+        """ Scales searched on a level: powers of scale_step covering the scale range, so that the scaled
+        masks and their spectra are shared by photos of different sizes
+        :return: [(ladder index, scale of the masks on the level)]
+        """
+        log_step = math.log(self.scale_step)
+        low = int(math.floor(math.log(self.min_scale * factor) / log_step))
+        high = int(math.ceil(math.log(self.max_scale * factor) / log_step))
+        return [(k, self.scale_step ** k) for k in range(low, high + 1)]
+
+    def _spectrum(self, name, k, level_scale, shape):
+        key = (name, k, shape)
+        spectrum = self._spectrum_cache.get(key)
+        if spectrum is not None:
+            self._spectrum_cache.move_to_end(key)
+            return spectrum
+        mask, _ = self._scaled_mask(name, level_scale)
+        padded = np.zeros(shape, dtype=np.float32)
+        padded[:mask.shape[0], :mask.shape[1]] = mask
+        spectrum = self._spectrum_cache[key] = np.conj(np.fft.rfft2(padded))
+        while len(self._spectrum_cache) > MAX_CACHED_SPECTRA:
+            self._spectrum_cache.popitem(last=False)
+        return spectrum
+
+    def _search(self, image, factor):
+        """ Best match of every mask over all scales on one level
+        :return: dict name -> (score, scale, x, y) with x, y the top left corner on the level
+        """
+        height, width = image.shape
+        shape = (_fast_len(height), _fast_len(width))
+        templates = []
+        for name in self.masks:
+            for k, level_scale in self._ladder(factor):
+                mask, norm = self._scaled_mask(name, level_scale)
+                if min(mask.shape) >= MIN_MASK_SIDE and mask.shape[0] <= height and mask.shape[1] <= width \
+                        and norm > 0:
+                    templates.append((name, k, level_scale, mask, norm))
+        image_spectrum = np.fft.rfft2(image, s=shape)
+        integral, integral_sq = _integrals(image)
+        best = {}
+        for start in range(0, len(templates), FFT_BATCH):
+            batch = templates[start:start + FFT_BATCH]
+            products = np.empty((len(batch),) + image_spectrum.shape, dtype=image_spectrum.dtype)
+            for idx, (name, k, level_scale, _, _) in enumerate(batch):
+                np.multiply(self._spectrum(name, k, level_scale, shape), image_spectrum, out=products[idx])
+            correlations = np.fft.irfft2(products, s=shape)
+            for (name, k, level_scale, mask, norm), correlation in zip(batch, correlations):
+                ncc = _ncc(correlation, integral, integral_sq, mask.shape, norm)
+                pos = int(np.argmax(ncc))
+                y, x = divmod(pos, ncc.shape[1])
+                score = float(ncc[y, x])
+                if score > best.get(name, (-1.0,))[0]:
+                    best[name] = (score, level_scale / factor, x, y)
+        return best
+
+    def _refine(self, levels, name, scales, angles, center, spread):
+        """ Best match of a mask around an approximate position, on the refine level
+        :param scales: scales of the document tried
+        :param angles: rotations of the mask tried, in degrees
+        :param center: approximate center of the mask, in photo coordinates
+        :param spread: uncertainty of the center, in photo px
+        """
+        image, factor = levels['refine']
+        height, width = image.shape
+        candidates = []
+        for scale in scales:
+            for angle in angles:
+                mask, norm = self._scaled_mask(name, scale * factor, angle)
+                if norm > 0 and mask.shape[0] <= height and mask.shape[1] <= width:
+                    candidates.append((scale, angle, mask, norm))
+        if not candidates:
+            return Match(name, None, -1.0, scales[0])
+        # one window around the center holds all the candidates: the position is known within spread,
+        # plus the change of scale
+        mask_h = max(c[2].shape[0] for c in candidates)
+        mask_w = max(c[2].shape[1] for c in candidates)
+        half_w = int(math.ceil(mask_w / 2.0 + spread * factor + 0.1 * mask_w))
+        half_h = int(math.ceil(mask_h / 2.0 + spread * factor + 0.1 * mask_h))
+        left = int(max(0, min(width - mask_w, round(center[0] * factor) - half_w)))
+        top = int(max(0, min(height - mask_h, round(center[1] * factor) - half_h)))
+        window = image[top:min(height, top + 2 * half_h), left:min(width, left + 2 * half_w)]
+        shape = (_fast_len(window.shape[0]), _fast_len(window.shape[1]))
+        padded = np.zeros((len(candidates),) + shape, dtype=np.float32)
+        for idx, (_, _, mask, _) in enumerate(candidates):
+            padded[idx, :mask.shape[0], :mask.shape[1]] = mask
+        correlations = np.fft.irfft2(np.conj(np.fft.rfft2(padded)) * np.fft.rfft2(window, s=shape)[None], s=shape)
+        integral, integral_sq = _integrals(window)
+        best = None
+        for (scale, angle, mask, norm), correlation in zip(candidates, correlations):
+            if mask.shape[0] > window.shape[0] or mask.shape[1] > window.shape[1]:
+                continue
+            ncc = _ncc(correlation, integral, integral_sq, mask.shape, norm)
+            pos = int(np.argmax(ncc))
+            dy, dx = divmod(pos, ncc.shape[1])
+            score = float(ncc[dy, dx])
+            if best is None or score > best[0]:
+                best = (score, scale, angle, (left + dx + mask.shape[1] / 2.0) / factor,
+                        (top + dy + mask.shape[0] / 2.0) / factor)
+        if best is None:
+            return Match(name, None, -1.0, scales[0])
+        score, scale, angle, center_x, center_y = best
+        mask_h, mask_w = self.masks[name].shape
+        region = [int(round(center_x - mask_w * scale / 2.0)), int(round(center_y - mask_h * scale / 2.0)),
+                  int(round(mask_w * scale)), int(round(mask_h * scale))]
+        return Match(name, region, score, scale, angle)
+
+    def _verify(self, levels, regions):
+        """ Drop the matches the other anchored fields disagree with, search the missing fields where the
+        transform puts them
+        """
+        regions, transform = self._consensus(regions)
+        if transform is None:
+            return regions
+        scale = math.sqrt(abs(np.linalg.det(transform[:, :2])))
+        angle = get_angle_from_transform(np.vstack([transform, [0, 0, 1]]))
+        # the mask rotations closest to the angle of the document
+        angles = sorted(self.angles, key=lambda a: abs(a - angle))[:2]
+        for name, anchor in self.anchors.items():
+            if name in regions or name not in self.masks:
+                continue
+            center = transform[:, :2].dot(anchor) + transform[:, 2]
+            step = math.sqrt(self.scale_step)
+            match = self._refine(levels, name, (scale / step, scale, scale * step), angles, center,
+                                 0.25 * self.masks[name].shape[0] * scale)
+            if match.score >= self.min_score:
+                regions[name] = match
+        return regions
+
+    def _consensus(self, regions):
+        """ Keep the anchored matches agreeing with the transform of the largest consensus: every pair of
+        matches gives a transform, the one placing most matches within half a mask height of their anchor wins
+        (with the highest total score among equals). Wrong matches are dropped, to be searched again.
+        :return: kept matches, their transform (None when no pair gives a plausible one)
+        """
+        names = [name for name in regions if name in self.anchors]
+        best, best_key = None, None
+        for idx, first in enumerate(names):
+            for second in names[idx + 1:]:
+                candidate = self._fit_transform({first: regions[first], second: regions[second]})
+                if candidate is None:
+                    continue
+                scale = math.sqrt(abs(np.linalg.det(candidate[:, :2])))
+                if not self.min_scale / self.scale_step <= scale <= self.max_scale * self.scale_step:
+                    continue
+                inliers = [name for name in names if self._residual(candidate, regions[name]) <= 0.5]
+                key = (len(inliers), sum(regions[name].score for name in inliers))
+                if best_key is None or key > best_key:
+                    best, best_key = inliers, key
+        if best is None or len(best) < 2:
+            return regions, None
+        kept = dict((name, match) for name, match in regions.items() if name in best or name not in self.anchors)
+        return kept, self._fit_transform(kept)
+
+    def _residual(self, transform, match):
+        """ Distance between the found center and the transformed anchor, in mask heights """
+        center = transform[:, :2].dot(self.anchors[match.name]) + transform[:, 2]
+        return math.hypot(*(np.array(match.center()) - center)) / max(1, match.region[3])
+
+    def _fit_transform(self, regions):
+        """ Least squares similarity transform anchors -> centers of the found masks, None below 2 points """
+        names = [name for name in regions if name in self.anchors]
+        if len(names) < 2:
+            return None
+        src = np.array([self.anchors[name] for name in names], dtype=np.float64)
+        dst = np.array([regions[name].center() for name in names], dtype=np.float64)
+        src_mean, dst_mean = src.mean(axis=0), dst.mean(axis=0)
+        s, d = src - src_mean, dst - dst_mean
+        energy = (s * s).sum()
+        if energy == 0:
+            return None
+        # x' = a x + b y + tx, y' = -b x + a y + ty
+        a = (s[:, 0] * d[:, 0] + s[:, 1] * d[:, 1]).sum() / energy
+        b = (s[:, 1] * d[:, 0] - s[:, 0] * d[:, 1]).sum() / energy
+        rotation = np.array([[a, b], [-b, a]])
+        translation = dst_mean - rotation.dot(src_mean)
+        return np.hstack([rotation, translation[:, None]])
+
+
+def _gray(image):
+    image = np.asarray(image)
+    if image.ndim == 3:
+        # BGR as read by cv2, weights of cv2.COLOR_BGR2GRAY
+        image = image[..., 0] * 0.114 + image[..., 1] * 0.587 + image[..., 2] * 0.299
+    return image
+
+
+def _use_cv2():
+    """ cv2 is optional: PIL resizes and rotates when it is not installed (checked once) """
+    global _cv2_available
+    if _cv2_available is None:
+        try:
+            cv2.INTER_AREA
+            _cv2_available = True
+        except ImportError:
+            _cv2_available = False
+    return _cv2_available
+
+
+def _resize(image, size):
+    """ Resize to size (width, height), area interpolation with cv2, else bilinear with PIL """
+    if _use_cv2():
+        return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    return np.asarray(Image.fromarray(np.asarray(image, dtype=np.float32), mode='F').resize(size, Image.BILINEAR))
+
+
+def _rotate(mask, angle):
+    """ Mask rotated counterclockwise by angle degrees, the corners filled with its median gray """
+    fill = float(np.median(mask))
+    if not _use_cv2():
+        rotated = Image.fromarray(np.asarray(mask, dtype=np.float32), mode='F').rotate(
+            angle, resample=Image.BILINEAR, expand=True, fillcolor=fill)
+        return np.asarray(rotated)
+    height, width = mask.shape
+    matrix = cv2.getRotationMatrix2D((width / 2.0, height / 2.0), angle, 1.0)
+    cos, sin = abs(matrix[0, 0]), abs(matrix[0, 1])
+    size = (int(math.ceil(width * cos + height * sin)), int(math.ceil(width * sin + height * cos)))
+    matrix[:, 2] += (size[0] - width) / 2.0, (size[1] - height) / 2.0
+    return cv2.warpAffine(mask, matrix, size, flags=cv2.INTER_LINEAR, borderValue=fill)
+
+
+def _fast_len(n):
+    """ Smallest length >= n whose factors are 2, 3 and 5, fast for the FFT """
+    best = 1 << int(math.ceil(math.log(max(n, 1), 2)))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            p = p35
+            while p < n:
+                p *= 2
+            best = min(best, p)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+def _integrals(image):
+    """ Integral images of the pixels and of their squares, with a leading row and column of zeros """
+    image = image.astype(np.float64)
+    integral = np.zeros((image.shape[0] + 1, image.shape[1] + 1))
+    integral_sq = np.zeros_like(integral)
+    np.cumsum(np.cumsum(image, axis=0), axis=1, out=integral[1:, 1:])
+    np.cumsum(np.cumsum(image * image, axis=0), axis=1, out=integral_sq[1:, 1:])
+    return integral, integral_sq
+
+
+def _box_sums(integral, height, width):
+    """ Sums of all height x width windows, indexed by top left corner """
+    return (integral[height:, width:] - integral[:-height, width:]
+            - integral[height:, :-width] + integral[:-height, :-width])
+
+
+def _ncc(correlation, integral, integral_sq, mask_shape, norm):
+    """ Normalized cross correlation of the valid positions, from the correlation with a zero-mean mask """
+    height, width = mask_shape
+    count = float(height * width)
+    sums = _box_sums(integral, height, width)
+    energy = _box_sums(integral_sq, height, width) - sums * sums / count
+    rows, cols = sums.shape
+    ncc = correlation[:rows, :cols] / (np.sqrt(np.maximum(energy, 1e-6)) * norm)
+    # flat windows (uniform background) carry no match
+    ncc[energy < 1e-3 * count] = 0
+    return ncc
@@ -116,6 +116,27 @@ STATIC_URL = '/static/'
 
 TEMPLATE_DIRS = (os.path.join(BASE_DIR, 'templates'),)
 
+# OCR service (django_web.ocr_service)
+OCR_TESSDATA_PATH = '/usr/local/share/tessdata'
+OCR_DEFAULT_LANG = 'chi_sim'
+OCR_DEFAULT_PSM = 7
+OCR_BATCH_SIZE = 16  # max regions recognized in one batch
+OCR_MAX_WAIT_MS = 10  # max time spent filling a batch, in ms
+OCR_WORKERS = 4  # recognizer workers
+OCR_TIMEOUT = 30  # max time a request waits for its texts, in seconds
+OCR_RECOGNIZER = 'auto'  # 'cli': tesseract command line even when tesserocr is installed
+
+# Training api (django_web.train_service)
+TRAIN_REF_PATH = '/web/train_data'  # training folders
+TRAIN_FONT_PATH = os.path.join(BASE_DIR, 'django_web/resource/ttf')  # fonts a submitted job may use
+TRAIN_WORKERS = 2  # trainings running at the same time
+TRAIN_MAX_QUEUED = 64  # waiting trainings, further submissions are refused
+TRAIN_ALLOW_PUBLISH = False  # jobs may replace the served language packs of OCR_TESSDATA_PATH (the api is not authenticated)
+
+# Uploaded training inputs (django_web.input_store)
+INPUT_STORE_PATH = '/web/train_data/inputs'
+INPUT_MAX_BYTES = 2 * 1024 * 1024 * 1024  # size limit of an uploaded corpus or font file
+
 # LOGGING
 LOGGING = {
     'version': 1,
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Upload handler streaming the files of a multipart request into the input store.
+"""
+from django.core.files.uploadhandler import FileUploadHandler
+
+from django_web.input_store import CHUNK_SIZE
+
+
+class InputStoreUploadHandler(FileUploadHandler):
+    """ Write every uploaded chunk to the input store as it arrives, hashing it on the way:
+        request.FILES holds input_store.StoredInput objects instead of in-memory or temporary files
+    """
+    chunk_size = CHUNK_SIZE
+
+    def __init__(self, store, request=None):
+        FileUploadHandler.__init__(self, request)
+        self.store = store
+        self.upload = None
+
+    def new_file(self, *args, **kwargs):
+        FileUploadHandler.new_file(self, *args, **kwargs)
+        self.upload = self.store.open_upload()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.upload.write(raw_data)
+        # consumed, no other handler sees the chunk
+        return None
+
+    def file_complete(self, file_size):
+        upload, self.upload = self.upload, None
+        return upload.finish(self.file_name)
+
+    def upload_interrupted(self):
+        if self.upload is not None:
+            self.upload.abort()
+            self.upload = None
@@ -16,6 +16,15 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
+from img_ai_trainer import views
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('api/ocr/', views.ocr),
+    path('api/ocr/stats/', views.ocr_stats),
+    path('api/train/', views.train_submit),
+    path('api/train/stats/', views.train_stats),
+    path('api/train/<str:job_id>/', views.train_status),
+    path('api/inputs/', views.inputs_upload),
+    path('api/inputs/<str:sha256>/', views.inputs_detail),
 ]
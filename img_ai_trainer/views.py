@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+
+from django.conf import settings
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+
+from django_web.model import ServiceException
+from django_web.util.constants import MAX_IMG_SIZE
+
+
+def _error(msg, status=400):
+    return JsonResponse({'code': 1, 'msg': msg}, status=status, json_dumps_params={'ensure_ascii': False})
+
+
+@csrf_exempt
+@require_POST
+def ocr(request):
+    """ Recognize text regions
+        multipart form:
+            image:   整张图片, 和regions一起使用时从中截取文字区域
+            regions: 可选, json列表 [[x, y, w, h], ...]
+            region:  可选, 多个已经截好的文字区域图片
+            lang:    语言包, 默认settings.OCR_DEFAULT_LANG
+            psm:     页面分割模式, 默认settings.OCR_DEFAULT_PSM
+        返回 {"code": 0, "texts": [...]} 按区域顺序
+    """
+    from django_web.ocr_service import get_service, load_image, crop_regions
+
+    start = time.time()
+    lang = request.POST.get('lang', settings.OCR_DEFAULT_LANG)
+    try:
+        psm = int(request.POST.get('psm', settings.OCR_DEFAULT_PSM))
+        images = []
+        if 'image' in request.FILES:
+            image = load_image(request.FILES['image'].read(), MAX_IMG_SIZE)
+            regions = request.POST.get('regions')
+            images.extend(crop_regions(image, json.loads(regions)) if regions else [image])
+        for upload in request.FILES.getlist('region'):
+            images.append(load_image(upload.read(), MAX_IMG_SIZE))
+        if not images:
+            raise ServiceException("no image or region uploaded")
+        texts = get_service().recognize(images, lang, psm, timeout=settings.OCR_TIMEOUT)
+    except ServiceException as e:
+        return _error(str(e))
+    except ValueError as e:
+        return _error("bad parameter: %s" % e)
+    except Exception as e:
+        return _error("recognition failed: %s" % e, status=500)
+    return JsonResponse({'code': 0, 'lang': lang, 'psm': psm, 'texts': texts,
+                         'seconds': time.time() - start}, json_dumps_params={'ensure_ascii': False})
+
+
+@require_GET
+def ocr_stats(request):
+    """ Batching and latency statistics of the recognition service """
+    from django_web.ocr_service import get_service
+
+    return JsonResponse(get_service().snapshot())
+
+
+@csrf_exempt
+@require_POST
+def train_submit(request):
+    """ Queue a training
+        json body:
+            lang_name: 语言包名称
+            text:      训练文本
+            fonts:     字体文件名列表, 位于settings.TRAIN_FONT_PATH
+            font_size: 字号, 或字号列表
+            其他可选参数见train_service.CLIENT_OPTIONS
+        返回 {"code": 0, "job_id": "..."}
+    """
+    from django_web.train_service import get_training_service
+
+    try:
+        spec = json.loads(request.body.decode('utf-8'))
+        if not isinstance(spec, dict):
+            raise ValueError("the body must be a json object")
+        job_id = get_training_service().submit(spec)
+    except ServiceException as e:
+        return _error(str(e))
+    except ValueError as e:
+        return _error("bad parameter: %s" % e)
+    return JsonResponse({'code': 0, 'job_id': job_id}, status=202)
+
+
+@require_GET
+def train_status(request, job_id):
+    """ State of a training: queued, running, ok or failed """
+    from django_web.train_service import get_training_service
+
+    try:
+        status = get_training_service().status(job_id)
+    except KeyError:
+        return _error("unknown job %s" % job_id, status=404)
+    status['code'] = 0
+    return JsonResponse(status, json_dumps_params={'ensure_ascii': False})
+
+
+@require_GET
+def train_stats(request):
+    """ Queue and worker statistics of the training service """
+    from django_web.train_service import get_training_service
+
+    return JsonResponse(get_training_service().snapshot())
+
+
+@csrf_exempt
+@require_POST
+def inputs_upload(request):
+    """ Store training inputs: corpora (utf-8 text) and truetype/opentype fonts
+        multipart form: one or more files, streamed to the input store while being hashed
+        返回 {"code": 0, "inputs": [{"name", "sha256", "size", "kind", "new"}, ...]},
+        sha256用于训练任务的text_sha256和fonts
+    """
+    from django_web.input_store import get_input_store
+    from img_ai_trainer.upload_handlers import InputStoreUploadHandler
+
+    # set before request.FILES is read: the files never go through memory or temporary files
+    request.upload_handlers = [InputStoreUploadHandler(get_input_store(), request)]
+    try:
+        stored = [item for name in request.FILES for item in request.FILES.getlist(name)]
+    except ServiceException as e:
+        return _error(str(e))
+    if not stored:
+        return _error("no file uploaded")
+    return JsonResponse({'code': 0, 'inputs': [item.to_dict() for item in stored]},
+                        json_dumps_params={'ensure_ascii': False})
+
+
+@require_GET
+def inputs_detail(request, sha256):
+    """ Size, kind and name of a stored input """
+    from django_web.input_store import get_input_store
+
+    try:
+        stored = get_input_store().get(sha256)
+    except ServiceException as e:
+        return _error(str(e), status=404)
+    result = stored.to_dict()
+    del result['new']
+    result['code'] = 0
+    return JsonResponse(result, json_dumps_params={'ensure_ascii': False})
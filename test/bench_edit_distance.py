@@ -0,0 +1,121 @@
+# coding:utf-8
+"""
+Speed of the error rate scoring (django_web/util/edit_distance.py) on a generated check set.
+
+Pages of CJK text are drawn from a corpus (or from the common CJK block), then "recognized"
+with random substitutions, insertions and deletions at --error-rate. The pages are scored
+with ErrorCounts (bit-parallel distances, confusion counts) and a sample of them with the
+plain dynamic programming distance, for the speedup and to check that both agree.
+
+usage:
+    python test/bench_edit_distance.py
+    python test/bench_edit_distance.py --pages 5000 --chars 600 --corpus django_web/resource/train_text/output.txt
+
+The exit status is 1 when the distances disagree, or when the scoring exceeds --max-seconds.
+(Named bench_edit_distance.py: pytest does not collect it.)
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django_web.util.edit_distance import ErrorCounts, distances  # noqa: E402
+
+
+def dp_distance(expected, actual):
+    """ Plain dynamic programming Levenshtein distance, the reference """
+    previous = list(range(len(actual) + 1))
+    for i, char in enumerate(expected, 1):
+        current = [i]
+        for j, other in enumerate(actual, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != other)))
+        previous = current
+    return previous[-1]
+
+
+def make_pages(args, rng):
+    if args.corpus:
+        with open(args.corpus, 'r', encoding='UTF-8') as fp:
+            alphabet = sorted(set("".join(fp.read().split())))
+    else:
+        alphabet = [chr(code) for code in range(0x4e00, 0x4e00 + 3500)]
+    pages = []
+    for idx in range(args.pages):
+        # a few long pages besides the lines and paragraphs
+        length = args.long_chars if idx % 100 == 99 else rng.randint(1, 2 * args.chars)
+        expected = [rng.choice(alphabet) for _ in range(length)]
+        # words separated by spaces, for the word error rate
+        cut = sorted(rng.sample(range(1, length), min(rng.randint(0, 12), length - 1)))
+        expected = ["".join(expected[i:j]) for i, j in zip([0] + cut, cut + [length])]
+        actual = []
+        for word in expected:
+            recognized = []
+            for char in word:
+                roll = rng.random()
+                if roll < args.error_rate / 3:
+                    recognized.append(rng.choice(alphabet))
+                elif roll < args.error_rate * 2 / 3:
+                    recognized.extend((char, rng.choice(alphabet)))
+                elif roll >= args.error_rate:
+                    recognized.append(char)
+            actual.append("".join(recognized))
+        pages.append((" ".join(expected), " ".join(actual)))
+    return pages
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Speed of the bit-parallel error rate scoring.')
+    parser.add_argument('--pages', type=int, default=2000)
+    parser.add_argument('--chars', type=int, default=300, help="mean characters per page")
+    parser.add_argument('--long-chars', type=int, default=5000, help="characters of every 100th page")
+    parser.add_argument('--error-rate', type=float, default=0.05)
+    parser.add_argument('--corpus', help="draw the characters from this text file")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--dp-pages', type=int, default=100, help="pages also scored with plain dynamic programming")
+    parser.add_argument('--max-seconds', type=float, default=10.0, help="limit of the scoring with confusions")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    pages = make_pages(args, rng)
+    chars = sum(len(expected) for expected, _ in pages)
+    print("**** %d pages, %d characters" % (len(pages), chars))
+
+    start = time.time()
+    plain = ErrorCounts()
+    plain.add_pages(pages)
+    plain_seconds = time.time() - start
+    start = time.time()
+    counts = ErrorCounts(confusions=True)
+    counts.add_pages(pages)
+    seconds = time.time() - start
+    print("**** cer %.4f, wer %.4f" % (counts.cer(), counts.wer()))
+    print("**** scoring: %.2f s (%.0f chars/s), with confusions: %.2f s, %d pages not aligned"
+          % (plain_seconds, chars / max(plain_seconds, 1e-9), seconds, counts.unaligned))
+    print("**** top confusions: %s" % ", ".join("%s->%s %d" % (wanted or '_', found or '_', occurrences)
+                                                 for (wanted, found), occurrences in counts.top_confusions(5)))
+
+    sample = [("".join(expected.split()), "".join(actual.split())) for expected, actual in pages[:args.dp_pages]]
+    start = time.time()
+    reference = [dp_distance(expected, actual) for expected, actual in sample]
+    dp_seconds = time.time() - start
+    start = time.time()
+    fast = distances(sample)
+    fast_seconds = time.time() - start
+    print("**** %d pages: dynamic programming %.2f s, bit-parallel %.3f s (x%.0f)"
+          % (len(sample), dp_seconds, fast_seconds, dp_seconds / max(fast_seconds, 1e-9)))
+    failed = False
+    if fast != reference:
+        print("**** distances differ from the dynamic programming on %d pages"
+              % sum(a != b for a, b in zip(fast, reference)))
+        failed = True
+    if seconds > args.max_seconds:
+        print("**** scoring took %.2f s, more than %.2f s" % (seconds, args.max_seconds))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
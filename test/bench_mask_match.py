@@ -0,0 +1,197 @@
+# coding:utf-8
+"""
+Latency and accuracy of mask_match.MaskMatcher.
+
+By default the samples are generated: a reference card with a few printed labels (the
+masks) is rendered, then photographed at a random scale, rotation and position on a noisy
+background, with random field values, blur and noise. The found labels are compared with
+their true position, the estimated angle with the true rotation.
+
+Real photos can be given with --photos, the masks then come from django_web/resource/mask
+(img_util.get_mask); only the latency and the found rate are reported.
+
+usage:
+    python test/bench_mask_match.py
+    python test/bench_mask_match.py --samples 50 --target-ms 150 --save /tmp/samples
+    python test/bench_mask_match.py --photos /data/id_cards --masks name.png,number.png
+
+The first match pays for the preparation of the mask spectra and is reported apart. The exit
+status is 1 when the p95 latency exceeds --target-ms or when fewer than --min-found of the
+labels are found. (Named bench_mask_match.py: pytest does not collect it.)
+"""
+import argparse
+import math
+import os
+import random
+import sys
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django_web.util.mask_match import MaskMatcher  # noqa: E402
+
+FONT = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+CARD_SIZE = (1000, 630)
+PHOTO_SIZE = (1280, 960)
+# label, top left corner on the reference card, longest value printed after it
+LABELS = [("NAME", (60, 70), 14), ("SEX", (60, 170), 3), ("BORN", (420, 170), 10),
+          ("ADDRESS", (60, 270), 14), ("ID NUMBER", (60, 520), 14)]
+VALUES = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+
+
+def render_card(font, rng):
+    """ Reference card with labels and random field values, and the label boxes [x, y, w, h] """
+    card = Image.new('L', CARD_SIZE, 255)
+    draw = ImageDraw.Draw(card)
+    draw.rectangle([8, 8, CARD_SIZE[0] - 9, CARD_SIZE[1] - 9], outline=90, width=3)
+    boxes = {}
+    for label, (x, y), longest in LABELS:
+        draw.text((x, y), label, fill=40, font=font)
+        left, top, right, bottom = draw.textbbox((x, y), label, font=font)
+        boxes[label] = [left - 4, top - 4, right - left + 8, bottom - top + 8]
+        if rng is not None:
+            value = "".join(rng.choice(VALUES) for _ in range(rng.randint(1, longest)))
+            draw.text((right + 30, y), value, fill=20, font=font)
+    return card, boxes
+
+
+def make_photo(card, rng):
+    """ The card pasted on a noisy background at a random scale, rotation and position
+    :return: photo (uint8 array), 2x3 matrix card -> photo, scale, angle (degrees, counterclockwise)
+    """
+    scale = rng.uniform(0.6, 1.6)
+    angle = rng.uniform(-5, 5)
+    rad = math.radians(angle)
+    # same convention as cv2.getRotationMatrix2D: positive angles turn counterclockwise
+    rotation = scale * np.array([[math.cos(rad), math.sin(rad)], [-math.sin(rad), math.cos(rad)]])
+    corners = rotation.dot(np.array([[0, CARD_SIZE[0], CARD_SIZE[0], 0], [0, 0, CARD_SIZE[1], CARD_SIZE[1]]]))
+    low, high = corners.min(axis=1), corners.max(axis=1)
+    width, height = max(PHOTO_SIZE[0], int(high[0] - low[0]) + 40), max(PHOTO_SIZE[1], int(high[1] - low[1]) + 40)
+    offset = np.array([rng.uniform(-low[0] + 10, width - high[0] - 10),
+                       rng.uniform(-low[1] + 10, height - high[1] - 10)])
+    matrix = np.hstack([rotation, offset[:, None]])
+    inverse = np.linalg.inv(np.vstack([matrix, [0, 0, 1]]))[:2]
+    warped = card.transform((width, height), Image.AFFINE, tuple(inverse.ravel()), resample=Image.BILINEAR,
+                            fillcolor=0)
+    inside = Image.new('L', CARD_SIZE, 255).transform((width, height), Image.AFFINE, tuple(inverse.ravel()),
+                                                      resample=Image.BILINEAR, fillcolor=0)
+    background = np.random.RandomState(rng.randint(0, 2 ** 31)).normal(120, 25, (height, width))
+    alpha = np.asarray(inside, dtype=np.float32) / 255
+    photo = np.asarray(warped, dtype=np.float32) * alpha + background * (1 - alpha)
+    photo = Image.fromarray(np.clip(photo, 0, 255).astype(np.uint8)).filter(ImageFilter.GaussianBlur(rng.uniform(0, 1.2)))
+    photo = np.asarray(photo, dtype=np.float32) + np.random.RandomState(rng.randint(0, 2 ** 31)).normal(0, 6, (height, width))
+    return np.clip(photo, 0, 255).astype(np.uint8), matrix, scale, angle
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(q / 100.0 * len(values))) - 1)] if values else 0.0
+
+
+def bench_generated(args):
+    font = ImageFont.truetype(args.font, 34)
+    card, boxes = render_card(font, None)
+    reference = np.asarray(card)
+    masks = {label: reference[y:y + h, x:x + w] for label, (x, y, w, h) in boxes.items()}
+    anchors = {label: (x + w / 2.0, y + h / 2.0) for label, (x, y, w, h) in boxes.items()}
+    matcher = MaskMatcher(masks, anchors=anchors, min_scale=args.min_scale, max_scale=args.max_scale)
+    rng = random.Random(args.seed)
+    samples = []
+    for idx in range(args.samples):
+        sample_card, _ = render_card(font, rng)
+        samples.append(make_photo(sample_card, rng))
+        if args.save:
+            os.makedirs(args.save, exist_ok=True)
+            Image.fromarray(samples[-1][0]).save(os.path.join(args.save, "sample_%03d.png" % idx))
+
+    latencies, errors, angle_errors, found, first = [], [], [], 0, None
+    for photo, matrix, scale, angle in samples:
+        result = matcher.match(photo)
+        if first is None:
+            # first call: spectra of the masks for this photo size
+            first = result['seconds']
+            # again without the cached pyramid of the photo
+            matcher._image_cache.clear()
+            result = matcher.match(photo)
+        latencies.append(result['seconds'])
+        for label, match in result['regions'].items():
+            truth = matrix[:, :2].dot(anchors[label]) + matrix[:, 2]
+            error = math.hypot(*(np.array(match.center()) - truth))
+            errors.append(error / scale)
+            # a label more than half its height away is a wrong match
+            if error / scale < boxes[label][3] / 2.0:
+                found += 1
+        if result['angle'] is not None:
+            angle_errors.append(abs(result['angle'] - angle))
+    total = len(samples) * len(masks)
+    return first, latencies, found / float(total), errors, angle_errors
+
+
+def bench_photos(args):
+    from django_web.util.img_util import get_mask
+    import cv2
+
+    masks = {name: get_mask(name, 0) for name in args.masks.split(',')}
+    matcher = MaskMatcher(masks, min_scale=args.min_scale, max_scale=args.max_scale)
+    latencies, found, total, first = [], 0, 0, None
+    for name in sorted(os.listdir(args.photos)):
+        photo = cv2.imread(os.path.join(args.photos, name), 0)
+        if photo is None:
+            continue
+        result = matcher.match(photo)
+        if first is None:
+            first = result['seconds']
+            continue
+        latencies.append(result['seconds'])
+        found += len(result['regions'])
+        total += len(masks)
+    return first, latencies, found / float(max(1, total)), [], []
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Latency and accuracy of the multi-scale mask matcher.')
+    parser.add_argument('--samples', type=int, default=20, help="generated photos")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--font', default=FONT, help="font of the generated card")
+    parser.add_argument('--min-scale', type=float, default=0.5)
+    parser.add_argument('--max-scale', type=float, default=2.0)
+    parser.add_argument('--save', help="write the generated photos to this directory")
+    parser.add_argument('--photos', help="directory of real photos instead of generated ones")
+    parser.add_argument('--masks', default='', help="with --photos: comma separated mask files of resource/mask")
+    parser.add_argument('--target-ms', type=float, default=200.0, help="p95 latency limit")
+    parser.add_argument('--min-found', type=float, default=0.9, help="found rate limit")
+    args = parser.parse_args(argv)
+
+    if args.photos:
+        if not args.masks:
+            parser.error("--photos needs --masks")
+        first, latencies, found_rate, errors, angle_errors = bench_photos(args)
+    else:
+        first, latencies, found_rate, errors, angle_errors = bench_generated(args)
+    if not latencies:
+        print("**** no photo matched")
+        return 1
+
+    p95 = percentile(latencies, 95) * 1000
+    print("**** first match (mask spectra): %.1f ms" % (first * 1000))
+    print("**** latency over %d photos: p50 %.1f ms, p95 %.1f ms, max %.1f ms"
+          % (len(latencies), percentile(latencies, 50) * 1000, p95, max(latencies) * 1000))
+    print("**** found: %.1f%% of the masks" % (found_rate * 100))
+    if errors:
+        print("**** center error (reference px): mean %.2f, max %.2f" % (float(np.mean(errors)), max(errors)))
+    if angle_errors:
+        print("**** angle error (degrees): mean %.2f, max %.2f" % (float(np.mean(angle_errors)), max(angle_errors)))
+    failed = False
+    if p95 > args.target_ms:
+        print("**** p95 latency %.1f ms exceeds the target %.1f ms" % (p95, args.target_ms))
+        failed = True
+    if found_rate < args.min_found:
+        print("**** found rate %.3f below %.3f" % (found_rate, args.min_found))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
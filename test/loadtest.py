@@ -0,0 +1,461 @@
+# coding:utf-8
+"""
+Load test of the training and recognition api.
+
+Starts the django app locally (manage.py runserver) with stub tesseract binaries on its PATH,
+or targets a running deployment with --url, then drives a mix of requests at target rates:
+    ocr:    POST /api/ocr/ with rendered text line regions
+    submit: POST /api/train/ with a small training job
+    status: GET /api/train/<job id>/ of a submitted job
+
+Arrivals are open loop: requests are issued at the target rate whatever the response times,
+and a latency counts from the time the request was due, so a saturated server shows up as
+growing latencies instead of a silently lower request rate. /api/ocr/stats/ and
+/api/train/stats/ are sampled every second for the worker occupation and the queues.
+
+The stubs answer in constant time (--stub-ocr-ms per recognized region), the render stage
+of the trainings is real: the numbers measure the service (batching, queues, workers,
+rendering), not tesseract.
+
+usage:
+    python test/loadtest.py --duration 60 --ocr-rate 20 --submit-rate 0.5 --status-rate 5
+    python test/loadtest.py --url http://10.0.0.5:8000 --ocr-rate 50 --submit-rate 0 --status-rate 0
+    python test/loadtest.py ... --json report.json --max-error-rate 0.01 --max-p99-ms 2000
+
+The exit status is 1 when an error rate or a p99 latency exceeds the given limits, so that the
+script can guard against scaling regressions. (Named loadtest.py: pytest does not collect it.)
+"""
+import argparse
+import io
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+KINDS = ('ocr', 'submit', 'status')
+FONT_CANDIDATES = ['/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+                   '/usr/share/fonts/TTF/DejaVuSans.ttf',
+                   '/Library/Fonts/Arial.ttf',
+                   'C:\\Windows\\Fonts\\arial.ttf']
+LINE_TEXT = "Load test 0123456789"
+TRAIN_CHARS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+
+# stub tesseract: box.train touches the .tr file, recognition answers one line per tif page
+_TESSERACT_STUB = """#!{python}
+import os, sys, time
+args = [a for a in sys.argv[1:]]
+if '--tessdata-dir' in args:
+    del args[args.index('--tessdata-dir'):args.index('--tessdata-dir') + 2]
+if len(args) > 1 and args[1] == 'stdout':
+    from PIL import Image
+    pages = getattr(Image.open(args[0]), 'n_frames', 1)
+    time.sleep(pages * float(os.environ.get('STUB_OCR_MS', '0')) / 1000.0)
+    sys.stdout.write('\\f'.join(['stub text'] * pages) + '\\f')
+elif len(args) > 1:
+    open(args[1] + '.tr', 'a').close()
+"""
+_SHELL_STUBS = {
+    'unicharset_extractor': "printf '2\\nNULL 0 Common 0\\na 3 0 Latin 1 0 1 a\\n' > unicharset",
+    'shapeclustering': "touch shapetable",
+    'mftraining': "touch inttemp pffmtable shapetable",
+    'cntraining': "touch normproto",
+    'combine_tessdata': 'touch "${1}traineddata"',
+    'magick': 'for last; do :; done\ncat "$1" > "$last"',
+}
+
+_SETTINGS = """from img_ai_trainer.settings import *
+
+DEBUG = False
+LOGGING = {{'version': 1, 'disable_existing_loggers': False}}
+OCR_TESSDATA_PATH = {tessdata!r}
+OCR_RECOGNIZER = 'cli'
+OCR_WORKERS = {ocr_workers}
+TRAIN_REF_PATH = {ref!r}
+TRAIN_FONT_PATH = {fonts!r}
+TRAIN_WORKERS = {train_workers}
+"""
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile of sorted values """
+    if not values:
+        return None
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+class LocalServer(object):
+    """ The app run by manage.py runserver in a scratch directory, with stub tesseract binaries """
+
+    def __init__(self, font, port=None, ocr_workers=4, train_workers=2, stub_ocr_ms=20):
+        self.workdir = tempfile.mkdtemp(prefix='loadtest_')
+        self.port = port or _free_port()
+        self.url = 'http://127.0.0.1:%d' % self.port
+        bin_dir, fonts, tessdata, ref = [os.path.join(self.workdir, name)
+                                         for name in ('bin', 'fonts', 'tessdata', 'ref')]
+        for folder in (bin_dir, fonts, tessdata, ref):
+            os.makedirs(folder)
+        self.font_name = os.path.basename(font)
+        shutil.copy(font, os.path.join(fonts, self.font_name))
+        _write_script(os.path.join(bin_dir, 'tesseract'), _TESSERACT_STUB.format(python=sys.executable))
+        for name, body in _SHELL_STUBS.items():
+            _write_script(os.path.join(bin_dir, name), "#!/bin/sh\n%s\n" % body)
+        with open(os.path.join(self.workdir, 'loadtest_settings.py'), 'w') as fp:
+            fp.write(_SETTINGS.format(tessdata=tessdata, ocr_workers=ocr_workers, ref=ref, fonts=fonts,
+                                      train_workers=train_workers))
+        env = dict(os.environ)
+        env['PATH'] = bin_dir + os.pathsep + env.get('PATH', '')
+        env['PYTHONPATH'] = os.pathsep.join([self.workdir, BASE_DIR, env.get('PYTHONPATH', '')])
+        env['DJANGO_SETTINGS_MODULE'] = 'loadtest_settings'
+        env['STUB_OCR_MS'] = str(stub_ocr_ms)
+        self.log_path = os.path.join(self.workdir, 'server.log')
+        self.log = open(self.log_path, 'wb')
+        self.process = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, 'manage.py'), 'runserver',
+                                         '127.0.0.1:%d' % self.port, '--noreload'],
+                                        cwd=self.workdir, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, timeout=60):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                break
+            try:
+                urllib.request.urlopen(self.url + '/api/ocr/stats/', timeout=2).read()
+                return
+            except (urllib.error.URLError, OSError):
+                time.sleep(0.2)
+        self.stop(keep=True)
+        raise RuntimeError("the server did not start, see %s:\n%s" % (self.log_path, self.log_tail()))
+
+    def log_tail(self, lines=20):
+        with open(self.log_path, 'rb') as fp:
+            return "\n".join(fp.read().decode('utf-8', 'replace').splitlines()[-lines:])
+
+    def stop(self, keep=False):
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.log.close()
+        if not keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _write_script(path, content):
+    with open(path, 'w') as fp:
+        fp.write(content)
+    os.chmod(path, 0o755)
+
+
+def render_line(font, text=LINE_TEXT, size=32):
+    """ png bytes of a text line, the region sent to /api/ocr/ """
+    from PIL import Image, ImageDraw, ImageFont
+
+    ttf = ImageFont.truetype(font, size)
+    left, top, right, bottom = ttf.getbbox(text)
+    image = Image.new('L', (right - left + 20, bottom - top + 20), 255)
+    ImageDraw.Draw(image).text((10 - left, 10 - top), text, font=ttf, fill=0)
+    out = io.BytesIO()
+    image.save(out, format='PNG')
+    return out.getvalue()
+
+
+def multipart(fields, files):
+    """ multipart/form-data body
+    :param fields: dict name -> str
+    :param files: list of (name, filename, bytes)
+    :return: (content type, body)
+    """
+    boundary = 'loadtest%x' % random.getrandbits(64)
+    parts = []
+    for name, value in fields.items():
+        parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'
+                      % (boundary, name, value)).encode('utf-8'))
+    for name, filename, data in files:
+        parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                      'Content-Type: application/octet-stream\r\n\r\n' % (boundary, name, filename)).encode('utf-8'))
+        parts.append(data)
+        parts.append(b'\r\n')
+    parts.append(('--%s--\r\n' % boundary).encode('utf-8'))
+    return 'multipart/form-data; boundary=%s' % boundary, b''.join(parts)
+
+
+class LoadTest(object):
+    """ Open loop request generator and recorder """
+
+    def __init__(self, url, rates, duration, font_name, line_png, regions=1, concurrency=64, timeout=60,
+                 train_chars=40, font_size=24, seed=0):
+        self.url = url.rstrip('/')
+        self.rates = rates
+        self.duration = duration
+        self.font_name = font_name
+        self.line_png = line_png
+        self.regions = regions
+        self.timeout = timeout
+        self.train_chars = train_chars
+        self.font_size = font_size
+        self.random = random.Random(seed)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.lock = threading.Lock()
+        # kind -> list of (latency in s, ok, error)
+        self.records = dict((kind, []) for kind in KINDS)
+        self.job_ids = []
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        start = time.time() + 0.1
+        sampler = threading.Thread(target=self._sample, daemon=True)
+        sampler.start()
+        schedulers = [threading.Thread(target=self._schedule, args=(kind, self.rates[kind], start), daemon=True)
+                      for kind in KINDS if self.rates.get(kind)]
+        for thread in schedulers:
+            thread.start()
+        for thread in schedulers:
+            thread.join()
+        self.executor.shutdown(wait=True)
+        self.elapsed = time.time() - start
+        self.stopped.set()
+        sampler.join()
+
+    def _schedule(self, kind, rate, start):
+        count = int(self.duration * rate)
+        for idx in range(count):
+            due = start + idx / float(rate)
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.executor.submit(self._issue, kind, due)
+
+    def _issue(self, kind, due):
+        ok, error = False, None
+        try:
+            if kind == 'status':
+                with self.lock:
+                    job_id = self.random.choice(self.job_ids) if self.job_ids else None
+                if job_id is None:
+                    # nothing submitted yet, not counted
+                    return
+                body = self._request('GET', '/api/train/%s/' % job_id)
+            elif kind == 'submit':
+                body = self._request('POST', '/api/train/', 'application/json', self._job_body())
+                with self.lock:
+                    self.job_ids.append(body['job_id'])
+            else:
+                content_type, data = multipart({'psm': '7'}, [('region', 'line.png', self.line_png)] * self.regions)
+                body = self._request('POST', '/api/ocr/', content_type, data)
+                if len(body['texts']) != self.regions:
+                    raise ValueError("%d texts for %d regions" % (len(body['texts']), self.regions))
+            ok = True
+        except urllib.error.HTTPError as e:
+            error = "HTTP %d" % e.code
+        except Exception as e:
+            error = type(e).__name__
+        with self.lock:
+            self.records[kind].append((time.time() - due, ok, error))
+
+    def _job_body(self):
+        with self.lock:
+            text = "".join(self.random.choice(TRAIN_CHARS) for _ in range(self.train_chars))
+        return json.dumps({'lang_name': 'load', 'text': text, 'fonts': [self.font_name],
+                           'font_size': self.font_size, 'base_lang': 'eng', 'base_psm': 7}).encode('utf-8')
+
+    def _request(self, method, path, content_type=None, data=None):
+        request = urllib.request.Request(self.url + path, data=data, method=method)
+        if content_type:
+            request.add_header('Content-Type', content_type)
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            body = json.loads(response.read().decode('utf-8'))
+        if body.get('code', 0) != 0:
+            raise ValueError(body.get('msg'))
+        return body
+
+    def _sample(self):
+        while not self.stopped.wait(1.0):
+            sample = {'time': time.time()}
+            for name in ('ocr', 'train'):
+                try:
+                    sample[name] = self._request('GET', '/api/%s/stats/' % name)
+                except Exception:
+                    sample[name] = None
+            self.samples.append(sample)
+
+    def final_jobs(self):
+        """ States of all submitted jobs at the end of the run """
+        states = {}
+        seconds = []
+        for job_id in self.job_ids:
+            try:
+                status = self._request('GET', '/api/train/%s/' % job_id)
+            except Exception:
+                states['unknown'] = states.get('unknown', 0) + 1
+                continue
+            states[status['state']] = states.get(status['state'], 0) + 1
+            if status['state'] == 'ok':
+                seconds.append(status['seconds'])
+        return states, sorted(seconds)
+
+    def report(self, drain=0):
+        """ dict of the measures """
+        report = {'duration': self.elapsed, 'rates': self.rates, 'kinds': {}}
+        for kind in KINDS:
+            records = self.records[kind]
+            if not records:
+                continue
+            latencies = sorted(1000.0 * latency for latency, ok, _ in records if ok)
+            errors = {}
+            for _, ok, error in records:
+                if not ok:
+                    errors[error] = errors.get(error, 0) + 1
+            report['kinds'][kind] = {
+                'sent': len(records),
+                'ok': len(latencies),
+                'error_rate': float(len(records) - len(latencies)) / len(records),
+                'errors': errors,
+                'throughput': len(latencies) / self.elapsed,
+                'latency_ms': dict(('p%d' % p, percentile(latencies, p)) for p in (50, 90, 99)),
+                'max_ms': latencies[-1] if latencies else None,
+            }
+        report['saturation'] = dict((name, _occupation(self.samples, name)) for name in ('ocr', 'train'))
+        if self.job_ids:
+            deadline = time.time() + drain
+            while True:
+                states, seconds = self.final_jobs()
+                if time.time() >= deadline or not (states.get('queued') or states.get('running')):
+                    break
+                time.sleep(1)
+            report['jobs'] = {'states': states, 'train_seconds_p50': percentile(seconds, 50),
+                              'train_seconds_max': seconds[-1] if seconds else None}
+        return report
+
+
+def _occupation(samples, name):
+    """ Mean and max worker occupation and queue length of a service over the samples """
+    stats = [s[name] for s in samples if s.get(name) and s[name].get('workers')]
+    if not stats:
+        return None
+    busy = [float(s['busy_workers']) / s['workers'] for s in stats]
+    queued = [s.get('queued_regions', s.get('queued', 0)) for s in stats]
+    return {'workers': stats[-1]['workers'], 'busy_mean': sum(busy) / len(busy), 'busy_max': max(busy),
+            'queue_max': max(queued), 'samples': len(stats)}
+
+
+def format_report(report):
+    header = ('kind', 'sent', 'ok', 'err%', 'ok/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')
+    rows = []
+    for kind, k in sorted(report['kinds'].items()):
+        cells = [k['latency_ms']['p50'], k['latency_ms']['p90'], k['latency_ms']['p99'], k['max_ms']]
+        rows.append((kind, str(k['sent']), str(k['ok']), "%.2f" % (100.0 * k['error_rate']),
+                     "%.2f" % k['throughput']) + tuple('-' if v is None else "%.1f" % v for v in cells))
+    widths = [max(len(row[i]) for row in rows + [header]) for i in range(len(header))]
+    lines = ["  ".join(cell.rjust(width) for cell, width in zip(row, widths)) for row in [header] + rows]
+    lines.insert(1, "-" * len(lines[0]))
+    for kind, k in sorted(report['kinds'].items()):
+        if k['errors']:
+            lines.append("%s errors: %s" % (kind, ", ".join("%s x%d" % item for item in sorted(k['errors'].items()))))
+    for name, occupation in sorted(report['saturation'].items()):
+        if occupation:
+            lines.append("%s workers: %d, busy %.0f%% on average, %.0f%% at most, queue at most %d" % (
+                name, occupation['workers'], 100 * occupation['busy_mean'], 100 * occupation['busy_max'],
+                occupation['queue_max']))
+    if 'jobs' in report:
+        jobs = report['jobs']
+        lines.append("trainings: %s" % ", ".join("%s %d" % item for item in sorted(jobs['states'].items())))
+        if jobs['train_seconds_p50'] is not None:
+            lines.append("training time: p50 %.1fs, max %.1fs" % (jobs['train_seconds_p50'],
+                                                                 jobs['train_seconds_max']))
+    return "\n".join(lines)
+
+
+def check_limits(report, max_error_rate=None, max_p99_ms=None):
+    """ Messages of the exceeded limits """
+    failures = []
+    for kind, k in sorted(report['kinds'].items()):
+        if max_error_rate is not None and k['error_rate'] > max_error_rate:
+            failures.append("%s error rate %.3f > %.3f" % (kind, k['error_rate'], max_error_rate))
+        p99 = k['latency_ms']['p99']
+        if max_p99_ms is not None and (p99 is None or p99 > max_p99_ms):
+            failures.append("%s p99 %s ms > %.0f ms" % (kind, "-" if p99 is None else "%.0f" % p99, max_p99_ms))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test of the training and recognition api.')
+    parser.add_argument('--url', help="target a running deployment instead of starting a local server")
+    parser.add_argument('--duration', type=float, default=30, help="seconds of load")
+    parser.add_argument('--ocr-rate', type=float, default=10, help="recognition requests per second")
+    parser.add_argument('--submit-rate', type=float, default=0.2, help="training submissions per second")
+    parser.add_argument('--status-rate', type=float, default=2, help="status polls per second")
+    parser.add_argument('--regions', type=int, default=1, help="regions per recognition request")
+    parser.add_argument('--concurrency', type=int, default=64, help="requests in flight at most")
+    parser.add_argument('--timeout', type=float, default=60, help="request timeout, in seconds")
+    parser.add_argument('--font', help="font of the rendered regions and the trainings (default: DejaVuSans)")
+    parser.add_argument('--font-name', help="with --url: font file name known to the server")
+    parser.add_argument('--train-chars', type=int, default=40, help="characters of a submitted training text")
+    parser.add_argument('--ocr-workers', type=int, default=4, help="local server: OCR_WORKERS")
+    parser.add_argument('--train-workers', type=int, default=2, help="local server: TRAIN_WORKERS")
+    parser.add_argument('--stub-ocr-ms', type=float, default=20, help="local server: stub time per region, in ms")
+    parser.add_argument('--drain', type=float, default=0, help="seconds to wait for the submitted trainings")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="write the report to this json file")
+    parser.add_argument('--max-error-rate', type=float, default=None, help="fail above this error rate")
+    parser.add_argument('--max-p99-ms', type=float, default=None, help="fail above this p99 latency")
+    parser.add_argument('--keep', action='store_true', help="keep the scratch directory of the local server")
+    args = parser.parse_args(argv)
+
+    font = args.font or next((path for path in FONT_CANDIDATES if os.path.exists(path)), None)
+    if font is None:
+        parser.error("no default font found, pass --font")
+    server = None
+    url = args.url
+    font_name = args.font_name or os.path.basename(font)
+    if url is None:
+        server = LocalServer(font, ocr_workers=args.ocr_workers, train_workers=args.train_workers,
+                             stub_ocr_ms=args.stub_ocr_ms)
+        print("**** starting the server in %s" % server.workdir)
+        server.wait_ready()
+        url = server.url
+    rates = {'ocr': args.ocr_rate, 'submit': args.submit_rate, 'status': args.status_rate}
+    try:
+        test = LoadTest(url, rates, args.duration, font_name, render_line(font), regions=args.regions,
+                        concurrency=args.concurrency, timeout=args.timeout, train_chars=args.train_chars,
+                        seed=args.seed)
+        print("**** %.0fs of load on %s: %s" % (args.duration, url,
+                                               ", ".join("%s %g/s" % (k, rates[k]) for k in KINDS)))
+        test.run()
+        report = test.report(drain=args.drain)
+    finally:
+        if server is not None:
+            server.stop(keep=args.keep)
+    print(format_report(report))
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    failures = check_limits(report, args.max_error_rate, args.max_p99_ms)
+    for failure in failures:
+        print("LIMIT EXCEEDED: %s" % failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,63 @@
+# coding:utf-8
+"""
+DAWG builder (django_web/tesseract_trainer/dawg.py): a shuffled word list sorted in several
+runs is read back from the written squished dawg.
+"""
+import os
+import random
+import struct
+
+from django_web.tesseract_trainer.dawg import DAWG_MAGIC, build_dawg, encode_word, read_dawg, read_unicharset
+
+# unichar ids 1..n, 'ch' is a single unichar
+UNICHARS = ['a', 'b', 'c', 'ch', 'd', 'e', 'f', 'g', 'h']
+
+
+def _write_unicharset(path):
+    with open(path, 'w', encoding='UTF-8') as fp:
+        fp.write("%d\n" % (len(UNICHARS) + 1))
+        fp.write("NULL 0 Common 0\n")
+        for idx, unichar in enumerate(UNICHARS, 1):
+            fp.write("%s 3 0,255,0,255,0,0,0,0,0,0 Latin %d 0 %d %s\n" % (unichar, idx, idx, unichar))
+
+
+def test_round_trip(tmp_path):
+    rng = random.Random(7)
+    letters = "abcdefgh"
+    words = ["".join(rng.choice(letters) for _ in range(rng.randint(1, 8))) for _ in range(300)]
+    # duplicates, and words with a character the unicharset does not know
+    words += words[:50] + ["xyz", "abz"]
+    rng.shuffle(words)
+    word_list = str(tmp_path / 'words.txt')
+    with open(word_list, 'w', encoding='UTF-8') as fp:
+        fp.write("\n".join(words) + "\n")
+    unicharset = str(tmp_path / 'unicharset')
+    _write_unicharset(unicharset)
+    dawg_path = str(tmp_path / 'eng.word-dawg')
+
+    # runs of 16 words: about 20 sorted runs are merged
+    stats = build_dawg(word_list, unicharset, dawg_path, chunk_size=16, tmp_dir=str(tmp_path))
+
+    unichars, size = read_unicharset(unicharset)
+    expected = set(encode_word(word, unichars, 2) for word in words) - {None}
+    read = list(read_dawg(dawg_path))
+    assert len(read) == len(set(read))
+    assert set(read) == expected
+    assert stats['read'] == len(words)
+    assert stats['dropped'] == 2
+    assert stats['words'] == len(expected)
+
+    with open(dawg_path, 'rb') as fp:
+        magic, unicharset_size, num_edges = struct.unpack('<hii', fp.read(10))
+        records = fp.read()
+    assert (magic, unicharset_size) == (DAWG_MAGIC, size)
+    assert num_edges == stats['edges'] == len(records) // 8
+    assert os.path.getsize(dawg_path) == 10 + 8 * num_edges
+    # root edges: one per first unichar, in increasing unichar id order, the last one marked
+    shift = 4  # ceil(log2(10 + 1))
+    root = []
+    for (record,) in struct.iter_unpack('<Q', records):
+        root.append(record & ((1 << shift) - 1))
+        if (record >> shift) & 1:
+            break
+    assert root == sorted(set(ids[0] for ids in expected))
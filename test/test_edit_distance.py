@@ -0,0 +1,65 @@
+# coding:utf-8
+"""
+Bit-parallel edit distances (django_web/util/edit_distance.py) against the plain dynamic
+programming distance.
+"""
+import random
+
+from django_web.util.edit_distance import ErrorCounts, LANE_BITS, align, distance, distances
+
+
+def dp_distance(a, b):
+    """ Plain dynamic programming Levenshtein distance, the reference """
+    previous = list(range(len(b) + 1))
+    for i, item in enumerate(a, 1):
+        current = [i]
+        for j, other in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (item != other)))
+        previous = current
+    return previous[-1]
+
+
+def _pairs(rng, count, max_len, alphabet):
+    pairs = []
+    for _ in range(count):
+        a = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, max_len)))
+        # mostly a noisy copy of a, sometimes unrelated
+        if rng.random() < 0.8:
+            b = "".join(char for char in a if rng.random() > 0.1)
+            b = "".join(char + (rng.choice(alphabet) if rng.random() < 0.05 else "") for char in b)
+        else:
+            b = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, max_len)))
+        pairs.append((a, b))
+    return pairs
+
+
+def test_distances_match_dp():
+    rng = random.Random(5)
+    # short pairs run in the numpy lanes, the long ones (> LANE_BITS after trimming) through distance()
+    pairs = _pairs(rng, 400, 40, "abcd") + _pairs(rng, 60, 3 * LANE_BITS, "中华人民共和国") + [
+        ("", ""), ("", "abc"), ("abc", ""), ("same", "same"), ("x" * 70, "y" * 70)]
+    expected = [dp_distance(a, b) for a, b in pairs]
+    assert distances(pairs) == expected
+    assert [distance(a, b) for a, b in pairs] == expected
+
+
+def test_word_distances():
+    pairs = [("the cat sat".split(), "the cat sat down".split()), ("a b c".split(), "a x c".split()),
+             (["中华", "人民"], ["中华", "人"])]
+    assert distances(pairs) == [dp_distance(a, b) for a, b in pairs] == [1, 1, 1]
+
+
+def test_align_and_counts():
+    rng = random.Random(11)
+    for a, b in _pairs(rng, 100, 60, "abcde"):
+        operations = align(a, b)
+        assert len(operations) == dp_distance(a, b)
+    assert align("abcd", "abxd") == [("c", "x")]
+    assert align("abc", "abc", max_cells=0) == []
+    assert align("abcdef", "ghijkl", max_cells=10) is None
+
+    counts = ErrorCounts(confusions=True)
+    counts.add_pages([("中华人民 共和国", "中华人民 共合国"), ("ab cd", "ab")])
+    assert (counts.char_errors, counts.chars) == (1 + 2, 7 + 4)
+    assert (counts.word_errors, counts.words) == (1 + 1, 2 + 2)
+    assert counts.top_confusions(1) == [(("和", "合"), 1)]
@@ -0,0 +1,99 @@
+# coding:utf-8
+"""
+Distributed training through the job queue, on one box: DistributedTraining.run starts local
+worker processes, the tesseract tools are stubs written to a temporary PATH.
+
+- the box.train of exp 0 fails once: its unit is tried again;
+- the box.train of exp 1 kills its worker (and the unit) once: the unit is claimed again by
+  the other worker when its lease expires.
+"""
+import glob
+import multiprocessing
+import os
+import sqlite3
+import stat
+import sys
+
+import pytest
+
+from django_web.tesseract_trainer import TesseractTrainer, ON_EXISTS_CLEAN
+from django_web.tesseract_trainer import scheduler
+from django_web.tesseract_trainer.job_queue import JobQueue, DistributedTraining, STATE_DONE
+
+FONT_PATTERNS = ['/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', '/usr/share/fonts/**/*.ttf',
+                 '/Library/Fonts/*.ttf', 'C:\\Windows\\Fonts\\*.ttf']
+
+TESSERACT_STUB = """#!{python}
+import os, signal, sys
+prefix = sys.argv[2]
+marker = os.path.join({stubs!r}, os.path.basename(prefix) + '.seen')
+first = not os.path.exists(marker)
+open(marker, 'a').close()
+if first and prefix.endswith('exp0'):
+    sys.exit(1)
+if first and prefix.endswith('exp1'):
+    unit = os.getppid()
+    with open('/proc/%d/stat' % unit) as fp:
+        worker = int(fp.read().rsplit(')', 1)[1].split()[1])
+    os.kill(worker, signal.SIGKILL)
+    os.kill(unit, signal.SIGKILL)
+    sys.exit(1)
+open(prefix + '.tr', 'w').close()
+"""
+
+STUBS = {
+    'unicharset_extractor': "#!/bin/sh\nprintf '3\\nNULL 0 Common 0\\na 3 0 Latin 1 0 1 a\\nb 3 0 Latin 2 0 2 b\\n'"
+                            " > unicharset\n",
+    'mftraining': "#!/bin/sh\ntouch unicharset pffmtable inttemp normproto shapetable\n",
+    'cntraining': "#!/bin/sh\ntouch unicharset pffmtable inttemp normproto shapetable\n",
+    'magick': "#!/bin/sh\nfor last; do :; done\ncat \"$1\" > \"$last\"\n",
+}
+
+
+def _font():
+    for pattern in FONT_PATTERNS:
+        found = sorted(glob.glob(pattern, recursive=True))
+        if found:
+            return found[0]
+    return None
+
+
+def _write_stubs(directory):
+    os.makedirs(directory)
+    stubs = dict(STUBS, tesseract=TESSERACT_STUB.format(python=sys.executable, stubs=directory))
+    for name, content in stubs.items():
+        path = os.path.join(directory, name)
+        with open(path, 'w') as fp:
+            fp.write(content)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux') or multiprocessing.get_start_method() != 'fork',
+                    reason="stub workers need /proc and fork")
+def test_retry_and_lease_expiry(tmp_path, monkeypatch):
+    font = _font()
+    if font is None:
+        pytest.skip("no truetype font on this host")
+    stubs = str(tmp_path / 'bin')
+    _write_stubs(stubs)
+    monkeypatch.setenv('PATH', stubs + os.pathsep + os.environ.get('PATH', ''))
+    # ledger and memory estimates of the test only, the forked workers inherit the scheduler
+    monkeypatch.setattr(scheduler, '_scheduler', scheduler.ResourceScheduler(
+        ledger_path=str(tmp_path / 'ledger.json'), estimates_path=str(tmp_path / 'estimates.json')))
+    ref_path = tmp_path / 'ref'
+    tessdata = tmp_path / 'tessdata'
+    ref_path.mkdir()
+    tessdata.mkdir()
+    trainer = TesseractTrainer(str(ref_path), 'eng', 7, 'tst', 'stub', 'ab', [font, font], (0, 0, 0, 0, 0), 20,
+                               tessdata_path=str(tessdata), on_exists=ON_EXISTS_CLEAN, verbose=False,
+                               skip_missing_glyphs=False)
+    queue = JobQueue(str(ref_path / 'queue.db'), lease_seconds=3)
+
+    traineddata = DistributedTraining(trainer, queue, timeout=120).run(local_workers=2)
+
+    assert os.path.exists(traineddata)
+    with sqlite3.connect(queue.db_path) as conn:
+        units = conn.execute("SELECT kind, payload, state, attempts, error FROM units ORDER BY id").fetchall()
+    assert [(kind, state) for kind, _, state, _, _ in units] == [('font', STATE_DONE)] * 2 + [('cluster', STATE_DONE)]
+    # exp 0: failed attempt then retry; exp 1: lease of the killed worker expired, claimed again
+    assert [attempts for _, _, _, attempts, _ in units] == [2, 2, 1]
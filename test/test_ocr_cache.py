@@ -0,0 +1,47 @@
+# coding:utf-8
+"""
+OCR result cache (django_web/tesseract_trainer/ocr_cache.py): models are keyed by the content
+of their traineddata, two identical models named apart (as the combinations of a sweep are)
+share their results.
+"""
+import numpy as np
+
+from django_web.tesseract_trainer.ocr_cache import OcrCache
+
+
+def _pages():
+    pages = [np.full((20, 30), 255, dtype=np.uint8) for _ in range(3)]
+    pages[1][5:10, 5:10] = 0
+    pages[2][10:15, 5:25] = 0
+    # the same page twice is recognized once
+    return pages + [pages[1].copy()]
+
+
+def test_identical_models_share_results(tmp_path):
+    tessdata = tmp_path / 'tessdata'
+    tessdata.mkdir()
+    for name, content in [('tst_sw000', b"model"), ('tst_sw001', b"model"), ('tst_sw002', b"other")]:
+        (tessdata / ('%s.traineddata' % name)).write_bytes(content)
+    cache = OcrCache(str(tmp_path / 'ocr_cache.db'), tesseract_cmd=str(tmp_path / 'no_tesseract'))
+    recognized = []
+
+    def ocr(page):
+        recognized.append(page)
+        return "text %d" % int(page.sum())
+
+    pages = _pages()
+    first = cache.recognize(pages, 'tst_sw000', 6, ocr, str(tessdata))
+    assert len(recognized) == 3
+    assert cache.model_hash('tst_sw000', str(tessdata)) == cache.model_hash('tst_sw001', str(tessdata))
+
+    # same traineddata under another name: every page is a hit
+    assert cache.recognize(pages, 'tst_sw001', 6, ocr, str(tessdata)) == first
+    assert len(recognized) == 3
+    assert (cache.hits, cache.misses) == (1 + 4, 3)
+
+    # another psm, another model, or a missing traineddata: recognized again
+    cache.recognize(pages, 'tst_sw001', 7, ocr, str(tessdata))
+    cache.recognize(pages, 'tst_sw002', 6, ocr, str(tessdata))
+    cache.recognize(pages, 'tst_missing', 6, ocr, str(tessdata))
+    assert len(recognized) == 3 + 3 + 3 + 3
+    assert (cache.hits, cache.misses, cache.uncached) == (1 + 4 + 3, 9, 3)
@@ -0,0 +1,76 @@
+# coding:utf-8
+"""
+Pre-flight page check (django_web/tesseract_trainer/page_check.py) on synthetic pages whose
+issues are known.
+"""
+import numpy as np
+from PIL import Image
+
+from django_web.tesseract_trainer.page_check import check_files, check_page
+
+
+def _page(height=100, width=200):
+    return np.full((height, width), 255, dtype=np.uint8)
+
+
+def test_clean_page():
+    page = _page()
+    page[20:40, 20:35] = 0
+    page[20:40, 60:75] = 0
+    report = check_page(page, [[18, 18, 37, 42], [58, 18, 77, 42]], page_nb=3)
+    assert report.ok
+    assert report.page_nb == 3
+    assert report.describe() == ""
+
+
+def test_box_issues():
+    page = _page()
+    page[20:40, 20:35] = 0  # box 0: inked
+    page[60, 100] = 0  # box 2: one ink pixel in 20x20, sparse
+    page[20:40, 150:160] = 0  # boxes 3 and 4 overlap on it
+    boxes = [[18, 18, 37, 42],
+             [60, 10, 80, 30],  # empty
+             [90, 50, 110, 70],
+             [148, 18, 158, 42],
+             [155, 18, 162, 42],
+             [190, 80, 210, 90]]  # outside (x1 > width)
+    report = check_page(page, boxes)
+    assert report.box_issues['outside'].tolist() == [False, False, False, False, False, True]
+    assert report.box_issues['empty'].tolist() == [False, True, False, False, False, True]
+    assert report.box_issues['sparse'].tolist() == [False, False, True, False, False, False]
+    assert report.box_issues['overlap'].tolist() == [False, False, False, True, True, False]
+    assert report.bad_boxes.tolist() == [False, True, True, True, True, True]
+    assert not report.page_issue and not report.ok
+
+
+def test_page_issues():
+    page = _page()
+    page[20:40, 20:35] = 0
+    page[0:5, 100:110] = 0  # touching the top border, outside of every box
+    page[70:72, 50:53] = 0  # 6 stray pixels
+    report = check_page(page, [[18, 18, 37, 42]])
+    assert report.clipped
+    assert report.stray_ink == 50 + 6
+    assert report.page_issue
+    assert report.counts()['clipped'] == 1
+    # stray ink up to max_stray is tolerated
+    assert check_page(page, [[18, 18, 37, 42], [98, 0, 112, 6]], max_stray=6).stray_ink == 0
+
+
+def test_check_files(tmp_path):
+    first, second = _page(), _page()
+    first[20:40, 20:35] = 0
+    second[20:40, 20:35] = 0
+    tif_path = str(tmp_path / 'tst.font.exp0.tif')
+    Image.fromarray(first).save(tif_path, save_all=True, append_images=[Image.fromarray(second)])
+    box_path = str(tmp_path / 'tst.font.exp0.box')
+    height = first.shape[0]
+    with open(box_path, 'w', encoding='UTF-8') as fp:
+        # tesseract coordinates, y from the bottom: left bottom right top page
+        fp.write("a 18 %d 37 %d 0\n" % (height - 42, height - 18))
+        fp.write("b 18 %d 37 %d 1\n" % (height - 42, height - 18))
+        fp.write("c 60 %d 80 %d 1\n" % (height - 30, height - 10))  # empty box
+    reports = check_files(tif_path, box_path)
+    assert [report.page_nb for report in reports] == [0, 1]
+    assert reports[0].ok
+    assert reports[1].box_issues['empty'].tolist() == [False, True]
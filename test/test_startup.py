@@ -0,0 +1,63 @@
+# coding:utf-8
+"""
+Startup cost check: importing the trainer and the util modules must not load
+cv2/PIL/numpy/libtiff/django, so that render and training workers are cheap to spawn.
+
+Run it directly to print the import cost of each module:
+    python test/test_startup.py
+"""
+import os
+import subprocess
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules a worker process imports before doing any work
+LIGHT_MODULES = [
+    'django_web.tesseract_trainer',
+    'django_web.tesseract_trainer.multipage_tif',
+    'django_web.util.img_util',
+    'django_web.util.file_util',
+]
+# modules which must only be imported on first use
+HEAVY_MODULES = ['cv2', 'PIL', 'numpy', 'libtiff', 'django', 'pytesseract']
+# generous upper bound of the import time of a single light module, in ms
+IMPORT_BUDGET_MS = 300
+
+_PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+print('%.2f' % ((time.perf_counter() - start) * 1000))
+print(','.join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+
+def import_cost(module):
+    """ Import module in a fresh interpreter
+    :param module: dotted module name
+    :return: (import time in ms, list of heavy modules loaded by the import)
+    """
+    code = _PROBE.format(module=module, heavy=HEAVY_MODULES)
+    run = subprocess.run([sys.executable, '-c', code], cwd=BASE_DIR,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if run.returncode != 0:
+        raise AssertionError("import %s failed:\n%s" % (module, str(run.stderr, 'utf-8')))
+    lines = str(run.stdout, 'utf-8').splitlines()
+    elapsed = float(lines[0])
+    loaded = [m for m in lines[1].split(',') if m] if len(lines) > 1 else []
+    return elapsed, loaded
+
+
+def test_no_heavy_import_at_startup():
+    for module in LIGHT_MODULES:
+        elapsed, loaded = import_cost(module)
+        assert not loaded, "%s imports %s at load time" % (module, ", ".join(loaded))
+        assert elapsed < IMPORT_BUDGET_MS, "%s took %.1f ms to import" % (module, elapsed)
+
+
+if __name__ == '__main__':
+    print("%-45s %10s  %s" % ("module", "time(ms)", "heavy modules loaded"))
+    for module in LIGHT_MODULES:
+        elapsed, loaded = import_cost(module)
+        print("%-45s %10.2f  %s" % (module, elapsed, ", ".join(loaded) or "-"))
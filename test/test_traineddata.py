@@ -0,0 +1,77 @@
+# coding:utf-8
+"""
+Traineddata reader and writer (django_web/tesseract_trainer/traineddata.py): files written
+from components are read back component by component, edited and compared.
+"""
+import struct
+
+import pytest
+
+from django_web.model import ServiceException
+from django_web.tesseract_trainer.traineddata import (COMPONENTS, LEGACY_ENTRIES, TrainedData, combine, compare,
+                                                      replace_components, write_traineddata)
+
+LEGACY = {'unicharset': b"3\nNULL 0 Common 0\n", 'inttemp': b"\x01\x02\x03" * 100, 'pffmtable': b"",
+          'normproto': b"normproto", 'shapetable': b"shapes"}
+
+
+def _read_all(path):
+    with TrainedData(path) as data:
+        return data.num_entries, dict((name, bytes(data.view(name))) for name in data.names())
+
+
+def test_combine_round_trip(tmp_path):
+    prefix = str(tmp_path / 'tst.')
+    for name, content in LEGACY.items():
+        with open(prefix + name, 'wb') as fp:
+            fp.write(content)
+
+    written = combine(prefix)
+
+    assert written == [name for name in COMPONENTS if name in LEGACY]
+    num_entries, components = _read_all(prefix + 'traineddata')
+    # the empty pffmtable stays a present component
+    assert (num_entries, components) == (LEGACY_ENTRIES, LEGACY)
+    with TrainedData(prefix + 'traineddata') as data:
+        assert data.version() is None
+        with pytest.raises(ServiceException):
+            data.view('word-dawg')
+
+
+def test_tesseract4_entries_and_replace(tmp_path):
+    path = str(tmp_path / 'tst.traineddata')
+    components = dict(LEGACY, lstm=bytearray(b"L" * 1000), version=b"4.1.1:tst")
+    write_traineddata(path, components)
+    num_entries, read = _read_all(path)
+    assert num_entries == len(COMPONENTS)
+    assert read == dict((name, bytes(content)) for name, content in components.items())
+    with TrainedData(path) as data:
+        assert data.version() == "4.1.1:tst"
+
+    edited = str(tmp_path / 'edited.traineddata')
+    replace_components(path, {'word-dawg': b"dawg", 'shapetable': None, 'inttemp': b"new"}, edited)
+    _, read = _read_all(edited)
+    assert read['word-dawg'] == b"dawg" and read['inttemp'] == b"new" and 'shapetable' not in read
+    assert read['lstm'] == b"L" * 1000
+    status = dict(compare(path, edited))
+    assert status == {'unicharset': 'same', 'inttemp': 'differs', 'pffmtable': 'same', 'normproto': 'same',
+                      'word-dawg': 'only in b', 'shapetable': 'only in a', 'lstm': 'same', 'version': 'same'}
+
+
+def test_big_endian_file(tmp_path):
+    path = str(tmp_path / 'be.traineddata')
+    offsets = [-1] * LEGACY_ENTRIES
+    offsets[COMPONENTS.index('unicharset')] = 4 + 8 * LEGACY_ENTRIES
+    with open(path, 'wb') as fp:
+        fp.write(struct.pack('>i%dq' % LEGACY_ENTRIES, LEGACY_ENTRIES, *offsets) + LEGACY['unicharset'])
+    assert _read_all(path) == (LEGACY_ENTRIES, {'unicharset': LEGACY['unicharset']})
+
+
+def test_invalid_offsets(tmp_path):
+    path = str(tmp_path / 'bad.traineddata')
+    offsets = [-1] * LEGACY_ENTRIES
+    offsets[0] = 10  # inside the offset table
+    with open(path, 'wb') as fp:
+        fp.write(struct.pack('<i%dq' % LEGACY_ENTRIES, LEGACY_ENTRIES, *offsets) + b"x" * 20)
+    with pytest.raises(ServiceException):
+        TrainedData(path)
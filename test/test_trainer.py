@@ -1,17 +1,12 @@
 # coding:utf-8
-import django_web.django_setting
 from django_web.tesseract_trainer import TesseractTrainer
 import os
-from img_ai_trainer.settings import BASE_DIR
-from django_web.util import file_util as fu
-from django.conf import settings
-import pytesseract
-from PIL import Image
-from libtiff import TIFF
-import random
+from img_ai_trainer.settings import BASE_DIR, WIN_PLATFORM
+from django_web.util.corpus import CharIndex
+from django_web.tesseract_trainer.ocr_cache import OcrCache
 
 resource = os.path.join(BASE_DIR, "django_web/resource")
-if settings.WIN_PLATFORM:
+if WIN_PLATFORM:
     tessdata_path = "C:\\Program Files (x86)\\Tesseract-OCR\\tessdata"
 else:
     tessdata_path = os.path.join(resource, "tess_data")
@@ -24,7 +19,8 @@ training_test_file = "han"
 # ********
 base_lang = "chi_sim"
 base_psm = 6
-shuffle = False
+max_repeat = None  # 每个字最多重复的次数, None则保留语料中的全部出现次数
+shuffle_seed = None  # 设为整数则按该种子打乱训练字符
 font_name = "myfont"
 # ttf_file = os.path.join(resource, "ttf", "msyh.ttf")
 ttf_file_list = []
@@ -39,14 +35,12 @@ ttf_file_list.append(os.path.join(resource, "ttf", "ARIALUNI.TTF"))  # Arial Uni
 font_size = 60
 train_id = 0  # 训练编号
 font_properties = (0, 0, 0, 0, 0)
+ocr_cache_path = os.path.join(ref_path, ".ocr_cache.db")  # 识别结果缓存
 
 
 def train_lang():
-    training_text = fu.read_file(os.path.join(resource, "train_text"), training_test_file)
-    if shuffle:
-        training_text = list(training_text)
-        random.shuffle(training_text)
-        training_text = "".join(training_text)
+    corpus = CharIndex.from_file(os.path.join(resource, "train_text", training_test_file))
+    training_text = corpus.training_text(max_repeat=max_repeat, shuffle_seed=shuffle_seed)
     # tessdata_path = os.path.join(resource, "tess_data")
     trainer = TesseractTrainer(ref_path,
                                base_lang,
@@ -65,22 +59,33 @@ def train_lang():
     # trainer.clean()  # remove all files generated in the training process (except the traineddata file)
 
 
-def case_test(lang, psm, sample):
+def case_test(lang, psm, sample, ocr_cache=None):
+    from django_web.tesseract_trainer.evaluate import ocr_pages, load_truth
+    from django_web.util.edit_distance import ErrorCounts
     print("************ CASE CHECK ************")
     image_path = os.path.join(resource, "check_case/%s.tif"%sample)
-    tif = TIFF.open(image_path, mode='r')
-    index = 0
-    for im in tif.iter_images():
-        # test
-        text = pytesseract.image_to_string(im, lang, config="-psm %d" % psm)
+    # 图片和语言包都没变的页面直接使用上次的识别结果
+    texts = ocr_pages(image_path, lang, psm, cache=ocr_cache)
+    for index, text in enumerate(texts):
         print("idx =%d result = %s" % (index, text))
-        index += 1
+    # 有标注文件check_case/{sample}.txt时计算字错误率、词错误率和最常见的识别错误
+    truth_path = os.path.join(resource, "check_case/%s.txt" % sample)
+    if os.path.exists(truth_path):
+        counts = ErrorCounts(confusions=True)
+        counts.add_pages(zip(load_truth(truth_path), texts))
+        print("cer = %.4f (%d/%d) wer = %.4f (%d/%d)" % (counts.cer(), counts.char_errors, counts.chars,
+                                                         counts.wer(), counts.word_errors, counts.words))
+        for (expected, actual), count in counts.top_confusions(10):
+            print("  %s -> %s : %d" % (expected or "(missing)", actual or "(extra)", count))
+    if ocr_cache is not None:
+        print(ocr_cache.describe())
 
 
 if __name__ == '__main__':
     train_lang()
-    case_test(lang_name, base_psm,"address_sample")
-    case_test(lang_name, base_psm, "address_sample")
+    cache = OcrCache(ocr_cache_path)
+    case_test(lang_name, base_psm, "address_sample", cache)
+    case_test(lang_name, base_psm, "address_sample", cache)
     # case_test("han", 6)
 
 